@@ -0,0 +1,183 @@
+import asyncio
+import functools
+import logging
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import main
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Асинхронный фронтенд. psycopg2 блокирующий, поэтому синхронный код
+# выполняется в отдельном пуле потоков, а цикл событий держит тысячи
+# ожидающих команд. Одновременно в базу уходит не больше DB_CONCURRENCY
+# команд; сообщения отправляет диспетчер db, и доставки одновременно ждут
+# не больше HTTP_CONCURRENCY из них.
+
+DB_CONCURRENCY = None     # по умолчанию — размер пула соединений db.DB_POOL['maxconn']
+HTTP_CONCURRENCY = 64
+
+# Команды, которым не нужна база: выполняются прямо в цикле событий
+LOCAL_COMMANDS = {"/validate"}
+
+_executors = {}
+_executors_lock = threading.Lock()
+_limits = weakref.WeakKeyDictionary()   # цикл событий -> {"db": Semaphore, "http": Semaphore}
+
+
+def _db_concurrency():
+    return DB_CONCURRENCY or db.DB_POOL['maxconn']
+
+
+def _executor(kind):
+    """Возвращает пул потоков для "db" или "http", создавая его при первом вызове."""
+    executor = _executors.get(kind)
+    if executor is None:
+        with _executors_lock:
+            executor = _executors.get(kind)
+            if executor is None:
+                workers = _db_concurrency() if kind == "db" else HTTP_CONCURRENCY
+                executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"aio-{kind}")
+                _executors[kind] = executor
+    return executor
+
+
+def _limit(kind):
+    loop = asyncio.get_running_loop()
+    limits = _limits.get(loop)
+    if limits is None:
+        limits = {"db": asyncio.Semaphore(_db_concurrency()), "http": asyncio.Semaphore(HTTP_CONCURRENCY)}
+        _limits[loop] = limits
+    return limits[kind]
+
+
+async def _run(kind, func, *args, **kwargs):
+    # Семафор держит лишние вызовы в цикле событий, а не в очереди пула потоков,
+    # поэтому отмена ожидающей задачи ничего не оставляет в пуле
+    async with _limit(kind):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor(kind), functools.partial(func, *args, **kwargs))
+
+
+async def run_db(func, *args, **kwargs):
+    """Выполняет синхронную функцию работы с базой, не блокируя цикл событий."""
+    return await _run("db", func, *args, **kwargs)
+
+
+def _async_variant(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_db(func, *args, **kwargs)
+    wrapper.__name__ = wrapper.__qualname__ = f"{func.__name__}_async"
+    return wrapper
+
+
+# Асинхронные варианты функций db
+get_user_data_async = _async_variant(db.get_user_data)
+get_user_from_db_async = _async_variant(db.get_user_from_db)
+get_user_balance_async = _async_variant(db.get_user_balance)
+get_balance_async = _async_variant(db.get_balance)
+get_user_info_async = _async_variant(db.get_user_info)
+register_user_async = _async_variant(db.register_user)
+delete_user_account_async = _async_variant(db.delete_user_account)
+apply_balance_delta_async = _async_variant(db.apply_balance_delta)
+transfer_funds_async = _async_variant(db.transfer_funds)
+transfer_balance_async = _async_variant(db.transfer_balance)
+bulk_adjust_balances_async = _async_variant(db.bulk_adjust_balances)
+purge_idempotency_keys_async = _async_variant(db.purge_idempotency_keys)
+add_funds_async = _async_variant(db.add_funds)
+withdraw_funds_async = _async_variant(db.withdraw_funds)
+record_operation_async = _async_variant(db.record_operation)
+log_user_activity_async = _async_variant(db.log_user_activity)
+record_system_event_async = _async_variant(db.record_system_event)
+get_user_operations_async = _async_variant(db.get_user_operations)
+get_user_activity_async = _async_variant(db.get_user_activity)
+get_transaction_history_async = _async_variant(db.get_transaction_history)
+get_all_users_async = _async_variant(db.get_all_users)
+get_system_info_async = _async_variant(db.get_system_info)
+
+
+async def send_message_async(user_id, message):
+    """Отправляет сообщение пользователю, не блокируя цикл событий.
+
+    Отправкой занимается диспетчер db; здесь только ожидание его Future.
+    Семафор ограничивает число сообщений, ждущих доставки.
+    """
+    async with _limit("http"):
+        future = db.send_message(user_id, message, wait=False)
+        if isinstance(future, bool):
+            return future
+        return await asyncio.wrap_future(future)
+
+
+async def handle_command_async(command, *args, sender_id=None):
+    """Асинхронный обработчик команд.
+
+    Команда целиком (с единицей работы) выполняется за один переход в пул
+    потоков базы — так на команду тратится одно соединение и один поток.
+    sender_id — ключ ограничителя частоты (см. main.handle_command).
+    """
+    if command in LOCAL_COMMANDS:
+        return main.handle_command(command, *args, sender_id=sender_id)
+    return await run_db(main.handle_command, command, *args, sender_id=sender_id)
+
+
+async def iter_messages_async(reply):
+    """Асинхронно перебирает ответ команды: строку или генератор сообщений (/users).
+
+    Следующее сообщение генератора читается в пуле потоков базы, чтобы
+    серверный курсор не блокировал цикл событий.
+    """
+    if isinstance(reply, str):
+        yield reply
+        return
+    iterator = iter(reply)
+    done = object()
+    while True:
+        message = await run_db(next, iterator, done)
+        if message is done:
+            return
+        yield message
+
+
+async def handle_update(chat_id, command, *args):
+    """Выполняет команду пользователя и отправляет ему ответ."""
+    try:
+        reply = await handle_command_async(command, *args, sender_id=chat_id)
+    except Exception as e:
+        logger.error("Ошибка при обработке команды %s для %s: %s", command, chat_id, e)
+        reply = "❌ Внутренняя ошибка. Попробуйте позже."
+    sent = 0
+    async for message in iter_messages_async(reply):
+        await send_message_async(chat_id, message)
+        sent += 1
+    return sent
+
+
+async def run_updates(updates):
+    """Обрабатывает пачку обновлений (chat_id, command, *args) конкурентно; возвращает число отправленных сообщений."""
+    return await asyncio.gather(*(handle_update(*update) for update in updates))
+
+
+def shutdown():
+    """Останавливает пулы потоков, endpoint метрик и закрывает пул соединений."""
+    with _executors_lock:
+        executors = list(_executors.values())
+        _executors.clear()
+    for executor in executors:
+        executor.shutdown(wait=True)
+    metrics.stop()
+    db.close_dispatcher()
+    db.close_pool()
+
+
+# Пример использования:
+if __name__ == "__main__":
+    updates = [(user_id, "/balance", user_id) for user_id in ("12345", "67890")]
+    try:
+        print(asyncio.run(run_updates(updates)))
+    finally:
+        shutdown()
@@ -0,0 +1,511 @@
+import argparse
+import datetime
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import uuid
+import zlib
+from decimal import Decimal
+
+from psycopg2 import sql
+
+import db
+import partitions
+
+logger = logging.getLogger(__name__)
+
+# Холодный архив истории. Строки operations и user_activity старше
+# min_age_months выгружаются в файлы <directory>/<таблица>/<YYYY-MM>.arc —
+# по файлу на месяц — и удаляются из базы (отключенные секции из схемы
+# archive, см. partitions.py, удаляются целиком).
+#
+# Файл: MAGIC, блоки пользователей, оглавление, трейлер (смещение и длина
+# оглавления) и снова MAGIC. Блок — сжатые zlib колонки строк одного vk_id,
+# отсортированные по (created_at, id) от новых к старым. Оглавление —
+# сжатый JSON со списком колонок и индексом vk_id -> (смещение, длина,
+# строк). Чтение идет через mmap: страница истории распаковывает только блок
+# нужного пользователя в нужных месяцах. Строки без vk_id (operations до
+# migrate_operations.py) тоже выгружаются — в блок с ключом NO_USER.
+#
+# Секция или месяц удаляются из базы, только если в архиве месяцев столько
+# же строк, сколько в источнике; иначе источник остается и в итоге run()
+# попадает в kept.
+#
+# db.fetch_user_history_page читает архив, когда страница истории доходит
+# до конца живой таблицы, поэтому курсоры страниц продолжают работать и для
+# выгруженных месяцев. Список месяцев, открытые файлы и множество vk_id с
+# архивными строками кэшируются на каталог таблицы, и последняя страница
+# пользователя без архивных строк стоит один stat каталога и поиск в множестве.
+
+ARCHIVE = {
+    'directory': os.environ.get("BOT_ARCHIVE_DIR", "archive"),
+    'min_age_months': 12,       # месяцы старше этого выгружаются из живой таблицы
+    'chunk_size': 50000,        # строк за одно обращение к серверному курсору
+    'delete_batch': 5000,       # строк в одном DELETE после выгрузки
+    'compression_level': 6,
+    'tables': {                 # колонки, которые сохраняются (vk_id — ключ блока)
+        'operations': ["id", "operation_type", "amount", "details", "created_at"],
+        'user_activity': ["id", "action_type", "details", "created_at"],
+    },
+}
+
+MAGIC = b"RDMDARC1"
+NO_USER = ""            # ключ блока строк с vk_id IS NULL
+_TRAILER = struct.Struct("<QQ")
+FILE_SUFFIX = ".arc"
+
+# Значения колонок в блоке хранятся в JSON; эти колонки восстанавливаются при чтении
+_DECODERS = {
+    "created_at": datetime.datetime.fromisoformat,
+    "amount": Decimal,
+}
+
+
+def _encode_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def month_start(moment, shift=0):
+    """Начало месяца moment (UTC), сдвинутое на shift месяцев."""
+    index = moment.year * 12 + moment.month - 1 + shift
+    return datetime.datetime(index // 12, index % 12 + 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def archive_path(table, month, directory=None):
+    return os.path.join(directory or ARCHIVE['directory'], table, f"{month:%Y-%m}{FILE_SUFFIX}")
+
+
+class ArchiveWriter:
+    """Пишет архив месяца во временный файл; close() атомарно ставит его на место.
+
+    Пользователи добавляются по одному (add_user) вместе со всеми своими
+    строками месяца в порядке от новых к старым.
+    """
+
+    def __init__(self, path, table, month, columns, level=None):
+        self.path = path
+        self.table = table
+        self.month = month
+        self.columns = list(columns)
+        self.level = ARCHIVE['compression_level'] if level is None else level
+        self.users = {}
+        self.rows = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        self._file = open(self._tmp, "wb")
+        self._file.write(MAGIC)
+
+    def add_user(self, vk_id, rows):
+        """rows — кортежи значений в порядке columns; vk_id None — строки без пользователя."""
+        vk_id = NO_USER if vk_id is None else vk_id
+        block = {column: [_encode_value(row[i]) for row in rows] for i, column in enumerate(self.columns)}
+        payload = zlib.compress(json.dumps(block, ensure_ascii=False, separators=(",", ":")).encode(), self.level)
+        self.users[vk_id] = [self._file.tell(), len(payload), len(rows)]
+        self._file.write(payload)
+        self.rows += len(rows)
+
+    def close(self):
+        header = zlib.compress(json.dumps({
+            "table": self.table,
+            "month": f"{self.month:%Y-%m}",
+            "columns": self.columns,
+            "rows": self.rows,
+            "users": self.users,
+        }, ensure_ascii=False, separators=(",", ":")).encode(), self.level)
+        offset = self._file.tell()
+        self._file.write(header)
+        self._file.write(_TRAILER.pack(offset, len(header)))
+        self._file.write(MAGIC)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self._tmp, self.path)
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.remove(self._tmp)
+        except FileNotFoundError:
+            pass
+
+
+class ArchiveFile:
+    """Архив месяца, открытый через mmap; оглавление читается один раз при открытии."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self._file.close()
+            raise
+        tail = len(MAGIC) + _TRAILER.size
+        if self._map[:len(MAGIC)] != MAGIC or self._map[-len(MAGIC):] != MAGIC:
+            self.close()
+            raise ValueError(f"Файл {path} не является архивом истории")
+        offset, length = _TRAILER.unpack(self._map[-tail:-len(MAGIC)])
+        header = json.loads(zlib.decompress(self._map[offset:offset + length]))
+        self.table = header["table"]
+        self.columns = header["columns"]
+        self.rows = header["rows"]
+        self.users = header["users"]
+
+    def user_rows(self, vk_id):
+        """Колонки строк пользователя (dict колонка -> список значений) или None."""
+        entry = self.users.get(vk_id)
+        if entry is None:
+            return None
+        offset, length, _ = entry
+        block = json.loads(zlib.decompress(self._map[offset:offset + length]))
+        for column, decode in _DECODERS.items():
+            if column in block:
+                block[column] = [decode(value) if value is not None else None for value in block[column]]
+        return block
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+_open_files = {}
+_open_lock = threading.Lock()
+# Каталог таблицы -> [mtime каталога, месяцы от новых к старым, {месяц: ArchiveFile},
+# vk_id с архивными строками (None, пока не понадобились)]
+_tables = {}
+
+
+def open_archive(path):
+    """Открытый ArchiveFile для path; файл переоткрывается, если его перезаписали."""
+    mtime = os.stat(path).st_mtime_ns
+    with _open_lock:
+        cached = _open_files.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        # Старый файл не закрывается: его может читать другой поток,
+        # отображение освободится вместе с объектом
+        archive = ArchiveFile(path)
+        _open_files[path] = (mtime, archive)
+    return archive
+
+
+def close_archives():
+    with _open_lock:
+        files = [archive for _, archive in _open_files.values()]
+        _open_files.clear()
+        _tables.clear()
+    for archive in files:
+        archive.close()
+
+
+def _table_folder(table, directory=None):
+    return os.path.join(directory or ARCHIVE['directory'], table)
+
+
+def _table_archive(table, directory=None):
+    """(месяцы от новых к старым, открытые файлы месяцев) архива таблицы.
+
+    Каталог перечитывается, только когда меняется его mtime (файл месяца
+    ставится на место через os.replace) или после export_month в этом
+    процессе; кэш файлов сбрасывается вместе со списком.
+    """
+    folder = _table_folder(table, directory)
+    try:
+        mtime = os.stat(folder).st_mtime_ns
+    except FileNotFoundError:
+        return [], {}
+    with _open_lock:
+        cached = _tables.get(folder)
+    if cached is None or cached[0] != mtime:
+        cached = [mtime, _list_months(folder), {}, None]
+        with _open_lock:
+            _tables[folder] = cached
+    return cached[1], cached[2]
+
+
+def archived_users(table, directory=None):
+    """vk_id, у которых есть строки в архиве table (по оглавлениям всех месяцев).
+
+    Множество кэшируется вместе со списком месяцев: для пользователя без
+    архивных строк read_history не перебирает месяцы.
+    """
+    months, files = _table_archive(table, directory)
+    with _open_lock:
+        cached = _tables.get(_table_folder(table, directory))
+    if cached is not None and cached[2] is files and cached[3] is not None:
+        return cached[3]
+    users = set()
+    for month in months:
+        archive = files.get(month)
+        if archive is None:
+            archive = files[month] = open_archive(archive_path(table, month, directory))
+        users.update(archive.users)
+    if cached is not None and cached[2] is files:
+        cached[3] = users
+    return users
+
+
+def _forget_table(table, directory=None):
+    with _open_lock:
+        _tables.pop(_table_folder(table, directory), None)
+
+
+def archived_months(table, directory=None):
+    """Месяцы, выгруженные в архив, от новых к старым."""
+    return _table_archive(table, directory)[0]
+
+
+def _list_months(folder):
+    try:
+        names = os.listdir(folder)
+    except FileNotFoundError:
+        return []
+    months = []
+    for name in names:
+        if name.endswith(FILE_SUFFIX):
+            try:
+                months.append(datetime.datetime.strptime(name[:-len(FILE_SUFFIX)], "%Y-%m")
+                              .replace(tzinfo=datetime.timezone.utc))
+            except ValueError:
+                continue
+    return sorted(months, reverse=True)
+
+
+def read_history(table, vk_id, columns, limit, before=None, directory=None):
+    """Строки истории пользователя из архива от новых к старым, не больше limit.
+
+    Каждая строка — значения columns, затем created_at и id, как у
+    db.fetch_history_page. before — ключ (created_at, id): берутся строки
+    строго старше него. Таблицы не из ARCHIVE['tables'] не выгружаются,
+    для них сразу возвращается пустой список.
+    """
+    if table not in ARCHIVE['tables'] or vk_id not in archived_users(table, directory):
+        return []
+    rows = []
+    months, files = _table_archive(table, directory)
+    for month in months:
+        if len(rows) >= limit:
+            break
+        if before is not None and month > before[0]:
+            continue
+        archive = files.get(month)
+        if archive is None:
+            archive = files[month] = open_archive(archive_path(table, month, directory))
+        block = archive.user_rows(vk_id)
+        if block is None:
+            continue
+        created, ids = block["created_at"], block["id"]
+        values = [block.get(column, [None] * len(ids)) for column in columns]
+        for i in range(len(ids)):
+            if before is not None and (created[i], ids[i]) >= before:
+                continue
+            rows.append(tuple(value[i] for value in values) + (created[i], ids[i]))
+            if len(rows) >= limit:
+                break
+    return rows
+
+
+def iter_archived_blocks(table, skip_months=(), directory=None):
+    """Генератор: (месяц, vk_id, колонки блока) по всем архивным файлам table, кроме skip_months.
+
+    Читает каждый блок каждого месяца — это для полного пересчета
+    (reconcile.py), а не для страниц истории.
+    """
+    months, files = _table_archive(table, directory)
+    for month in months:
+        if month in skip_months:
+            continue
+        archive = files.get(month)
+        if archive is None:
+            archive = files[month] = open_archive(archive_path(table, month, directory))
+        for vk_id in archive.users:
+            yield month, vk_id, archive.user_rows(vk_id)
+
+
+def _months_of(source, until=None):
+    """Месяцы, за которые в source есть строки, до until."""
+    with db.db_cursor() as cursor:
+        cursor.execute(sql.SQL("SELECT min(created_at), max(created_at) FROM {}").format(source))
+        oldest, newest = cursor.fetchone()
+    if oldest is None:
+        return []
+    months, month = [], month_start(oldest)
+    while month <= newest and (until is None or month < until):
+        months.append(month)
+        month = month_start(month, 1)
+    return months
+
+
+def archived_rows(table, month, directory=None):
+    """Число строк в архиве месяца (0, если его нет)."""
+    path = archive_path(table, month, directory)
+    return open_archive(path).rows if os.path.exists(path) else 0
+
+
+def _count_rows(source, month=None):
+    """Число строк в source (за месяц month, если он задан)."""
+    query = sql.SQL("SELECT count(*) FROM {}").format(source)
+    params = []
+    if month is not None:
+        query += sql.SQL(" WHERE created_at >= %s AND created_at < %s")
+        params = [month, month_start(month, 1)]
+    with db.db_cursor() as cursor:
+        cursor.execute(query, params)
+        return cursor.fetchone()[0]
+
+
+def export_month(table, month, source=None, directory=None):
+    """Выгружает все строки месяца из source (по умолчанию — живая таблица) в архив; возвращает число строк.
+
+    Если файл месяца уже есть (прерванный запуск дошел до удаления), он не
+    перезаписывается.
+    """
+    path = archive_path(table, month, directory)
+    if os.path.exists(path):
+        return 0
+    columns = ARCHIVE['tables'][table]
+    source = source or sql.Identifier(table)
+    writer = ArchiveWriter(path, table, month, columns)
+    try:
+        with db.db_cursor(transaction=True, name=f"archive_{uuid.uuid4().hex}") as cursor:
+            cursor.itersize = ARCHIVE['chunk_size']
+            cursor.execute(sql.SQL(
+                "SELECT vk_id, {columns} FROM {source} "
+                "WHERE created_at >= %s AND created_at < %s "
+                "ORDER BY vk_id, created_at DESC, id DESC"
+            ).format(columns=sql.SQL(", ").join(map(sql.Identifier, columns)), source=source),
+                [month, month_start(month, 1)])
+            current, user_rows = NO_USER, []
+            while True:
+                chunk = cursor.fetchmany(ARCHIVE['chunk_size'])
+                if not chunk:
+                    break
+                for row in chunk:
+                    if row[0] != current:
+                        if user_rows:
+                            writer.add_user(current, user_rows)
+                        current, user_rows = row[0], []
+                    user_rows.append(row[1:])
+            if user_rows:
+                writer.add_user(current, user_rows)
+    except Exception:
+        writer.abort()
+        raise
+    writer.close()
+    _forget_table(table, directory)
+    logger.info("Архив %s: строк %s, пользователей %s", path, writer.rows, len(writer.users))
+    return writer.rows
+
+
+def delete_month(table, month):
+    """Удаляет выгруженный месяц из живой таблицы пачками; возвращает число строк.
+
+    Удаленные строки operations тем же запросом переходят в счетчики
+    archived:operations:<тип>.
+    """
+    total = 0
+    batch = ARCHIVE['delete_batch']
+    delete = sql.SQL(
+        "DELETE FROM {table} WHERE id IN ("
+        "SELECT id FROM {table} WHERE created_at >= %s AND created_at < %s LIMIT %s)"
+    ).format(table=sql.Identifier(table))
+    while True:
+        with db.db_cursor() as cursor:
+            if table == "operations":
+                cursor.execute(db.with_counters(delete + sql.SQL(" RETURNING operation_type"),
+                                                db.OPERATIONS_ARCHIVED_DELTAS),
+                               [month, month_start(month, 1), batch])
+                deleted = cursor.fetchone()[0]
+            else:
+                cursor.execute(delete, [month, month_start(month, 1), batch])
+                deleted = max(cursor.rowcount, 0)
+        total += deleted
+        if deleted < batch:
+            return total
+
+
+def detached_partitions(table):
+    """Секции table, отключенные partitions.py в схему archive."""
+    schema_name = partitions.PARTITIONING['archive_schema']
+    with db.db_cursor() as cursor:
+        cursor.execute(
+            "SELECT tablename FROM pg_tables WHERE schemaname = %s AND tablename LIKE %s ORDER BY tablename",
+            [schema_name, f"{table}\\_%"]
+        )
+        return [sql.Identifier(schema_name, row[0]) for row in cursor.fetchall()]
+
+
+def run(now=None, directory=None):
+    """Выгружает в архив отключенные секции и старые месяцы живых таблиц.
+
+    Из секционированной таблицы старые месяцы уходят через partitions.py
+    (отключение секции), здесь строки удаляются только из обычных таблиц.
+    Источник, строки которого не сошлись с архивом, не удаляется и
+    перечисляется в kept.
+    """
+    started = time.perf_counter()
+    cutoff = month_start(now or datetime.datetime.now(datetime.timezone.utc), -ARCHIVE['min_age_months'])
+    result = {}
+    for table in ARCHIVE['tables']:
+        exported, deleted, kept = 0, 0, []
+        for partition in detached_partitions(table):
+            months = _months_of(partition)
+            for month in months:
+                exported += export_month(table, month, source=partition, directory=directory)
+            in_archive = sum(archived_rows(table, month, directory) for month in months)
+            in_partition = _count_rows(partition)
+            if in_archive != in_partition:
+                name = ".".join(partition.strings)
+                logger.error("Секция %s не удалена: строк в ней %s, в архиве %s", name, in_partition, in_archive)
+                kept.append(name)
+                continue
+            with db.db_cursor() as cursor:
+                cursor.execute(sql.SQL("DROP TABLE {}").format(partition))
+        with db.db_cursor() as cursor:
+            partitioned = partitions.is_partitioned(cursor, table)
+        for month in [] if partitioned else _months_of(sql.Identifier(table), until=cutoff):
+            exported += export_month(table, month, directory=directory)
+            in_archive = archived_rows(table, month, directory)
+            in_table = _count_rows(sql.Identifier(table), month)
+            if in_archive != in_table:
+                logger.error("Месяц %s таблицы %s не удален: строк в нем %s, в архиве %s",
+                             f"{month:%Y-%m}", table, in_table, in_archive)
+                kept.append(f"{table}:{month:%Y-%m}")
+                continue
+            deleted += delete_month(table, month)
+        result[table] = {"exported": exported, "deleted": deleted, "kept": kept}
+    result["elapsed_s"] = round(time.perf_counter() - started, 3)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Выгрузка старой истории в архивные файлы")
+    parser.add_argument("--directory", default=None, help="каталог архива")
+    parser.add_argument("--min-age-months", type=int, default=ARCHIVE['min_age_months'])
+    parser.add_argument("--dbname", default=None)
+    parser.add_argument("--host", default=None)
+    parser.add_argument("--user", default=None)
+    parser.add_argument("--password", default=None)
+    args = parser.parse_args()
+
+    for key in ("dbname", "host", "user", "password"):
+        if getattr(args, key) is not None:
+            db.DB_CONNECTION[key] = getattr(args, key)
+    ARCHIVE['min_age_months'] = args.min_age_months
+
+    logging.basicConfig(level=logging.INFO)
+    result = run(directory=args.directory)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    db.close_pool()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+import argparse
+import datetime
+import json
+import logging
+import random
+import subprocess
+import sys
+import threading
+import time
+
+import bench_transfer
+import db
+import logsetup
+import main as bot
+import ratelimit
+import schema
+from bench_transfer import percentile
+
+# Набор бенчмарков: заполняет отдельную базу данными заданного масштаба и
+# меряет задержки (p50/p95/p99/max) и пропускную способность команд
+# main.handle_command и горячих функций db при разном числе параллельных
+# потоков. Результаты пишутся в JSON; --compare сравнивает прогон с
+# предыдущим и завершается с кодом 1 при регрессии.
+#
+# Данные генерируются на сервере (generate_series) детерминированно от
+# номера строки, поэтому два заполнения одного масштаба совпадают.
+
+BENCH_USER_PREFIX = "bench_"
+SEED_BATCH = 1000000            # строк в одном INSERT ... SELECT
+
+SEED_SQL = {
+    "users": """
+        INSERT INTO users (vk_id, username, balance, created_at)
+        SELECT %(prefix)s || g, 'User_' || %(prefix)s || g,
+               abs(hashtext('b' || g)) %% 100000,
+               now() - (g %% 31536000) * interval '1 second'
+        FROM generate_series(%(start)s, %(stop)s - 1) AS g
+        ON CONFLICT (vk_id) DO NOTHING
+    """,
+    "operations": """
+        INSERT INTO operations (vk_id, operation_type, amount, details, created_at)
+        SELECT %(prefix)s || (abs(hashtext('o' || g)) %% %(users)s),
+               (ARRAY['deposit', 'withdraw', 'перевод'])[1 + abs(hashtext('t' || g)) %% 3],
+               1 + abs(hashtext('a' || g)) %% 1000, 'bench',
+               now() - interval '365 days' + (g::float8 / %(total)s) * interval '365 days'
+        FROM generate_series(%(start)s, %(stop)s - 1) AS g
+    """,
+    "user_activity": """
+        INSERT INTO user_activity (vk_id, action_type, details, created_at)
+        SELECT %(prefix)s || (abs(hashtext('v' || g)) %% %(users)s),
+               (ARRAY['Пополнение', 'Снятие'])[1 + abs(hashtext('k' || g)) %% 2], 'bench',
+               now() - interval '365 days' + (g::float8 / %(total)s) * interval '365 days'
+        FROM generate_series(%(start)s, %(stop)s - 1) AS g
+    """,
+    "transactions": """
+        INSERT INTO transactions (vk_id, transaction_type, amount, created_at)
+        SELECT %(prefix)s || (abs(hashtext('x' || g)) %% %(users)s),
+               (ARRAY['deposit', 'withdraw'])[1 + abs(hashtext('y' || g)) %% 2],
+               1 + abs(hashtext('z' || g)) %% 1000,
+               now() - interval '365 days' + (g::float8 / %(total)s) * interval '365 days'
+        FROM generate_series(%(start)s, %(stop)s - 1) AS g
+    """,
+}
+
+
+def seed(users=100000, operations=1000000, activity=None, transactions=None, force=False):
+    """Очищает таблицы и заполняет их заново; возвращает масштаб.
+
+    Таблицы очищаются TRUNCATE, поэтому без force работает только в базе,
+    в имени которой есть "bench".
+    """
+    if "bench" not in str(db.DB_CONNECTION.get('dbname', '')) and not force:
+        raise RuntimeError("Заполнение очищает таблицы: используйте базу с 'bench' в имени или force=True")
+    scale = {
+        "users": users,
+        "operations": operations,
+        "user_activity": activity if activity is not None else operations // 10,
+        "transactions": transactions if transactions is not None else operations // 10,
+    }
+    schema.migrate()
+    with db.db_cursor() as cursor:
+        cursor.execute("TRUNCATE users, operations, user_activity, transactions, system_counters")
+        for table, total in scale.items():
+            for start in range(0, total, SEED_BATCH):
+                cursor.execute(SEED_SQL[table], {
+                    "prefix": BENCH_USER_PREFIX, "users": users, "total": total,
+                    "start": start, "stop": min(total, start + SEED_BATCH),
+                })
+            cursor.execute(f"ANALYZE {table}")
+    db.refresh_system_counters()
+    return scale
+
+
+def seeded_users():
+    """Число пользователей bench_* в базе."""
+    with db.db_cursor() as cursor:
+        cursor.execute("SELECT count(*) FROM users WHERE vk_id LIKE %s", [BENCH_USER_PREFIX + "%"])
+        return cursor.fetchone()[0]
+
+
+def _consume(reply):
+    """Дочитывает ответ-генератор (/users), чтобы замер включал всю выгрузку."""
+    if isinstance(reply, str):
+        return reply
+    return sum(1 for _ in reply)
+
+
+def scenarios(users):
+    """Сценарии {имя: (функция(rnd), ограничение числа операций или None)}."""
+    def user(rnd):
+        return f"{BENCH_USER_PREFIX}{rnd.randrange(users)}"
+
+    def two_users(rnd):
+        first, second = rnd.sample(range(users), 2)
+        return f"{BENCH_USER_PREFIX}{first}", f"{BENCH_USER_PREFIX}{second}"
+
+    return {
+        "cmd /balance": (lambda rnd: bot.handle_command("/balance", user(rnd)), None),
+        "cmd /deposit": (lambda rnd: bot.handle_command("/deposit", user(rnd), "10"), None),
+        "cmd /withdraw": (lambda rnd: bot.handle_command("/withdraw", user(rnd), "1"), None),
+        "cmd /history": (lambda rnd: bot.handle_command("/history", user(rnd)), None),
+        "cmd /activity": (lambda rnd: bot.handle_command("/activity", user(rnd)), None),
+        "cmd /start": (lambda rnd: bot.handle_command("/start", f"{BENCH_USER_PREFIX}new_{rnd.getrandbits(64)}"), None),
+        "cmd /validate": (lambda rnd: bot.handle_command("/validate", user(rnd)), None),
+        "cmd /users": (lambda rnd: _consume(bot.handle_command("/users")), 5),
+        "db get_user_balance": (lambda rnd: db.get_user_balance(user(rnd)), None),
+        "db transfer_balance": (lambda rnd: db.transfer_balance(*two_users(rnd), 1), None),
+        "db get_user_operations": (lambda rnd: db.get_user_operations(user(rnd)), None),
+        "db get_all_users": (lambda rnd: db.get_all_users(), 5),
+        "db get_system_info": (lambda rnd: db.get_system_info(), None),
+    }
+
+
+def measure(func, concurrency, duration=10.0, max_ops=None, seed=0):
+    """Гоняет func в concurrency потоках duration секунд (или max_ops раз); возвращает метрики."""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+    remaining = [max_ops]
+
+    def take():
+        with lock:
+            if remaining[0] is None:
+                return time.perf_counter() < deadline
+            if remaining[0] <= 0:
+                return False
+            remaining[0] -= 1
+            return True
+
+    def worker(index):
+        rnd = random.Random(seed * 1000 + index)
+        local, local_errors = [], 0
+        while take():
+            started = time.perf_counter()
+            try:
+                func(rnd)
+            except Exception:
+                local_errors += 1
+            local.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(local)
+            errors[0] += local_errors
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "ops": len(latencies),
+        "errors": errors[0],
+        "elapsed_s": round(elapsed, 3),
+        "throughput_ops": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 3),
+            "p95": round(percentile(latencies, 95) * 1000, 3),
+            "p99": round(percentile(latencies, 99) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+        },
+    }
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return None
+
+
+def run(levels=(1, 8, 32), duration=10.0, only=None, hot_transfers=True):
+    """Прогоняет все сценарии на всех уровнях параллельности; возвращает результаты."""
+    users = seeded_users()
+    if not users:
+        raise RuntimeError("В базе нет пользователей bench_*: сначала выполните заполнение (--seed)")
+    db.DB_POOL['maxconn'] = max(db.DB_POOL['maxconn'], max(levels))
+
+    results = []
+    for name, (func, max_ops) in scenarios(users).items():
+        if only and not any(part in name for part in only):
+            continue
+        for concurrency in levels:
+            metrics = measure(func, concurrency, duration, max_ops)
+            results.append({"scenario": name, "concurrency": concurrency, **metrics})
+            print(f"{name:28} x{concurrency:<3} {metrics['throughput_ops']:>10} ops/s  "
+                  f"p50 {metrics['latency_ms']['p50']} ms  p99 {metrics['latency_ms']['p99']} ms",
+                  file=sys.stderr)
+
+    report = {
+        "meta": {
+            "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "revision": _git_revision(),
+            "users": users,
+            "levels": list(levels),
+            "duration_s": duration,
+        },
+        "results": results,
+    }
+    if hot_transfers:
+        report["hot_transfers"] = bench_transfer.run(threads=max(levels))
+    return report
+
+
+def compare(baseline, current, threshold=0.2):
+    """Список регрессий: p99 вырос или пропускная способность упала больше чем на threshold."""
+    base = {(r["scenario"], r["concurrency"]): r for r in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        old = base.get((result["scenario"], result["concurrency"]))
+        if old is None:
+            continue
+        key = f"{result['scenario']} x{result['concurrency']}"
+        old_p99, new_p99 = old["latency_ms"]["p99"], result["latency_ms"]["p99"]
+        if old_p99 and new_p99 > old_p99 * (1 + threshold):
+            regressions.append(f"{key}: p99 {old_p99} -> {new_p99} ms")
+        if old["throughput_ops"] and result["throughput_ops"] < old["throughput_ops"] * (1 - threshold):
+            regressions.append(f"{key}: {old['throughput_ops']} -> {result['throughput_ops']} ops/s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки команд бота и функций db")
+    parser.add_argument("--seed", action="store_true", help="очистить и заполнить базу перед замерами")
+    parser.add_argument("--force", action="store_true", help="разрешить заполнение базы без 'bench' в имени")
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--operations", type=int, default=1000000)
+    parser.add_argument("--levels", default="1,8,32", help="уровни параллельности через запятую")
+    parser.add_argument("--duration", type=float, default=10.0, help="секунд на один замер")
+    parser.add_argument("--only", default=None, help="только сценарии, содержащие эти подстроки (через запятую)")
+    parser.add_argument("--no-hot-transfers", action="store_true", help="не запускать bench_transfer")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", default=None, help="JSON предыдущего прогона для сравнения")
+    parser.add_argument("--threshold", type=float, default=0.2, help="допустимое ухудшение (доля)")
+    parser.add_argument("--dbname", default=None)
+    parser.add_argument("--host", default=None)
+    parser.add_argument("--user", default=None)
+    parser.add_argument("--password", default=None)
+    args = parser.parse_args()
+
+    for key in ("dbname", "host", "user", "password"):
+        if getattr(args, key) is not None:
+            db.DB_CONNECTION[key] = getattr(args, key)
+
+    # Журнал каждой команды на уровне INFO исказил бы замеры
+    for name in ("", *logsetup.LOGGING['levels']):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    # Бенчмарк меряет сами команды, а не отказы ограничителя частоты
+    ratelimit.set_rate_limiter(ratelimit.RateLimiter({"enabled": False}))
+    try:
+        scale = None
+        if args.seed:
+            scale = seed(args.users, args.operations, force=args.force)
+        report = run(
+            levels=tuple(int(level) for level in args.levels.split(",")),
+            duration=args.duration,
+            only=args.only.split(",") if args.only else None,
+            hot_transfers=not args.no_hot_transfers,
+        )
+        report["meta"]["seeded"] = scale
+    finally:
+        db.close_pool()
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты записаны в {args.output}", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(json.load(f), report, args.threshold)
+        for line in regressions:
+            print(f"РЕГРЕССИЯ {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
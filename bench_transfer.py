@@ -0,0 +1,124 @@
+import argparse
+import json
+import random
+import threading
+import time
+
+import db
+from db import transfer_funds, InsufficientFundsError
+
+# Нагрузочный тест переводов: много потоков гоняют деньги между несколькими
+# "горячими" счетами в обе стороны. Требует локальный PostgreSQL с таблицами
+# users и operations.
+
+BENCH_PREFIX = "bench_transfer_"
+
+
+def seed_accounts(count, balance):
+    """Создает (или сбрасывает) тестовые счета и возвращает их vk_id."""
+    vk_ids = [f"{BENCH_PREFIX}{i}" for i in range(count)]
+    with db.db_cursor(transaction=True) as cursor:
+        for vk_id in vk_ids:
+            cursor.execute(
+                "INSERT INTO users (vk_id, username, balance, created_at) VALUES (%s, %s, %s, now()) "
+                "ON CONFLICT (vk_id) DO UPDATE SET balance = EXCLUDED.balance",
+                [vk_id, vk_id, balance]
+            )
+    return vk_ids
+
+
+def total_balance(vk_ids):
+    """Сумма балансов тестовых счетов (должна сохраняться после переводов)."""
+    with db.db_cursor() as cursor:
+        cursor.execute("SELECT sum(balance) FROM users WHERE vk_id = ANY(%s)", [vk_ids])
+        return cursor.fetchone()[0]
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run(accounts=4, threads=16, transfers=5000, amount=1, seed_balance=1000000):
+    """Запускает нагрузку и возвращает словарь с результатами."""
+    db.DB_POOL['maxconn'] = max(db.DB_POOL['maxconn'], threads)
+    vk_ids = seed_accounts(accounts, seed_balance)
+    before = total_balance(vk_ids)
+
+    per_thread = transfers // threads
+    latencies = []
+    counters = {"ok": 0, "insufficient": 0, "errors": 0}
+    lock = threading.Lock()
+
+    def worker(seed):
+        rnd = random.Random(seed)
+        local_latencies = []
+        local = {"ok": 0, "insufficient": 0, "errors": 0}
+        for _ in range(per_thread):
+            from_vk_id, to_vk_id = rnd.sample(vk_ids, 2)
+            started = time.perf_counter()
+            try:
+                transfer_funds(from_vk_id, to_vk_id, amount)
+                local["ok"] += 1
+            except InsufficientFundsError:
+                local["insufficient"] += 1
+            except Exception:
+                local["errors"] += 1
+            local_latencies.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(local_latencies)
+            for key, value in local.items():
+                counters[key] += value
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    started = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    after = total_balance(vk_ids)
+    return {
+        "accounts": accounts,
+        "threads": threads,
+        "transfers": per_thread * threads,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_tps": round(counters["ok"] / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 3),
+            "p95": round(percentile(latencies, 95) * 1000, 3),
+            "p99": round(percentile(latencies, 99) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+        },
+        **counters,
+        "balance_conserved": before == after,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест db.transfer_funds")
+    parser.add_argument("--accounts", type=int, default=4, help="число горячих счетов")
+    parser.add_argument("--threads", type=int, default=16, help="число параллельных потоков")
+    parser.add_argument("--transfers", type=int, default=5000, help="всего переводов")
+    parser.add_argument("--amount", type=int, default=1, help="сумма одного перевода")
+    parser.add_argument("--dbname", default=None)
+    parser.add_argument("--host", default=None)
+    parser.add_argument("--user", default=None)
+    parser.add_argument("--password", default=None)
+    args = parser.parse_args()
+
+    for key in ("dbname", "host", "user", "password"):
+        if getattr(args, key) is not None:
+            db.DB_CONNECTION[key] = getattr(args, key)
+
+    result = run(args.accounts, args.threads, args.transfers, args.amount)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    db.close_pool()
+
+
+if __name__ == "__main__":
+    main()
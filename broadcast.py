@@ -0,0 +1,241 @@
+import argparse
+import json
+import logging
+import time
+import uuid
+from collections import deque
+
+from psycopg2.extras import execute_values
+
+import db
+from dispatcher import Dispatcher
+
+logger = logging.getLogger(__name__)
+
+# Массовая рассылка. Получатели читаются из users порциями по ключу vk_id
+# (каждая порция — короткий запрос по первичному ключу), сообщения уходят
+# через отдельный диспетчер, чтобы рассылка не тормозила ответы на команды.
+# После каждой порции прогресс (последний vk_id и счетчики) сохраняется в
+# broadcasts, поэтому прерванная рассылка продолжается с места остановки.
+# Скорость ограничена BROADCAST['rate'] — он должен укладываться в лимит
+# Bot API для токена бота (около 30 сообщений в секунду) вместе с обычными
+# ответами, поэтому по умолчанию рассылке оставлено 25. С такой скоростью
+# 1 млн получателей — около 11 часов (1 000 000 / 25 = 40 000 с); быстрее
+# можно только с лимитом, повышенным для бота в Telegram.
+
+BROADCAST = {
+    'chunk_size': 1000,         # получателей в одной порции (и между сохранениями прогресса)
+    'workers': 8,               # потоков отправки диспетчера рассылки (на 25 сообщений/с хватает)
+    'rate': 25,                 # сообщений в секунду
+    'max_retries': 3,
+}
+
+
+def create_broadcast(message, min_balance=None):
+    """Создает рассылку и возвращает ее id."""
+    broadcast_id = uuid.uuid4().hex
+    with db.db_cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO broadcasts (id, message, min_balance) VALUES (%s, %s, %s)",
+            [broadcast_id, message, min_balance]
+        )
+    return broadcast_id
+
+
+def load_broadcast(broadcast_id):
+    """Возвращает строку broadcasts (dict) или None."""
+    with db.db_cursor(cursor_factory=db.RealDictCursor) as cursor:
+        cursor.execute("SELECT * FROM broadcasts WHERE id = %s", [broadcast_id])
+        row = cursor.fetchone()
+    return dict(row) if row else None
+
+
+def iter_recipients(after_vk_id=None, min_balance=None, chunk_size=None):
+    """Генератор: отдает списки vk_id по возрастанию, начиная после after_vk_id."""
+    chunk_size = chunk_size or BROADCAST['chunk_size']
+    while True:
+        conditions, params = [], []
+        if after_vk_id is not None:
+            conditions.append("vk_id > %s")
+            params.append(after_vk_id)
+        if min_balance is not None:
+            conditions.append("balance >= %s")
+            params.append(min_balance)
+        where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+        with db.db_cursor() as cursor:
+            cursor.execute(f"SELECT vk_id FROM users {where}ORDER BY vk_id LIMIT %s", params + [chunk_size])
+            chunk = [row[0] for row in cursor.fetchall()]
+        if not chunk:
+            return
+        yield chunk
+        if len(chunk) < chunk_size:
+            return
+        after_vk_id = chunk[-1]
+
+
+def _save_progress(broadcast_id, last_vk_id, sent, failed, failures, delivered_ahead=(), status="running"):
+    """Сохраняет прогресс порции; last_vk_id=None оставляет прежний."""
+    with db.db_cursor(transaction=True) as cursor:
+        cursor.execute(
+            "UPDATE broadcasts SET last_vk_id = coalesce(%s, last_vk_id), sent = sent + %s, failed = failed + %s, "
+            "status = %s, updated_at = now() WHERE id = %s",
+            [last_vk_id, sent, failed, status, broadcast_id]
+        )
+        if failures:
+            execute_values(
+                cursor,
+                "INSERT INTO broadcast_failures (broadcast_id, vk_id) VALUES %s ON CONFLICT DO NOTHING",
+                [(broadcast_id, vk_id) for vk_id in failures]
+            )
+        if delivered_ahead:
+            execute_values(
+                cursor,
+                "INSERT INTO broadcast_deliveries (broadcast_id, vk_id) VALUES %s ON CONFLICT DO NOTHING",
+                [(broadcast_id, vk_id) for vk_id in delivered_ahead]
+            )
+
+
+def _delivered_ahead(broadcast_id):
+    """Получатели за last_vk_id, которым сообщение уже доставлено."""
+    with db.db_cursor() as cursor:
+        cursor.execute("SELECT vk_id FROM broadcast_deliveries WHERE broadcast_id = %s", [broadcast_id])
+        return {row[0] for row in cursor.fetchall()}
+
+
+def _set_status(broadcast_id, status):
+    with db.db_cursor() as cursor:
+        cursor.execute("UPDATE broadcasts SET status = %s, updated_at = now() WHERE id = %s", [status, broadcast_id])
+
+
+def _collect(broadcast_id, chunk, stalled=False):
+    """Дожидается отправки порции и сохраняет прогресс; возвращает (sent, failures, stalled).
+
+    last_vk_id сдвигается по порядку vk_id до первого отмененного
+    сообщения — после него порция stalled, и дальше (в том числе в
+    следующих порциях) сохраняются только доставленные сообщения: они
+    записываются в broadcast_deliveries, и продолженная рассылка их не
+    повторяет. Недоставленные за отмененным получат сообщение при
+    продолжении.
+    """
+    sent, failures, delivered_ahead, last_vk_id = 0, [], [], None
+    for vk_id, future in chunk:
+        if future.cancelled():
+            stalled = True
+            continue
+        try:
+            delivered = future.result()
+        except Exception as e:
+            logger.error("Ошибка рассылки %s для %s: %s", broadcast_id, vk_id, e)
+            delivered = False
+        if stalled:
+            if delivered:
+                sent += 1
+                delivered_ahead.append(vk_id)
+            continue
+        if delivered:
+            sent += 1
+        else:
+            failures.append(vk_id)
+        last_vk_id = vk_id
+    if last_vk_id is not None or delivered_ahead:
+        _save_progress(broadcast_id, last_vk_id, sent, len(failures), failures, delivered_ahead)
+    return sent, failures, stalled
+
+
+def run_broadcast(broadcast_id, dispatcher=None, chunk_size=None):
+    """Выполняет (или продолжает) рассылку; возвращает отчет о скорости и ошибках.
+
+    Пока отправляется одна порция, уже читается и ставится в очередь
+    следующая. Прогресс сохраняется после каждой порции. При исключении
+    (в том числе Ctrl+C) неотправленные сообщения отменяются, а прогресс
+    сохраняется до первого отмененного вместе с уже доставленными после
+    него; при аварийной остановке процесса повторно могут уйти сообщения
+    двух последних порций.
+    """
+    broadcast = load_broadcast(broadcast_id)
+    if broadcast is None:
+        raise ValueError(f"Рассылка {broadcast_id} не найдена")
+    if broadcast['status'] == "done":
+        return {"broadcast_id": broadcast_id, "status": "done", "sent": broadcast['sent'], "failed": broadcast['failed']}
+
+    own_dispatcher = dispatcher is None
+    if own_dispatcher:
+        dispatcher = Dispatcher(
+            db.telegram_api_url("sendMessage"),
+            workers=BROADCAST['workers'], global_rate=BROADCAST['rate'], global_burst=BROADCAST['rate'],
+            max_retries=BROADCAST['max_retries'], max_queue=2 * (chunk_size or BROADCAST['chunk_size']),
+        )
+
+    started = time.perf_counter()
+    totals = {"sent": 0, "failed": 0}
+    sample_failures = []
+    pending = deque()
+    stalled = False
+    skip = _delivered_ahead(broadcast_id)
+
+    def collect_oldest():
+        nonlocal stalled
+        chunk_sent, failures, stalled = _collect(broadcast_id, pending[0], stalled)
+        pending.popleft()
+        totals["sent"] += chunk_sent
+        totals["failed"] += len(failures)
+        sample_failures.extend(failures[:100 - len(sample_failures)])
+
+    status = "running"
+    _set_status(broadcast_id, status)
+    try:
+        for recipients in iter_recipients(broadcast['last_vk_id'], broadcast['min_balance'], chunk_size):
+            pending.append([(vk_id, dispatcher.submit(vk_id, broadcast['message']))
+                            for vk_id in recipients if vk_id not in skip])
+            if len(pending) > 1:
+                collect_oldest()
+        while pending:
+            collect_oldest()
+        status = "done"
+    except BaseException:
+        status = "interrupted"
+        for chunk in pending:
+            for _, future in chunk:
+                future.cancel()
+        while pending:
+            collect_oldest()
+        raise
+    finally:
+        _set_status(broadcast_id, status)
+        if own_dispatcher:
+            dispatcher.close(wait=False)
+
+    elapsed = time.perf_counter() - started
+    return {
+        "broadcast_id": broadcast_id,
+        "status": status,
+        "resumed_after": broadcast['last_vk_id'],
+        "sent": totals["sent"],
+        "failed": totals["failed"],
+        "failed_sample": sample_failures,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_per_s": round((totals["sent"] + totals["failed"]) / elapsed, 1) if elapsed else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Массовая рассылка сообщений пользователям")
+    parser.add_argument("message", nargs="?", help="текст рассылки")
+    parser.add_argument("--min-balance", type=float, default=None, help="только пользователям с балансом не ниже")
+    parser.add_argument("--resume", default=None, help="продолжить рассылку с этим id")
+    parser.add_argument("--chunk-size", type=int, default=None)
+    args = parser.parse_args()
+    if not args.resume and not args.message:
+        parser.error("нужен текст рассылки или --resume")
+
+    logging.basicConfig(level=logging.INFO)
+    broadcast_id = args.resume or create_broadcast(args.message, args.min_balance)
+    try:
+        report = run_broadcast(broadcast_id, chunk_size=args.chunk_size)
+    finally:
+        db.close_pool()
+    print(json.dumps(report, ensure_ascii=False, indent=2, default=str))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class _Entry:
+    __slots__ = ("value", "expires_at", "version")
+
+    def __init__(self, value, expires_at, version):
+        self.value = value
+        self.expires_at = expires_at
+        self.version = version
+
+
+_TOMBSTONE = object()
+
+
+class TTLCache:
+    """Потокобезопасный LRU-кэш с ограничением размера и временем жизни записей.
+
+    Инвалидация оставляет "надгробие" с увеличенной версией ключа. Загрузчик
+    запоминает version(key) до чтения из базы и передает ее в set(): если
+    ключ успели инвалидировать, устаревшее значение в кэш не попадет.
+    """
+
+    def __init__(self, maxsize=10000, ttl=60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, default=None):
+        """Возвращает значение по ключу или default, если его нет или оно устарело."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry.value is _TOMBSTONE:
+                self.misses += 1
+                return default
+            if entry.expires_at < time.monotonic():
+                entry.value = _TOMBSTONE
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry.value
+
+    def version(self, key):
+        """Текущая версия ключа (для set с защитой от гонки с инвалидацией)."""
+        with self._lock:
+            entry = self._data.get(key)
+            return entry.version if entry is not None else 0
+
+    def set(self, key, value, version=None):
+        """Кладет значение; при переданной version — только если ключ не инвалидировали."""
+        with self._lock:
+            entry = self._data.get(key)
+            current = entry.version if entry is not None else 0
+            if version is not None and version != current:
+                return False
+            self._data[key] = _Entry(value, time.monotonic() + self.ttl, current)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+            return True
+
+    def invalidate(self, key):
+        """Удаляет значение и увеличивает версию ключа."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                entry = _Entry(_TOMBSTONE, 0.0, 0)
+                self._data[key] = entry
+            entry.value = _TOMBSTONE
+            entry.version += 1
+            self._data.move_to_end(key)
+            self.invalidations += 1
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """Счетчики попаданий, промахов, вытеснений и инвалидаций."""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
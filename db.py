@@ -1,10 +1,32 @@
-import requests
+import io
+import json
 import logging
+import sys
+import threading
+import time
 import uuid
-import config
+import archive
+import metrics
 import datetime
 import psycopg2
-from psycopg2 import sql
+import schema
+from collections import Counter
+from contextlib import contextmanager
+from decimal import Decimal
+from psycopg2 import extensions, sql
+from psycopg2.extras import RealDictCursor, execute_values
+from cache import TTLCache
+from dispatcher import Dispatcher
+from journal import Journal
+from pagination import encode_cursor, decode_cursor, next_page_hint
+from pool import ConnectionPool
+from querylog import QueryLog, logged_cursor_factory
+from replies import MESSAGE_MAX_LENGTH, render_users_messages, render_activity_page, render_transactions_page
+from storage import (BalanceError, UserNotFoundError, InsufficientFundsError, IdempotencyConflictError, BalanceResult,
+                     TransferResult, BulkAdjustResult, RejectedAdjustment, prepare_adjustments, balance_request,
+                     transfer_request, check_amount, UnitOfWorkAborted)
+
+logger = logging.getLogger(__name__)
 
 # Конфигурация для работы с PostgreSQL
 DB_CONNECTION = {
@@ -14,56 +36,919 @@ DB_CONNECTION = {
     'host': 'your_host',      # например, localhost
 }
 
+# Настройки пула соединений
+DB_POOL = {
+    'minconn': 2,               # соединений, открываемых заранее
+    'maxconn': 20,              # не больше этого числа соединений к PostgreSQL
+    'max_lifetime': 1800,       # секунд, после которых соединение пересоздается
+    'health_check_after': 30,   # проверять SELECT 1 соединения, простоявшие дольше (сек)
+    'timeout': 5,               # сколько ждать свободное соединение (сек)
+}
+
+# Буферизация записей аудита: строки operations, user_activity, system_events
+# и system_errors, записанные вне единицы работы, пишутся пакетами в фоне
+AUDIT_JOURNAL = {
+    'enabled': False,           # включить буферизацию
+    'max_rows': 500,            # сбрасывать, когда накопилось столько строк
+    'flush_interval': 1.0,      # ...или прошло столько секунд
+    'durable_tables': set(),    # таблицы, которые всегда пишутся синхронно
+}
+
+# Журнал SQL-запросов: время каждого запроса, выборочная статистика в
+# metrics и журнал медленных запросов
+QUERY_LOG = {
+    'enabled': True,
+    'sample_rate': 0.01,        # доля обычных запросов в статистике metrics (kind "sql")
+    'slow_threshold': 0.5,      # запросы дольше (сек) — в журнал медленных и в лог
+    'persist': False,           # писать медленные и упавшие запросы в system_events пакетами
+    'max_entries': 1000,        # последних медленных запросов в памяти
+}
+
+# Ключи идемпотентности денежных операций
+IDEMPOTENCY = {
+    'ttl': 24 * 3600,           # сколько секунд повтор с тем же ключом возвращает прежний результат
+    'purge_interval': 600,      # как часто удалять просроченные ключи (сек)
+    'purge_batch': 5000,        # ключей за один DELETE
+}
+
+# Постраничная выдача истории (operations, user_activity, transactions)
+HISTORY_PAGE_SIZE = 20          # записей на странице по умолчанию
+HISTORY_MAX_PAGE_SIZE = 200     # больше этого за один запрос не отдаем
+
+# Выгрузка списка пользователей (длина сообщения — replies.MESSAGE_MAX_LENGTH)
+USERS_CHUNK_SIZE = 1000         # строк в одной порции списка пользователей
+
+# Кэш строк users (по vk_id) и индекс username -> vk_id
+USER_CACHE = {
+    'maxsize': 50000,           # записей в кэше
+    'ttl': 60,                  # секунд жизни записи
+}
+
+# Адрес Bot API (в тестах подменяется на локальную заглушку)
+TELEGRAM_API_URL = "https://api.telegram.org"
+
+# Отправка сообщений: фоновые потоки с keep-alive соединениями
+MESSAGE_DISPATCHER = {
+    'workers': 8,               # потоков отправки (чат всегда обслуживает один и тот же)
+    'global_rate': 30,          # сообщений в секунду на всего бота
+    'global_burst': 30,
+    'per_chat_rate': 1,         # сообщений в секунду в один чат
+    'per_chat_burst': 3,
+    'max_retries': 5,           # повторов при 429, 5xx и сетевых ошибках
+    'timeout': 10,              # таймаут HTTP-запроса (сек)
+}
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Возвращает общий пул соединений, создавая его при первом обращении."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DB_CONNECTION, **DB_POOL)
+    return _pool
+
+def close_pool():
+    """Закрывает пул соединений (при остановке бота), предварительно сбросив журнал аудита."""
+    global _pool
+    stop_idempotency_purger()
+    close_audit_journal()
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
 def get_db_connection():
-    """Создает и возвращает соединение с базой данных."""
+    """Берет соединение из пула; вернуть его нужно через release_db_connection."""
     try:
-        conn = psycopg2.connect(**DB_CONNECTION)
-        return conn
+        return get_pool().getconn()
     except Exception as e:
-        logging.error(f"Ошибка подключения к базе данных: {e}")
+        logger.error("Ошибка подключения к базе данных: %s", e)
         return None
 
-def get_user_from_db(user_id):
-    """Получает пользователя по vk_id или username."""
+def release_db_connection(conn):
+    """Возвращает соединение, полученное через get_db_connection, в пул."""
+    get_pool().putconn(conn)
+
+class Session:
+    """Единица работы: одно соединение и одна транзакция на всю команду.
+
+    Соединение берется из пула при первом запросе, поэтому команды без
+    обращений к базе его не занимают.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.conn = None
+        self._after_commit = []
+        self.dirty_users = set()    # vk_id, измененные в этой транзакции
+        self.connection_wait = 0    # нс ожидания соединения; учитывается первым запросом
+
+    def connection(self):
+        if self.conn is None:
+            started = time.perf_counter_ns()
+            self.conn = self.pool.getconn()
+            self.connection_wait = time.perf_counter_ns() - started
+            self.conn.autocommit = False
+        return self.conn
+
+    def after_commit(self, callback):
+        """Откладывает вызов callback до успешного COMMIT."""
+        self._after_commit.append(callback)
+
+    def commit(self):
+        """Фиксирует транзакцию; если в ней была ошибка SQL — откатывает и бросает UnitOfWorkAborted."""
+        if self.conn is not None:
+            if self.conn.get_transaction_status() == extensions.TRANSACTION_STATUS_INERROR:
+                # Одна из функций перехватила ошибку SQL: транзакция уже отменена,
+                # и молча вернуть успех команде нельзя
+                self.conn.rollback()
+                self._after_commit = []
+                raise UnitOfWorkAborted("Единица работы откатана: в транзакции произошла ошибка SQL")
+            self.conn.commit()
+        callbacks, self._after_commit = self._after_commit, []
+        for callback in callbacks:
+            callback()
+
+    def close(self, discard=False):
+        if self.conn is not None:
+            conn, self.conn = self.conn, None
+            self.pool.putconn(conn, discard=discard)
+        self._after_commit = []
+        self.dirty_users = set()
+
+@contextmanager
+def unit_of_work():
+    """Открывает Session: все функции db, получившие ее, коммитятся вместе при выходе."""
+    session = Session(get_pool())
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return None
-
-        cursor = conn.cursor()
+        yield session
+        session.commit()
+    except psycopg2.OperationalError:
+        session.close(discard=True)
+        raise
+    finally:
+        # Незакоммиченная транзакция откатывается при возврате соединения в пул
+        session.close()
+
+@contextmanager
+def db_cursor(transaction=False, cursor_factory=None, session=None, name=None):
+    """Выдает курсор на соединении из пула и возвращает соединение обратно.
+
+    Соединения работают в autocommit, поэтому одиночный запрос фиксируется
+    сразу. При transaction=True все запросы блока выполняются в одной
+    транзакции: COMMIT при успешном выходе, ROLLBACK при исключении.
+    Если передана session, курсор открывается на ее соединении, а фиксирует
+    изменения сама сессия. С name открывается серверный (именованный)
+    курсор — ему нужна транзакция, поэтому вне сессии передавайте и
+    transaction=True.
+    """
+    query_log = get_query_log()
+    if query_log is not None:
+        cursor_factory = logged_cursor_factory(cursor_factory or extensions.cursor)
+
+    if session is not None:
+        cursor = session.connection().cursor(name=name, cursor_factory=cursor_factory)
+        if query_log is not None:
+            cursor.query_log = query_log
+            cursor.connection_wait, session.connection_wait = session.connection_wait, 0
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+        return
+
+    started = time.perf_counter_ns()
+    with get_pool().connection() as conn:
+        if transaction:
+            conn.autocommit = False
+        cursor = conn.cursor(name=name, cursor_factory=cursor_factory)
+        if query_log is not None:
+            cursor.query_log = query_log
+            cursor.connection_wait = time.perf_counter_ns() - started
+        try:
+            yield cursor
+        finally:
+            # Серверный курсор закрываем до COMMIT, пока он еще существует
+            cursor.close()
+        if transaction:
+            conn.commit()
+
+_query_log = None
+_query_log_lock = threading.Lock()
+
+def _persist_query_entry(entry):
+    event_type = "slow_query" if entry['error'] is None else "query_error"
+    message = f"{entry['duration']:.3f} с, строк: {entry['rows']}, ожидание соединения: " \
+              f"{entry['connection_wait']:.3f} с: {entry['query']}"
+    if entry['error'] is not None:
+        message = f"{entry['error']} — {message}"
+    get_audit_journal().append("system_events", (event_type, message, entry['created_at']))
+
+def get_query_log():
+    """Возвращает общий журнал запросов (None, если он выключен в QUERY_LOG)."""
+    global _query_log
+    if _query_log is None and QUERY_LOG['enabled']:
+        with _query_log_lock:
+            if _query_log is None:
+                _query_log = QueryLog(
+                    sample_rate=QUERY_LOG['sample_rate'],
+                    slow_threshold=QUERY_LOG['slow_threshold'],
+                    sink=_persist_query_entry if QUERY_LOG['persist'] else None,
+                    max_entries=QUERY_LOG['max_entries'],
+                )
+    return _query_log
+
+def slow_queries(limit=50):
+    """Последние медленные и упавшие запросы из журнала в памяти."""
+    query_log = get_query_log()
+    return query_log.entries(limit) if query_log is not None else []
+
+_user_cache = TTLCache(**USER_CACHE)
+_username_index = TTLCache(**USER_CACHE)
+
+def invalidate_user(vk_id, session=None):
+    """Сбрасывает пользователя в кэше; в сессии — еще раз после COMMIT."""
+    _user_cache.invalidate(vk_id)
+    if session is not None:
+        session.dirty_users.add(vk_id)
+        session.after_commit(lambda: _user_cache.invalidate(vk_id))
+
+def get_cached_user(vk_id, session=None):
+    """Возвращает строку users (dict) по vk_id из кэша или из базы; None, если нет.
+
+    Пользователь, измененный в транзакции session, читается из базы через
+    нее: в кэше его строка до изменения.
+    """
+    dirty = session is not None and vk_id in session.dirty_users
+    user = None if dirty else _user_cache.get(vk_id)
+    if user is not None:
+        return dict(user)
+    version = _user_cache.version(vk_id)
+    with db_cursor(cursor_factory=RealDictCursor, session=session) as cursor:
         cursor.execute(
-            sql.SQL("SELECT * FROM users WHERE vk_id = %s OR username = %s LIMIT 1"),
-            [user_id, user_id]
+            sql.SQL("SELECT * FROM users WHERE vk_id = %s"),
+            [vk_id]
         )
         user = cursor.fetchone()
-        cursor.close()
-        conn.close()
-        return user
-    except Exception as e:
-        logging.error(f"Ошибка при получении пользователя {user_id}: {e}")
+    if user is None:
         return None
-
-def get_user_by_username(username):
-    """Получает пользователя по username."""
-    try:
-        conn = get_db_connection()
-        if conn is None:
-            return None
-
-        cursor = conn.cursor()
+    user = dict(user)
+    # Незакоммиченные изменения своей сессии в общий кэш не попадают
+    if not dirty:
+        _user_cache.set(vk_id, user, version)
+        _username_index.set(user['username'], vk_id)
+    return dict(user)
+
+def get_cached_user_by_username(username, session=None):
+    """Возвращает строку users (dict) по username из кэша или из базы; None, если нет."""
+    vk_id = _username_index.get(username)
+    if vk_id is not None:
+        user = get_cached_user(vk_id, session=session)
+        if user is not None and user['username'] == username:
+            return user
+    with db_cursor(cursor_factory=RealDictCursor, session=session) as cursor:
         cursor.execute(
             sql.SQL("SELECT * FROM users WHERE username = %s LIMIT 1"),
             [username]
         )
         user = cursor.fetchone()
-        cursor.close()
-        conn.close()
+    if user is None:
+        return None
+    _username_index.set(username, user['vk_id'])
+    return dict(user)
+
+def user_cache_stats():
+    """Статистика кэша пользователей."""
+    return {"users": _user_cache.stats(), "usernames": _username_index.stats()}
+
+# Колонки таблиц аудита в порядке значений строки журнала
+AUDIT_COLUMNS = {
+    "operations": ("vk_id", "operation_type", "amount", "details", "created_at"),
+    "user_activity": ("vk_id", "action_type", "details", "created_at"),
+    "system_events": ("event_type", "message", "created_at"),
+    "system_errors": ("vk_id", "error_message", "created_at"),
+}
+
+_journal = None
+_journal_lock = threading.Lock()
+
+def _write_audit_batches(batches):
+    """Записывает накопленные строки аудита многострочными INSERT в одной транзакции.
+
+    В той же транзакции обновляются счетчики operations:<тип>. Медленные
+    запросы самого сброса в журнал не возвращаются.
+    """
+    query_log = get_query_log()
+    if query_log is not None:
+        with query_log.paused():
+            return _insert_audit_batches(batches)
+    return _insert_audit_batches(batches)
+
+def _insert_audit_batches(batches):
+    with db_cursor(transaction=True) as cursor:
+        for table, rows in batches.items():
+            query = sql.SQL("INSERT INTO {} ({}) VALUES %s").format(
+                sql.Identifier(table),
+                sql.SQL(", ").join(map(sql.Identifier, AUDIT_COLUMNS[table]))
+            )
+            execute_values(cursor, query, rows, page_size=len(rows))
+        operation_counts = Counter(f"operations:{row[1]}" for row in batches.get("operations", ()))
+        bump_system_counters(cursor, operation_counts)
+
+def get_audit_journal():
+    """Возвращает общий журнал аудита, создавая его при первом обращении."""
+    global _journal
+    if _journal is None:
+        with _journal_lock:
+            if _journal is None:
+                _journal = Journal(
+                    _write_audit_batches,
+                    max_rows=AUDIT_JOURNAL['max_rows'],
+                    flush_interval=AUDIT_JOURNAL['flush_interval'],
+                )
+    return _journal
+
+def close_audit_journal():
+    """Сбрасывает остаток журнала и останавливает его фоновый поток."""
+    global _journal
+    with _journal_lock:
+        journal, _journal = _journal, None
+    if journal is not None:
+        journal.close()
+
+def journal_audit_row(table, row, session=None, durable=False):
+    """Ставит строку аудита в журнал, если это допустимо; возвращает True, если поставлена.
+
+    Строки в единице работы и с durable=True пишутся синхронно, чтобы
+    фиксироваться вместе с изменением баланса.
+    """
+    if durable or session is not None or not AUDIT_JOURNAL['enabled']:
+        return False
+    if table in AUDIT_JOURNAL['durable_tables']:
+        return False
+    # Полный журнал строку не берет — тогда она пишется синхронно
+    return get_audit_journal().append(table, row)
+
+def _utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+def history_page_query(table, columns, where, params, page_size, cursor=None):
+    """Строит запрос страницы истории (на одну строку больше page_size) и его параметры."""
+    conditions = [sql.SQL(where)]
+    args = list(params)
+    if cursor:
+        after_created_at, after_id = decode_cursor(cursor)
+        # Отдельное created_at <= ... нужно для отсечения секций: по
+        # сравнению строк (created_at, id) планировщик секции не отбрасывает
+        conditions.append(sql.SQL("created_at <= %s AND (created_at, id) < (%s, %s)"))
+        args += [after_created_at, after_created_at, after_id]
+    args.append(page_size + 1)
+
+    query = sql.SQL("SELECT {columns}, created_at, id FROM {table} WHERE {where} "
+                    "ORDER BY created_at DESC, id DESC LIMIT %s").format(
+        columns=sql.SQL(", ").join(map(sql.Identifier, columns)),
+        table=sql.Identifier(table),
+        where=sql.SQL(" AND ").join(conditions),
+    )
+    return query, args
+
+def fetch_history_page(table, columns, where, params, page_size=None, cursor=None, session=None):
+    """Возвращает страницу истории от новых записей к старым и курсор следующей.
+
+    Страница выбирается по ключу (created_at, id) с LIMIT, поэтому каждый
+    вызов — ограниченный проход по индексу (vk_id, created_at, id). На
+    секционированной таблице следующие страницы не трогают секции новее
+    курсора, а первая читается упорядоченным Append с самой новой секции
+    и на LIMIT останавливается. В конец
+    каждой строки добавляются created_at и id. Курсор равен None, если
+    страница последняя; испорченный курсор дает ValueError.
+    """
+    page_size = max(1, min(int(page_size or HISTORY_PAGE_SIZE), HISTORY_MAX_PAGE_SIZE))
+    query, args = history_page_query(table, columns, where, params, page_size, cursor)
+    with db_cursor(session=session) as db_cur:
+        db_cur.execute(query, args)
+        rows = db_cur.fetchall()
+
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = encode_cursor(rows[-1][-2], rows[-1][-1])
+    return rows, next_cursor
+
+def fetch_user_history_page(table, columns, vk_id, page_size=None, cursor=None, session=None):
+    """Страница истории пользователя (как fetch_history_page) с продолжением в архиве.
+
+    Когда строки живой таблицы заканчиваются, страница дополняется
+    выгруженными месяцами из archive.py, и курсор ведет дальше по архиву.
+    """
+    page_size = max(1, min(int(page_size or HISTORY_PAGE_SIZE), HISTORY_MAX_PAGE_SIZE))
+    rows, next_cursor = fetch_history_page(table, columns, "vk_id = %s", [vk_id],
+                                           page_size=page_size, cursor=cursor, session=session)
+    if next_cursor is not None:
+        return rows, next_cursor
+
+    if rows:
+        before = (rows[-1][-2], rows[-1][-1])
+    else:
+        before = decode_cursor(cursor) if cursor else None
+    rows = list(rows) + archive.read_history(table, vk_id, columns, page_size + 1 - len(rows), before)
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = encode_cursor(rows[-1][-2], rows[-1][-1])
+    return rows, next_cursor
+
+# Поддерживаемые счетчики для get_system_info: users, total_balance и
+# operations:<тип>. Каждый счетчик разбит на SYSTEM_COUNTER_SHARDS строк
+# (шард — по номеру серверного процесса), чтобы параллельные транзакции не
+# ждали друг друга на одной строке; значение счетчика — сумма шардов.
+SYSTEM_COUNTER_SHARDS = 16
+
+# CTE "counted": прибавляет к счетчикам строки (name, value) из CTE
+# counter_deltas того же запроса, поэтому счетчики меняются в одной
+# транзакции с данными. Строки идут по имени — порядок блокировок один.
+BUMP_COUNTERS_CTE = sql.SQL("""counted AS (
+        INSERT INTO system_counters (name, shard, value)
+        SELECT name, mod(pg_backend_pid(), {shards}), sum(value)
+        FROM counter_deltas GROUP BY name ORDER BY name
+        ON CONFLICT (name, shard) DO UPDATE SET value = system_counters.value + EXCLUDED.value
+    )""").format(shards=sql.Literal(SYSTEM_COUNTER_SHARDS))
+
+def with_counters(statement, deltas):
+    """Дополняет изменяющий запрос обновлением счетчиков в том же запросе.
+
+    statement — INSERT/UPDATE/DELETE ... RETURNING, его строки доступны как
+    changed (строка или sql.Composable); deltas — SELECT строк (name, value)
+    по changed. Запрос
+    возвращает число затронутых строк.
+    """
+    if not isinstance(statement, sql.Composable):
+        statement = sql.SQL(statement)
+    return sql.SQL("WITH changed AS ({statement}), counter_deltas (name, value) AS ({deltas}), {counted} "
+                   "SELECT count(*) FROM changed").format(
+        statement=statement, deltas=sql.SQL(deltas), counted=BUMP_COUNTERS_CTE
+    )
+
+USERS_INSERTED_DELTAS = "SELECT 'users', 1 FROM changed"
+USERS_DELETED_DELTAS = ("SELECT 'users', -1 FROM changed "
+                        "UNION ALL SELECT 'total_balance', -balance FROM changed")
+BALANCE_SET_DELTAS = "SELECT 'total_balance', delta FROM changed"
+OPERATIONS_INSERTED_DELTAS = "SELECT 'operations:' || operation_type, 1 FROM changed"
+
+# Строки, ушедшие из operations в архив (archive.py) или по сроку хранения
+# (partitions.py), копятся в счетчиках archived:operations:<тип>. Счетчики
+# operations:<тип> их не теряют, а пересчет складывает живые строки с архивными.
+ARCHIVED_PREFIX = "archived:"
+OPERATIONS_ARCHIVED_DELTAS = "SELECT 'archived:operations:' || operation_type, 1 FROM changed"
+
+# Установка баланса: старое значение берется из заблокированной строки,
+# чтобы total_balance изменился ровно на разницу
+SET_USER_BALANCE_SQL = with_counters(
+    "UPDATE users u SET balance = %s "
+    "FROM (SELECT vk_id, balance FROM users WHERE vk_id = %s FOR UPDATE) old "
+    "WHERE u.vk_id = old.vk_id RETURNING u.balance - old.balance AS delta",
+    BALANCE_SET_DELTAS
+)
+
+DELETE_USER_SQL = with_counters(
+    "DELETE FROM users WHERE vk_id = %s RETURNING balance",
+    USERS_DELETED_DELTAS
+)
+
+BUMP_COUNTERS_SQL = sql.SQL("WITH counter_deltas (name, value) AS (VALUES %s), {counted} SELECT 1").format(
+    counted=BUMP_COUNTERS_CTE
+)
+
+def bump_system_counters(cursor, deltas):
+    """Прибавляет к счетчикам значения из словаря {имя: прибавка} на курсоре транзакции."""
+    if deltas:
+        execute_values(cursor, BUMP_COUNTERS_SQL, list(deltas.items()), page_size=len(deltas))
+
+def count_archived_operations(cursor, source):
+    """Прибавляет строки operations из source к счетчикам archived:operations:<тип>.
+
+    Вызывается на курсоре транзакции, которая удаляет source.
+    """
+    cursor.execute(sql.SQL(
+        "SELECT %s || operation_type, count(*) FROM {} GROUP BY operation_type"
+    ).format(source), [f"{ARCHIVED_PREFIX}operations:"])
+    bump_system_counters(cursor, dict(cursor.fetchall()))
+
+def _count_system_counters(cursor):
+    cursor.execute("SELECT count(*), coalesce(sum(balance), 0) FROM users")
+    total_users, total_balance = cursor.fetchone()
+    counters = {"users": total_users, "total_balance": total_balance}
+    cursor.execute("SELECT operation_type, count(*) FROM operations GROUP BY operation_type")
+    for operation_type, count in cursor.fetchall():
+        counters[f"operations:{operation_type}"] = count
+    # Архивных строк в таблицах уже нет: их число знают только счетчики archived:
+    cursor.execute("SELECT name, sum(value) FROM system_counters WHERE name LIKE %s GROUP BY name",
+                   [f"{ARCHIVED_PREFIX}%"])
+    for name, value in cursor.fetchall():
+        counters[name] = value
+        live = name[len(ARCHIVED_PREFIX):]
+        counters[live] = counters.get(live, 0) + value
+    return counters
+
+def compute_system_counters(session=None):
+    """Считает значения счетчиков по users и operations (с архивными строками из archived:)."""
+    with db_cursor(session=session) as cursor:
+        return _count_system_counters(cursor)
+
+def read_system_counters(session=None):
+    """Читает поддерживаемые счетчики: {имя: значение}."""
+    with db_cursor(session=session) as cursor:
+        cursor.execute("SELECT name, sum(value) FROM system_counters GROUP BY name")
+        return {name: value for name, value in cursor.fetchall() if value}
+
+def refresh_system_counters(session=None):
+    """Пересчитывает счетчики по таблицам и записывает их заново; возвращает новые значения.
+
+    Нужен один раз после создания system_counters и для исправления
+    расхождений. На время пересчета запись в users и operations блокируется.
+    Счетчики archived: не пересчитываются: строк, которые они считают, в
+    таблицах уже нет.
+    """
+    with db_cursor(transaction=True, session=session) as cursor:
+        cursor.execute(schema.SYSTEM_COUNTERS_DDL)
+        cursor.execute("LOCK TABLE users, operations IN SHARE MODE")
+        counters = _count_system_counters(cursor)
+        cursor.execute("DELETE FROM system_counters WHERE name NOT LIKE %s", [f"{ARCHIVED_PREFIX}%"])
+        execute_values(
+            cursor,
+            "INSERT INTO system_counters (name, shard, value) VALUES %s",
+            [(name, 0, value) for name, value in counters.items() if not name.startswith(ARCHIVED_PREFIX)]
+        )
+    return counters
+
+# Ключи идемпотентности: строка ключа захватывается в той же транзакции,
+# что и движение денег, и хранит его результат. Повтор с тем же ключом
+# находит результат по первичному ключу, не блокируя пользователей; если
+# первый вызов еще выполняется, INSERT ждет его завершения.
+# Просроченный, но еще не удаленный ключ захватывается заново
+CLAIM_IDEMPOTENCY_KEY_SQL = """
+    INSERT INTO idempotency_keys (key, request, expires_at)
+    VALUES (%s, %s, now() + make_interval(secs => %s))
+    ON CONFLICT (key) DO UPDATE
+    SET request = EXCLUDED.request, result = NULL, created_at = now(), expires_at = EXCLUDED.expires_at
+    WHERE idempotency_keys.expires_at <= now()
+    RETURNING key
+"""
+
+def find_idempotent_result(idempotency_key, request, session=None):
+    """Результат уже выполненного вызова с этим ключом (dict) или None.
+
+    Бросает IdempotencyConflictError, если ключ использован для другого запроса.
+    """
+    with db_cursor(session=session) as cursor:
+        cursor.execute(
+            "SELECT request, result FROM idempotency_keys "
+            "WHERE key = %s AND expires_at > now() AND result IS NOT NULL",
+            [idempotency_key]
+        )
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    if row[0] != request:
+        raise IdempotencyConflictError(idempotency_key)
+    return row[1]
+
+def _claim_idempotency_key(cursor, idempotency_key, request):
+    """Захватывает ключ в текущей транзакции: None — захвачен, иначе сохраненный результат."""
+    start_idempotency_purger()
+    cursor.execute(CLAIM_IDEMPOTENCY_KEY_SQL, [idempotency_key, request, IDEMPOTENCY['ttl']])
+    if cursor.fetchone() is not None:
+        return None
+    cursor.execute("SELECT request, result FROM idempotency_keys WHERE key = %s", [idempotency_key])
+    stored_request, result = cursor.fetchone()
+    if stored_request != request or result is None:
+        raise IdempotencyConflictError(idempotency_key)
+    return result
+
+def _complete_idempotency_key(cursor, idempotency_key, result):
+    cursor.execute(
+        "UPDATE idempotency_keys SET result = %s::jsonb WHERE key = %s",
+        [json.dumps(result, ensure_ascii=False), idempotency_key]
+    )
+
+@contextmanager
+def _releasing_key(cursor, idempotency_key):
+    """Снимает захват ключа, если операция отклонена.
+
+    В единице работы транзакция после отказа продолжается, и без этого
+    ключ зафиксировался бы без результата.
+    """
+    try:
+        yield
+    except (BalanceError, ValueError):
+        if idempotency_key is not None:
+            cursor.execute("DELETE FROM idempotency_keys WHERE key = %s AND result IS NULL", [idempotency_key])
+        raise
+
+def purge_idempotency_keys(batch_size=None):
+    """Удаляет просроченные ключи порциями по batch_size; возвращает число удаленных."""
+    batch_size = batch_size or IDEMPOTENCY['purge_batch']
+    total = 0
+    while True:
+        with db_cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM idempotency_keys WHERE key IN ("
+                "SELECT key FROM idempotency_keys WHERE expires_at <= now() ORDER BY expires_at LIMIT %s)",
+                [batch_size]
+            )
+            deleted = max(cursor.rowcount, 0)
+        total += deleted
+        if deleted < batch_size:
+            return total
+
+_purger = None
+_purger_lock = threading.Lock()
+_purger_stop = threading.Event()
+
+def _purge_loop():
+    while not _purger_stop.wait(IDEMPOTENCY['purge_interval']):
+        try:
+            deleted = purge_idempotency_keys()
+            if deleted:
+                logger.info("Удалено просроченных ключей идемпотентности: %s", deleted)
+        except Exception as e:
+            logger.error("Ошибка при удалении просроченных ключей идемпотентности: %s", e)
+
+def start_idempotency_purger():
+    """Запускает фоновое удаление просроченных ключей (при первом использовании ключа)."""
+    global _purger
+    if _purger is None:
+        with _purger_lock:
+            if _purger is None:
+                _purger_stop.clear()
+                _purger = threading.Thread(target=_purge_loop, name="idempotency-purge", daemon=True)
+                _purger.start()
+
+def stop_idempotency_purger():
+    global _purger
+    with _purger_lock:
+        purger, _purger = _purger, None
+    if purger is not None:
+        _purger_stop.set()
+        purger.join()
+
+# Одним запросом: изменяет баланс на delta (не допуская минуса), пишет
+# строку в operations и обновляет счетчики только если UPDATE затронул
+# пользователя.
+APPLY_BALANCE_DELTA_SQL = sql.SQL("""
+    WITH updated AS (
+        UPDATE users SET balance = balance + %(delta)s
+        WHERE vk_id = %(vk_id)s AND balance + %(delta)s >= 0
+        RETURNING vk_id, balance
+    ), logged AS (
+        INSERT INTO operations (vk_id, operation_type, amount, details, created_at)
+        SELECT vk_id, %(operation_type)s, %(delta)s, %(details)s, now() FROM updated
+    ), counter_deltas (name, value) AS (
+        SELECT 'total_balance', %(delta)s::numeric FROM updated
+        UNION ALL SELECT 'operations:' || %(operation_type)s, 1 FROM updated
+    ), {counted}
+    SELECT (SELECT balance FROM updated),
+           EXISTS (SELECT 1 FROM users WHERE vk_id = %(vk_id)s)
+""").format(counted=BUMP_COUNTERS_CTE)
+
+def _apply_balance_delta(cursor, vk_id, delta, operation_type, details):
+    cursor.execute(
+        APPLY_BALANCE_DELTA_SQL,
+        {"vk_id": vk_id, "delta": delta, "operation_type": operation_type, "details": details}
+    )
+    new_balance, user_exists = cursor.fetchone()
+    if new_balance is not None:
+        return new_balance
+    if not user_exists:
+        raise UserNotFoundError(vk_id)
+    raise InsufficientFundsError(vk_id)
+
+def apply_balance_delta(vk_id, delta, operation_type, details, session=None, idempotency_key=None):
+    """Атомарно изменяет баланс на delta и записывает операцию; возвращает BalanceResult.
+
+    Выполняется одним запросом. Бросает UserNotFoundError, если пользователя
+    нет, и InsufficientFundsError, если баланс стал бы отрицательным. С
+    idempotency_key повтор того же вызова возвращает баланс первого
+    выполнения с replayed=True, не меняя его снова.
+    """
+    if idempotency_key is None:
+        with db_cursor(session=session) as cursor:
+            new_balance = _apply_balance_delta(cursor, vk_id, delta, operation_type, details)
+        invalidate_user(vk_id, session=session)
+        return BalanceResult(new_balance, False)
+
+    request = balance_request(vk_id, delta, operation_type)
+    stored = find_idempotent_result(idempotency_key, request, session=session)
+    if stored is not None:
+        return BalanceResult(Decimal(stored['balance']), True)
+    with db_cursor(transaction=True, session=session) as cursor:
+        stored = _claim_idempotency_key(cursor, idempotency_key, request)
+        if stored is not None:
+            return BalanceResult(Decimal(stored['balance']), True)
+        with _releasing_key(cursor, idempotency_key):
+            new_balance = _apply_balance_delta(cursor, vk_id, delta, operation_type, details)
+        _complete_idempotency_key(cursor, idempotency_key, {"balance": str(new_balance)})
+    invalidate_user(vk_id, session=session)
+    return BalanceResult(new_balance, False)
+
+# Строки блокируются в порядке vk_id, поэтому встречные переводы A->B и B->A
+# ждут друг друга на одной и той же строке и не образуют взаимоблокировку.
+LOCK_TRANSFER_USERS_SQL = sql.SQL(
+    "SELECT vk_id, username, balance FROM users WHERE vk_id IN (%s, %s) ORDER BY vk_id FOR UPDATE"
+)
+
+APPLY_TRANSFER_SQL = sql.SQL("""
+    WITH moved AS (
+        UPDATE users
+        SET balance = balance + CASE WHEN vk_id = %(from_vk_id)s THEN -%(amount)s ELSE %(amount)s END
+        WHERE vk_id IN (%(from_vk_id)s, %(to_vk_id)s)
+        RETURNING vk_id, balance
+    ), logged AS (
+        INSERT INTO operations (vk_id, operation_type, amount, details, created_at)
+        VALUES (%(from_vk_id)s, %(sent_type)s, -%(amount)s, %(sent_details)s, now()),
+               (%(to_vk_id)s, %(received_type)s, %(amount)s, %(received_details)s, now())
+    ), counter_deltas (name, value) AS (
+        VALUES ('operations:' || %(sent_type)s, 1), ('operations:' || %(received_type)s, 1)
+    ), {counted}
+    SELECT vk_id, balance FROM moved
+""").format(counted=BUMP_COUNTERS_CTE)
+
+def transfer_funds(from_vk_id, to_vk_id, amount,
+                   sent_type="перевод", received_type="перевод",
+                   sent_details="Перевод на {to_vk_id}", received_details="Перевод от {from_vk_id}", session=None,
+                   idempotency_key=None):
+    """Переводит amount от одного пользователя другому в одной транзакции.
+
+    В шаблонах описаний доступны {from_vk_id}, {to_vk_id}, {from_name} и
+    {to_name}. Бросает UserNotFoundError, InsufficientFundsError или
+    ValueError для некорректной суммы и перевода самому себе. С
+    idempotency_key повтор возвращает результат первого перевода.
+    """
+    check_amount(amount)
+    if from_vk_id == to_vk_id:
+        raise ValueError("Нельзя перевести средства самому себе")
+
+    request = None
+    if idempotency_key is not None:
+        request = transfer_request(from_vk_id, to_vk_id, amount)
+        stored = find_idempotent_result(idempotency_key, request, session=session)
+        if stored is not None:
+            return _transfer_result(stored)
+
+    with db_cursor(transaction=True, session=session) as cursor:
+        if idempotency_key is not None:
+            stored = _claim_idempotency_key(cursor, idempotency_key, request)
+            if stored is not None:
+                return _transfer_result(stored)
+        with _releasing_key(cursor, idempotency_key):
+            result = _transfer_funds(cursor, from_vk_id, to_vk_id, amount,
+                                     sent_type, received_type, sent_details, received_details)
+        if idempotency_key is not None:
+            _complete_idempotency_key(cursor, idempotency_key, {
+                "from_balance": str(result.from_balance), "to_balance": str(result.to_balance),
+                "from_username": result.from_username, "to_username": result.to_username,
+            })
+    invalidate_user(from_vk_id, session=session)
+    invalidate_user(to_vk_id, session=session)
+    return result
+
+def _transfer_funds(cursor, from_vk_id, to_vk_id, amount, sent_type, received_type, sent_details, received_details):
+    cursor.execute(LOCK_TRANSFER_USERS_SQL, [from_vk_id, to_vk_id])
+    users = {row[0]: row for row in cursor.fetchall()}
+    if from_vk_id not in users:
+        raise UserNotFoundError(from_vk_id)
+    if to_vk_id not in users:
+        raise UserNotFoundError(to_vk_id)
+    if users[from_vk_id][2] < amount:
+        raise InsufficientFundsError(from_vk_id)
+
+    names = {
+        "from_vk_id": from_vk_id, "to_vk_id": to_vk_id,
+        "from_name": users[from_vk_id][1], "to_name": users[to_vk_id][1],
+    }
+    cursor.execute(APPLY_TRANSFER_SQL, {
+        "from_vk_id": from_vk_id, "to_vk_id": to_vk_id, "amount": amount,
+        "sent_type": sent_type, "sent_details": sent_details.format(**names),
+        "received_type": received_type, "received_details": received_details.format(**names),
+    })
+    balances = dict(cursor.fetchall())
+    return TransferResult(balances[from_vk_id], balances[to_vk_id], names["from_name"], names["to_name"])
+
+def _transfer_result(stored):
+    return TransferResult(Decimal(stored['from_balance']), Decimal(stored['to_balance']),
+                          stored['from_username'], stored['to_username'])
+
+# Массовое изменение балансов: записи грузятся COPY во временную таблицу,
+# пользователи блокируются в порядке vk_id (как в переводах), затем один
+# UPDATE ... FROM применяет суммы по пользователям с проверкой на минус и в
+# том же запросе пишет операции и счетчики.
+BULK_STAGING_DDL = """
+    CREATE TEMP TABLE IF NOT EXISTS bulk_adjustments (
+        seq bigint NOT NULL,
+        vk_id text NOT NULL,
+        delta numeric NOT NULL,
+        reason text
+    ) ON COMMIT DELETE ROWS
+"""
+
+LOCK_BULK_USERS_SQL = """
+    SELECT vk_id FROM users WHERE vk_id IN (SELECT vk_id FROM bulk_adjustments)
+    ORDER BY vk_id FOR UPDATE
+"""
+
+APPLY_BULK_ADJUSTMENTS_SQL = sql.SQL("""
+    WITH totals AS (
+        SELECT vk_id, sum(delta) AS delta FROM bulk_adjustments GROUP BY vk_id
+    ), updated AS (
+        UPDATE users u SET balance = u.balance + t.delta
+        FROM totals t
+        WHERE u.vk_id = t.vk_id AND u.balance + t.delta >= 0
+        RETURNING u.vk_id, t.delta
+    ), logged AS (
+        INSERT INTO operations (vk_id, operation_type, amount, details, created_at)
+        SELECT b.vk_id, %(operation_type)s, b.delta, b.reason, now()
+        FROM bulk_adjustments b JOIN updated USING (vk_id)
+        ORDER BY b.seq
+        RETURNING operation_type
+    ), counter_deltas (name, value) AS (
+        SELECT 'total_balance', delta FROM updated
+        UNION ALL SELECT 'operations:' || operation_type, 1 FROM logged
+    ), {counted}
+    SELECT NULL::bigint, vk_id, NULL FROM updated
+    UNION ALL
+    SELECT b.seq, b.vk_id, CASE WHEN u.vk_id IS NULL THEN 'user_not_found' ELSE 'insufficient_funds' END
+    FROM bulk_adjustments b LEFT JOIN users u USING (vk_id)
+    WHERE NOT EXISTS (SELECT 1 FROM updated WHERE updated.vk_id = b.vk_id)
+""").format(counted=BUMP_COUNTERS_CTE)
+
+def _copy_value(value):
+    """Значение в текстовом формате COPY."""
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+def bulk_adjust_balances(adjustments, operation_type="adjustment", session=None):
+    """Изменяет балансы многих пользователей одной транзакцией; возвращает BulkAdjustResult.
+
+    adjustments — записи (vk_id, delta, reason); reason пишется в details
+    операции. Записи одного пользователя применяются вместе: если его нет
+    или сумма увела бы баланс в минус, отклоняются все его записи.
+    Отклоненные возвращаются в rejected с номером записи во входных данных.
+    """
+    staged, rejected = prepare_adjustments(adjustments)
+    if not staged:
+        return BulkAdjustResult(0, rejected)
+
+    buffer = io.StringIO()
+    for seq, vk_id, delta, reason in staged:
+        buffer.write(f"{seq}\t{_copy_value(vk_id)}\t{delta}\t{_copy_value(reason)}\n")
+    buffer.seek(0)
+
+    with db_cursor(transaction=True, session=session) as cursor:
+        cursor.execute(BULK_STAGING_DDL)
+        cursor.execute("TRUNCATE bulk_adjustments")
+        cursor.copy_expert("COPY bulk_adjustments (seq, vk_id, delta, reason) FROM STDIN", buffer)
+        cursor.execute("ANALYZE bulk_adjustments")
+        cursor.execute(LOCK_BULK_USERS_SQL)
+        cursor.execute(APPLY_BULK_ADJUSTMENTS_SQL, {"operation_type": operation_type})
+        results = cursor.fetchall()
+
+    by_seq = {entry[0]: entry for entry in staged}
+    updated = set()
+    for seq, vk_id, error in results:
+        if seq is None:
+            updated.add(vk_id)
+        else:
+            _, _, delta, reason = by_seq[seq]
+            rejected.append(RejectedAdjustment(seq, vk_id, delta, reason, error))
+    for vk_id in updated:
+        invalidate_user(vk_id, session=session)
+
+    rejected.sort(key=lambda entry: entry.index)
+    return BulkAdjustResult(sum(1 for entry in staged if entry[1] in updated), rejected)
+
+def get_user_from_db(user_id, session=None):
+    """Получает пользователя по vk_id или username."""
+    try:
+        user = get_cached_user(user_id, session=session)
+        if user is None:
+            user = get_cached_user_by_username(user_id, session=session)
         return user
     except Exception as e:
-        logging.error(f"Ошибка при поиске пользователя {username}: {e}")
+        logger.error("Ошибка при получении пользователя %s: %s", user_id, e)
         return None
 
-def register_user(user_id):
+def get_user_by_username(username, session=None):
+    """Получает пользователя по username."""
+    try:
+        return get_cached_user_by_username(username, session=session)
+    except Exception as e:
+        logger.error("Ошибка при поиске пользователя %s: %s", username, e)
+        return None
+
+def register_user(user_id, session=None):
     """Регистрирует нового пользователя."""
     try:
         user_data = {
@@ -74,44 +959,33 @@ def register_user(user_id):
             "created_at": datetime.datetime.utcnow().isoformat()
         }
         
-        conn = get_db_connection()
-        if conn is None:
-            return False
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("INSERT INTO users (id, username, vk_id, balance, created_at) VALUES (%s, %s, %s, %s, %s)"),
-            [user_data["id"], user_data["username"], user_data["vk_id"], user_data["balance"], user_data["created_at"]]
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with db_cursor(session=session) as cursor:
+            cursor.execute(
+                with_counters("INSERT INTO users (id, username, vk_id, balance, created_at) "
+                              "VALUES (%s, %s, %s, %s, %s) RETURNING vk_id", USERS_INSERTED_DELTAS),
+                [user_data["id"], user_data["username"], user_data["vk_id"], user_data["balance"], user_data["created_at"]]
+            )
+        invalidate_user(user_id, session=session)
         return True
     except Exception as e:
-        logging.error(f"Ошибка при регистрации пользователя {user_id}: {e}")
+        logger.error("Ошибка при регистрации пользователя %s: %s", user_id, e)
         return False
 
-def update_user_name(user_id, new_name):
+def update_user_name(user_id, new_name, session=None):
     """Обновляет имя пользователя."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return False
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("UPDATE users SET username = %s WHERE vk_id = %s"),
-            [new_name, user_id]
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with db_cursor(session=session) as cursor:
+            cursor.execute(
+                sql.SQL("UPDATE users SET username = %s WHERE vk_id = %s"),
+                [new_name, user_id]
+            )
+        invalidate_user(user_id, session=session)
         return True
     except Exception as e:
-        logging.error(f"Ошибка при обновлении имени пользователя {user_id}: {e}")
+        logger.error("Ошибка при обновлении имени пользователя %s: %s", user_id, e)
         return False
 
-def record_operation(vk_id, op_type, amount, details):
+def record_operation(vk_id, op_type, amount, details, session=None):
     """Записывает операцию в таблицу операций."""
     try:
         operation_data = {
@@ -122,564 +996,403 @@ def record_operation(vk_id, op_type, amount, details):
             "created_at": datetime.datetime.utcnow().isoformat()
         }
         
-        conn = get_db_connection()
-        if conn is None:
-            return False
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("INSERT INTO operations (id, operation_tip, amount, details, created_at) VALUES (%s, %s, %s, %s, %s)"),
-            [operation_data["id"], operation_data["operation_tip"], operation_data["amount"], operation_data["details"], operation_data["created_at"]]
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with db_cursor(session=session) as cursor:
+            cursor.execute(
+                sql.SQL("INSERT INTO operations (id, vk_id, operation_tip, amount, details, created_at) VALUES (%s, %s, %s, %s, %s, %s)"),
+                [operation_data["id"], vk_id, operation_data["operation_tip"], operation_data["amount"], operation_data["details"], operation_data["created_at"]]
+            )
         return True
     except Exception as e:
-        logging.error(f"Ошибка при записи операции: {e}")
+        logger.error("Ошибка при записи операции: %s", e)
         return False
 
-def get_operations(vk_id):
-    """Получает историю операций для пользователя."""
+def get_operations(vk_id, page_size=None, cursor=None, session=None):
+    """Получает страницу истории операций для пользователя."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return []
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("SELECT * FROM operations WHERE details LIKE %s ORDER BY created_at DESC"),
-            [f"%vk_id: {vk_id}%"]
+        operations, _ = fetch_user_history_page(
+            "operations", ["id", "operation_tip", "amount", "details", "created_at"], vk_id,
+            page_size=page_size, cursor=cursor, session=session
         )
-        operations = cursor.fetchall()
-        cursor.close()
-        conn.close()
         return operations
     except Exception as e:
-        logging.error(f"Ошибка при получении истории операций для пользователя {vk_id}: {e}")
+        logger.error("Ошибка при получении истории операций для пользователя %s: %s", vk_id, e)
         return []
 
-def transfer_balance(from_user_id, to_user_id, amount):
+def transfer_balance(from_user_id, to_user_id, amount, session=None, idempotency_key=None):
     """Переводит средства от одного пользователя к другому."""
     try:
-        from_user = get_user_from_db(from_user_id)
-        to_user = get_user_from_db(to_user_id)
-
-        if not from_user or not to_user:
-            return "❌ Один из пользователей не найден."
-
-        if from_user['balance'] < amount:
-            return "❌ Недостаточно средств для перевода."
-
-        # Обновление баланса отправителя
-        new_balance_from = from_user['balance'] - amount
-        conn = get_db_connection()
-        if conn is None:
-            return "❌ Ошибка подключения к базе данных."
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("UPDATE users SET balance = %s WHERE vk_id = %s"),
-            [new_balance_from, from_user_id]
+        result = transfer_funds(
+            from_user_id, to_user_id, amount,
+            sent_type="transfer_sent", received_type="transfer_received",
+            sent_details="Перевод средств пользователю {to_name}",
+            received_details="Получены средства от пользователя {from_name}",
+            session=session, idempotency_key=idempotency_key,
         )
-        # Обновление баланса получателя
-        new_balance_to = to_user['balance'] + amount
-        cursor.execute(
-            sql.SQL("UPDATE users SET balance = %s WHERE vk_id = %s"),
-            [new_balance_to, to_user_id]
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
-
-        # Запись операций
-        record_operation(from_user_id, "transfer_sent", -amount, f"Перевод средств пользователю {to_user['username']}")
-        record_operation(to_user_id, "transfer_received", amount, f"Получены средства от пользователя {from_user['username']}")
-
-        return f"✅ Перевод {amount} средств пользователю {to_user['username']} выполнен успешно."
+        return f"✅ Перевод {amount} средств пользователю {result.to_username} выполнен успешно."
+    except IdempotencyConflictError:
+        return "❌ Ключ идемпотентности уже использован для другой операции."
+    except UserNotFoundError:
+        return "❌ Один из пользователей не найден."
+    except InsufficientFundsError:
+        return "❌ Недостаточно средств для перевода."
+    except ValueError as e:
+        return f"❌ {e}."
     except Exception as e:
-        logging.error(f"Ошибка при переводе средств: {e}")
+        logger.error("Ошибка при переводе средств: %s", e)
         return "❌ Ошибка при переводе средств. Попробуйте позже."
-def get_balance(user_id):
+def get_balance(user_id, session=None):
     """Получает текущий баланс пользователя."""
     try:
-        user = get_user_from_db(user_id)
+        user = get_user_from_db(user_id, session=session)
         if user:
             return f"💰 Ваш текущий баланс: {user['balance']}."
         else:
             return "❌ Пользователь не найден."
     except Exception as e:
-        logging.error(f"Ошибка при получении баланса пользователя {user_id}: {e}")
+        logger.error("Ошибка при получении баланса пользователя %s: %s", user_id, e)
         return "❌ Ошибка при получении баланса."
 
-def deposit_balance(user_id, amount):
+def deposit_balance(user_id, amount, session=None, idempotency_key=None):
     """Пополнение баланса пользователя."""
     try:
-        user = get_user_from_db(user_id)
-        if not user:
-            return "❌ Пользователь не найден."
-
-        new_balance = user['balance'] + amount
-        conn = get_db_connection()
-        if conn is None:
-            return "❌ Ошибка подключения к базе данных."
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("UPDATE users SET balance = %s WHERE vk_id = %s"),
-            [new_balance, user_id]
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
-
-        # Запись операции пополнения
-        record_operation(user_id, "deposit", amount, f"Пополнение баланса на {amount}")
+        check_amount(amount)
+    except ValueError:
+        return "❌ Сумма пополнения должна быть положительным числом."
+    try:
+        new_balance = apply_balance_delta(user_id, amount, "deposit", f"Пополнение баланса на {amount}", session=session, idempotency_key=idempotency_key).balance
         return f"✅ Ваш баланс пополнен на {amount}. Новый баланс: {new_balance}."
+    except IdempotencyConflictError:
+        return "❌ Ключ идемпотентности уже использован для другой операции."
+    except UserNotFoundError:
+        return "❌ Пользователь не найден."
+    except InsufficientFundsError:
+        return "❌ Недостаточно средств на балансе."
     except Exception as e:
-        logging.error(f"Ошибка при пополнении баланса пользователя {user_id}: {e}")
+        logger.error("Ошибка при пополнении баланса пользователя %s: %s", user_id, e)
         return "❌ Ошибка при пополнении баланса. Попробуйте позже."
 
-def withdraw_balance(user_id, amount):
+def withdraw_balance(user_id, amount, session=None, idempotency_key=None):
     """Вывод средств с баланса пользователя."""
     try:
-        user = get_user_from_db(user_id)
-        if not user:
-            return "❌ Пользователь не найден."
-
-        if user['balance'] < amount:
-            return "❌ Недостаточно средств для вывода."
-
-        new_balance = user['balance'] - amount
-        conn = get_db_connection()
-        if conn is None:
-            return "❌ Ошибка подключения к базе данных."
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("UPDATE users SET balance = %s WHERE vk_id = %s"),
-            [new_balance, user_id]
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
-
-        # Запись операции вывода
-        record_operation(user_id, "withdrawal", -amount, f"Вывод средств на {amount}")
+        check_amount(amount)
+    except ValueError:
+        return "❌ Сумма вывода должна быть положительным числом."
+    try:
+        new_balance = apply_balance_delta(user_id, -amount, "withdrawal", f"Вывод средств на {amount}", session=session, idempotency_key=idempotency_key).balance
         return f"✅ Ваш баланс был уменьшен на {amount}. Новый баланс: {new_balance}."
+    except IdempotencyConflictError:
+        return "❌ Ключ идемпотентности уже использован для другой операции."
+    except UserNotFoundError:
+        return "❌ Пользователь не найден."
+    except InsufficientFundsError:
+        return "❌ Недостаточно средств для вывода."
     except Exception as e:
-        logging.error(f"Ошибка при выводе баланса пользователя {user_id}: {e}")
+        logger.error("Ошибка при выводе баланса пользователя %s: %s", user_id, e)
         return "❌ Ошибка при выводе средств. Попробуйте позже."
 
-def get_user_history(user_id):
-    """Получает историю операций пользователя."""
+def get_user_history(user_id, page_size=None, cursor=None, session=None):
+    """Получает страницу истории операций пользователя."""
     try:
-        operations = get_operations(user_id)
+        # Курсор берем из fetch_user_history_page: он знает, есть ли следующая
+        # страница, а полная страница еще не значит, что она есть
+        operations, next_cursor = fetch_user_history_page(
+            "operations", ["operation_type", "amount", "details"], user_id,
+            page_size=page_size, cursor=cursor, session=session
+        )
         if not operations:
             return "❌ История операций пуста."
 
         history = "📜 История операций:\n"
         for op in operations:
-            history += f"Тип операции: {op[1]}, Сумма: {op[2]}, Дата: {op[4]}\n"
-        return history
+            history += f"Тип операции: {op[0]}, Сумма: {op[1]}, Дата: {op[3]}\n"
+        return history + next_page_hint(next_cursor)
     except Exception as e:
-        logging.error(f"Ошибка при получении истории операций для пользователя {user_id}: {e}")
+        logger.error("Ошибка при получении истории операций для пользователя %s: %s", user_id, e)
         return "❌ Ошибка при получении истории операций."
 
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+def telegram_api_url(method):
+    """Адрес метода Bot API для токена бота."""
+    import config  # здесь, а не вверху: config сам импортирует db, и вверху импорт был бы циклическим
+    return f"{TELEGRAM_API_URL}/bot{config.TELEGRAM_BOT_TOKEN}/{method}"
+
+def get_dispatcher():
+    """Возвращает общий диспетчер исходящих сообщений, создавая его при первом обращении."""
+    global _dispatcher
+    if _dispatcher is None:
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                _dispatcher = Dispatcher(telegram_api_url("sendMessage"), **MESSAGE_DISPATCHER)
+    return _dispatcher
+
+def close_dispatcher(wait=True):
+    """Останавливает диспетчер; с wait=True сначала отправляет очередь."""
+    global _dispatcher
+    with _dispatcher_lock:
+        dispatcher, _dispatcher = _dispatcher, None
+    if dispatcher is not None:
+        dispatcher.close(wait=wait)
+
 # Функция для отправки сообщения в Telegram или VK
-def send_message(user_id, message):
-    """Отправляет сообщение пользователю."""
+def send_message(user_id, message, wait=True, timeout=None):
+    """Отправляет сообщение пользователю через общий диспетчер.
+
+    С wait=True ждет результата и возвращает True/False. С wait=False сразу
+    возвращает Future с тем же результатом (его можно и не ждать).
+    """
     try:
-        # Здесь можно добавить интеграцию с VK API или Telegram Bot API
-        # Например, для Telegram:
-        response = requests.post(
-            f"https://api.telegram.org/bot{config.TELEGRAM_BOT_TOKEN}/sendMessage",
-            data={"chat_id": user_id, "text": message}
-        )
-        return response.status_code == 200
+        future = get_dispatcher().submit(user_id, message)
+        if not wait:
+            return future
+        return future.result(timeout)
     except Exception as e:
-        logging.error(f"Ошибка при отправке сообщения пользователю {user_id}: {e}")
+        logger.error("Ошибка при отправке сообщения пользователю %s: %s", user_id, e)
         return False
 
-def record_operation(user_id, operation_type, amount, details):
+def record_operation(user_id, operation_type, amount, details, session=None):
     """Записывает операцию в базу данных."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return "❌ Ошибка подключения к базе данных."
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("INSERT INTO operations (user_id, operation_type, amount, details, created_at) VALUES (%s, %s, %s, %s, now())"),
-            [user_id, operation_type, amount, details]
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with db_cursor(session=session) as cursor:
+            cursor.execute(
+                sql.SQL("INSERT INTO operations (vk_id, operation_type, amount, details, created_at) VALUES (%s, %s, %s, %s, now())"),
+                [user_id, operation_type, amount, details]
+            )
     except Exception as e:
-        logging.error(f"Ошибка при записи операции для пользователя {user_id}: {e}")
+        logger.error("Ошибка при записи операции для пользователя %s: %s", user_id, e)
 
-def get_operations(user_id):
-    """Получает все операции пользователя из базы данных."""
+def get_operations(user_id, page_size=None, cursor=None, session=None):
+    """Получает страницу операций пользователя из базы данных."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return None
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("SELECT * FROM operations WHERE user_id = %s ORDER BY created_at DESC"),
-            [user_id]
+        operations, _ = fetch_user_history_page(
+            "operations", ["id", "operation_type", "amount", "details", "created_at"], user_id,
+            page_size=page_size, cursor=cursor, session=session
         )
-        operations = cursor.fetchall()
-        cursor.close()
-        conn.close()
         return operations
     except Exception as e:
-        logging.error(f"Ошибка при получении операций пользователя {user_id}: {e}")
+        logger.error("Ошибка при получении операций пользователя %s: %s", user_id, e)
         return None
 
-def add_user(vk_id, username=None):
+def add_user(vk_id, username=None, session=None):
     """Добавляет нового пользователя в базу данных."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return "❌ Ошибка подключения к базе данных."
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("INSERT INTO users (vk_id, username, balance, created_at) VALUES (%s, %s, %s, now())"),
-            [vk_id, username, 0]
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with db_cursor(session=session) as cursor:
+            cursor.execute(
+                with_counters("INSERT INTO users (vk_id, username, balance, created_at) "
+                              "VALUES (%s, %s, %s, now()) RETURNING vk_id", USERS_INSERTED_DELTAS),
+                [vk_id, username, 0]
+            )
+        invalidate_user(vk_id, session=session)
         return "✅ Новый пользователь добавлен в базу данных."
     except Exception as e:
-        logging.error(f"Ошибка при добавлении пользователя {vk_id}: {e}")
+        logger.error("Ошибка при добавлении пользователя %s: %s", vk_id, e)
         return "❌ Ошибка при добавлении пользователя."
 
-def update_username(vk_id, new_username):
+def update_username(vk_id, new_username, session=None):
     """Обновляет имя пользователя."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return "❌ Ошибка подключения к базе данных."
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("UPDATE users SET username = %s WHERE vk_id = %s"),
-            [new_username, vk_id]
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
-        return f"✅ Имя пользователя
-            return None
+        with db_cursor(session=session) as cursor:
+            cursor.execute(
+                sql.SQL("UPDATE users SET username = %s WHERE vk_id = %s"),
+                [new_username, vk_id]
+            )
+        invalidate_user(vk_id, session=session)
+        return f"✅ Имя пользователя изменено на {new_username}."
+    except Exception as e:
+        logger.error("Ошибка при обновлении имени пользователя %s: %s", vk_id, e)
+        return "❌ Ошибка при обновлении имени пользователя."
 
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("SELECT * FROM users WHERE vk_id = %s"),
-            [vk_id]
-        )
-        user = cursor.fetchone()
-        cursor.close()
-        conn.close()
-        return user
+def get_user_data(vk_id, session=None):
+    """Получает данные пользователя в виде словаря."""
+    try:
+        return get_cached_user(vk_id, session=session)
     except Exception as e:
-        logging.error(f"Ошибка при получении данных пользователя {vk_id}: {e}")
+        logger.error("Ошибка при получении данных пользователя %s: %s", vk_id, e)
         return None
 
-def update_balance(vk_id, amount, operation_type):
+def update_balance(vk_id, amount, operation_type, session=None):
     """Обновляет баланс пользователя в базе данных."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return "❌ Ошибка подключения к базе данных."
-
-        cursor = conn.cursor()
-        # Получаем текущий баланс
-        cursor.execute(
-            sql.SQL("SELECT balance FROM users WHERE vk_id = %s"),
-            [vk_id]
-        )
-        current_balance = cursor.fetchone()
-        if current_balance is None:
-            return "❌ Пользователь не найден в базе данных."
-
-        new_balance = current_balance[0] + amount
-        if new_balance < 0:
-            return "❌ Недостаточно средств на балансе."
-
-        # Обновляем баланс
-        cursor.execute(
-            sql.SQL("UPDATE users SET balance = %s WHERE vk_id = %s"),
-            [new_balance, vk_id]
-        )
-        # Записываем операцию в таблицу операций
-        record_operation(vk_id, operation_type, amount, f"Обновление баланса на {amount}")
-        conn.commit()
-        cursor.close()
-        conn.close()
-
+        new_balance = apply_balance_delta(vk_id, amount, operation_type, f"Обновление баланса на {amount}", session=session).balance
         return f"✅ Баланс обновлен. Новый баланс: {new_balance}."
+    except UserNotFoundError:
+        return "❌ Пользователь не найден в базе данных."
+    except InsufficientFundsError:
+        return "❌ Недостаточно средств на балансе."
     except Exception as e:
-        logging.error(f"Ошибка при обновлении баланса пользователя {vk_id}: {e}")
+        logger.error("Ошибка при обновлении баланса пользователя %s: %s", vk_id, e)
         return "❌ Ошибка при обновлении баланса."
 
-def get_balance(vk_id):
+def get_balance(vk_id, session=None):
     """Получает текущий баланс пользователя."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return "❌ Ошибка подключения к базе данных."
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("SELECT balance FROM users WHERE vk_id = %s"),
-            [vk_id]
-        )
-        balance = cursor.fetchone()
-        cursor.close()
-        conn.close()
-        if balance is None:
+        user = get_cached_user(vk_id, session=session)
+        if user is None:
             return "❌ Пользователь не найден."
-        return f"Ваш текущий баланс: {balance[0]}."
+        return f"Ваш текущий баланс: {user['balance']}."
     except Exception as e:
-        logging.error(f"Ошибка при получении баланса пользователя {vk_id}: {e}")
+        logger.error("Ошибка при получении баланса пользователя %s: %s", vk_id, e)
         return "❌ Ошибка при получении баланса."
-def get_user_from_db(vk_id):
+def get_user_from_db(vk_id, session=None):
     """Получает пользователя по vk_id."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return None
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("SELECT * FROM users WHERE vk_id = %s"),
-            [vk_id]
-        )
-        user = cursor.fetchone()
-        cursor.close()
-        conn.close()
-        return user
+        return get_cached_user(vk_id, session=session)
     except Exception as e:
-        logging.error(f"Ошибка при получении данных пользователя {vk_id}: {e}")
+        logger.error("Ошибка при получении данных пользователя %s: %s", vk_id, e)
         return None
 
-def register_user(user_id):
+def register_user(user_id, session=None):
     """Регистрирует нового пользователя в базе данных."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return "❌ Ошибка подключения к базе данных."
-
-        cursor = conn.cursor()
-        # Генерация уникального ID для нового пользователя
-        user_data = {
-            "vk_id": user_id,
-            "username": f"User_{user_id}",
-            "balance": 0.0,
-            "created_at": datetime.datetime.utcnow().isoformat()
-        }
+        with db_cursor(session=session) as cursor:
+            # Генерация уникального ID для нового пользователя
+            user_data = {
+                "vk_id": user_id,
+                "username": f"User_{user_id}",
+                "balance": 0.0,
+                "created_at": datetime.datetime.utcnow().isoformat()
+            }
         
-        cursor.execute(
-            sql.SQL("INSERT INTO users (vk_id, username, balance, created_at) VALUES (%s, %s, %s, %s)"),
-            [user_data['vk_id'], user_data['username'], user_data['balance'], user_data['created_at']]
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
+            cursor.execute(
+                with_counters("INSERT INTO users (vk_id, username, balance, created_at) "
+                              "VALUES (%s, %s, %s, %s) RETURNING vk_id", USERS_INSERTED_DELTAS),
+                [user_data['vk_id'], user_data['username'], user_data['balance'], user_data['created_at']]
+            )
+        invalidate_user(user_id, session=session)
 
         return "✅ Регистрация прошла успешно!"
     except Exception as e:
-        logging.error(f"Ошибка при регистрации пользователя {user_id}: {e}")
+        logger.error("Ошибка при регистрации пользователя %s: %s", user_id, e)
         return "❌ Ошибка регистрации."
 
-def update_user_name(vk_id, new_name):
+def update_user_name(vk_id, new_name, session=None):
     """Обновляет имя пользователя в базе данных."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return "❌ Ошибка подключения к базе данных."
+        with db_cursor(session=session) as cursor:
+            # Проверка длины нового имени
+            if len(new_name) < 3 or len(new_name) > 20:
+                return "❌ Имя должно быть от 3 до 20 символов."
 
-        cursor = conn.cursor()
-        # Проверка длины нового имени
-        if len(new_name) < 3 or len(new_name) > 20:
-            return "❌ Имя должно быть от 3 до 20 символов."
-
-        cursor.execute(
-            sql.SQL("UPDATE users SET username = %s WHERE vk_id = %s"),
-            [new_name, vk_id]
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
+            cursor.execute(
+                sql.SQL("UPDATE users SET username = %s WHERE vk_id = %s"),
+                [new_name, vk_id]
+            )
+        invalidate_user(vk_id, session=session)
 
         return f"✅ Имя успешно изменено на {new_name}."
     except Exception as e:
-        logging.error(f"Ошибка при обновлении имени пользователя {vk_id}: {e}")
+        logger.error("Ошибка при обновлении имени пользователя %s: %s", vk_id, e)
         return "❌ Ошибка при изменении имени."
 
-def record_operation(vk_id, op_type, amount, details):
+def record_operation(vk_id, op_type, amount, details, session=None):
     """Записывает операцию в таблицу операций."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return False
+        with db_cursor(session=session) as cursor:
+            operation_data = {
+                "vk_id": vk_id,
+                "operation_tip": op_type,
+                "amount": amount,
+                "details": details,
+                "created_at": datetime.datetime.utcnow().isoformat()
+            }
 
-        cursor = conn.cursor()
-        operation_data = {
-            "vk_id": vk_id,
-            "operation_tip": op_type,
-            "amount": amount,
-            "details": details,
-            "created_at": datetime.datetime.utcnow().isoformat()
-        }
-
-        cursor.execute(
-            sql.SQL("INSERT INTO operations (vk_id, operation_tip, amount, details, created_at) VALUES (%s, %s, %s, %s, %s)"),
-            [operation_data['vk_id'], operation_data['operation_tip'], operation_data['amount'], operation_data['details'], operation_data['created_at']]
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
+            cursor.execute(
+                sql.SQL("INSERT INTO operations (vk_id, operation_tip, amount, details, created_at) VALUES (%s, %s, %s, %s, %s)"),
+                [operation_data['vk_id'], operation_data['operation_tip'], operation_data['amount'], operation_data['details'], operation_data['created_at']]
+            )
         
         return True
     except Exception as e:
-        logging.error(f"Ошибка при записи операции {details}: {e}")
+        logger.error("Ошибка при записи операции %s: %s", details, e)
         return False
 
-def get_operations(vk_id):
-    """Получает историю операций пользователя."""
+def get_operations(vk_id, page_size=None, cursor=None, session=None):
+    """Получает страницу истории операций пользователя (от новых к старым)."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return []
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("SELECT * FROM operations WHERE vk_id = %s ORDER BY created_at DESC"),
-            [vk_id]
+        operations, _ = fetch_user_history_page(
+            "operations", ["id", "operation_type", "amount", "details", "created_at"], vk_id,
+            page_size=page_size, cursor=cursor, session=session
         )
-        operations = cursor.fetchall()
-        cursor.close()
-        conn.close()
         return operations
     except Exception as e:
-        logging.error(f"Ошибка при получении истории операций для пользователя {vk_id}: {e}")
+        logger.error("Ошибка при получении истории операций для пользователя %s: %s", vk_id, e)
         return []
-def get_user_balance(vk_id):
+def get_user_balance(vk_id, session=None):
     """Получает баланс пользователя."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return None
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("SELECT balance FROM users WHERE vk_id = %s"),
-            [vk_id]
-        )
-        balance = cursor.fetchone()
-        cursor.close()
-        conn.close()
-        if balance:
-            return balance[0]
+        user = get_cached_user(vk_id, session=session)
+        if user:
+            return user['balance']
         return 0.0
     except Exception as e:
-        logging.error(f"Ошибка при получении баланса для пользователя {vk_id}: {e}")
+        logger.error("Ошибка при получении баланса для пользователя %s: %s", vk_id, e)
         return 0.0
 
-def update_user_balance(vk_id, new_balance):
+def update_user_balance(vk_id, new_balance, session=None):
     """Обновляет баланс пользователя."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return "❌ Ошибка подключения к базе данных."
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("UPDATE users SET balance = %s WHERE vk_id = %s"),
-            [new_balance, vk_id]
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with db_cursor(session=session) as cursor:
+            cursor.execute(
+                SET_USER_BALANCE_SQL,
+                [new_balance, vk_id]
+            )
+        invalidate_user(vk_id, session=session)
 
         return f"✅ Баланс успешно обновлён на {new_balance}."
     except Exception as e:
-        logging.error(f"Ошибка при обновлении баланса для пользователя {vk_id}: {e}")
+        logger.error("Ошибка при обновлении баланса для пользователя %s: %s", vk_id, e)
         return "❌ Ошибка при обновлении баланса."
 
-def transfer_balance(from_vk_id, to_vk_id, amount):
+def transfer_balance(from_vk_id, to_vk_id, amount, session=None, idempotency_key=None):
     """Перевод средств между двумя пользователями."""
     try:
-        from_balance = get_user_balance(from_vk_id)
-        to_balance = get_user_balance(to_vk_id)
-
-        if from_balance is None or to_balance is None:
-            return "❌ Ошибка получения баланса одного из пользователей."
-
-        if from_balance < amount:
-            return "❌ Недостаточно средств на балансе для перевода."
-
-        # Обновляем балансы обоих пользователей
-        new_from_balance = from_balance - amount
-        new_to_balance = to_balance + amount
-
-        # Обновляем данные в базе
-        update_user_balance(from_vk_id, new_from_balance)
-        update_user_balance(to_vk_id, new_to_balance)
-
-        # Записываем операцию перевода
-        record_operation(from_vk_id, "перевод", -amount, f"Перевод на {to_vk_id}")
-        record_operation(to_vk_id, "перевод", amount, f"Перевод от {from_vk_id}")
-
+        transfer_funds(from_vk_id, to_vk_id, amount, session=session, idempotency_key=idempotency_key)
         return f"✅ Перевод в размере {amount} успешно выполнен от {from_vk_id} к {to_vk_id}."
+    except IdempotencyConflictError:
+        return "❌ Ключ идемпотентности уже использован для другой операции."
+    except UserNotFoundError:
+        return "❌ Ошибка получения баланса одного из пользователей."
+    except InsufficientFundsError:
+        return "❌ Недостаточно средств на балансе для перевода."
+    except ValueError as e:
+        return f"❌ {e}."
     except Exception as e:
-        logging.error(f"Ошибка при переводе средств с {from_vk_id} на {to_vk_id}: {e}")
+        logger.error("Ошибка при переводе средств с %s на %s: %s", from_vk_id, to_vk_id, e)
         return "❌ Ошибка при выполнении перевода."
 
-def get_user_info(vk_id):
+def get_user_info(vk_id, session=None):
     """Получает полную информацию о пользователе."""
     try:
-        user = get_user_from_db(vk_id)
+        user = get_user_from_db(vk_id, session=session)
         if not user:
             return "❌ Пользователь не найден."
 
-        username = user[1]  # предполагаем, что имя в 2-й колонке
-        balance = user[2]  # предполагаем, что баланс в 3-й колонке
-        created_at = user[4]  # предполагаем, что дата регистрации в 5-й колонке
+        username = user['username']
+        balance = user['balance']
+        created_at = user['created_at']
 
         return f"Информация о пользователе {username}:\n" \
                f"Баланс: {balance}💰\n" \
                f"Дата регистрации: {created_at}"
 
     except Exception as e:
-        logging.error(f"Ошибка при получении информации о пользователе {vk_id}: {e}")
+        logger.error("Ошибка при получении информации о пользователе %s: %s", vk_id, e)
         return "❌ Ошибка при получении информации о пользователе."
 
-def delete_user(vk_id):
+def delete_user(vk_id, session=None):
     """Удаляет пользователя из базы данных."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return "❌ Ошибка подключения к базе данных."
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("DELETE FROM users WHERE vk_id = %s"),
-            [vk_id]
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with db_cursor(session=session) as cursor:
+            cursor.execute(
+                DELETE_USER_SQL,
+                [vk_id]
+            )
+        invalidate_user(vk_id, session=session)
 
         return f"✅ Пользователь с ID {vk_id} успешно удалён."
     except Exception as e:
-        logging.error(f"Ошибка при удалении пользователя {vk_id}: {e}")
+        logger.error("Ошибка при удалении пользователя %s: %s", vk_id, e)
         return "❌ Ошибка при удалении пользователя."
 
 # Пример использования:
@@ -700,43 +1413,30 @@ if __name__ == "__main__":
 
     # Удаление пользователя
     print(delete_user(vk_id_example))
-def record_operation(vk_id, operation_type, amount, details):
+def record_operation(vk_id, operation_type, amount, details, session=None, durable=False):
     """Записывает операцию в базу данных."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return "❌ Ошибка подключения к базе данных."
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("INSERT INTO operations (vk_id, operation_type, amount, details, created_at) "
-                    "VALUES (%s, %s, %s, %s, now())"),
-            [vk_id, operation_type, amount, details]
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
+        if journal_audit_row("operations", (vk_id, operation_type, amount, details, _utcnow()), session=session, durable=durable):
+            return "✅ Операция успешно сохранена."
+        with db_cursor(session=session) as cursor:
+            cursor.execute(
+                with_counters("INSERT INTO operations (vk_id, operation_type, amount, details, created_at) "
+                              "VALUES (%s, %s, %s, %s, now()) RETURNING operation_type", OPERATIONS_INSERTED_DELTAS),
+                [vk_id, operation_type, amount, details]
+            )
 
         return "✅ Операция успешно сохранена."
     except Exception as e:
-        logging.error(f"Ошибка при записи операции для пользователя {vk_id}: {e}")
+        logger.error("Ошибка при записи операции для пользователя %s: %s", vk_id, e)
         return "❌ Ошибка при записи операции."
 
-def get_user_operations(vk_id):
-    """Получает список операций пользователя."""
+def get_user_operations(vk_id, page_size=None, cursor=None, next_command=None, session=None):
+    """Получает страницу списка операций пользователя."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return "❌ Ошибка подключения к базе данных."
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("SELECT operation_type, amount, details, created_at FROM operations WHERE vk_id = %s ORDER BY created_at DESC"),
-            [vk_id]
+        operations, next_cursor = fetch_user_history_page(
+            "operations", ["operation_type", "amount", "details"], vk_id,
+            page_size=page_size, cursor=cursor, session=session
         )
-        operations = cursor.fetchall()
-        cursor.close()
-        conn.close()
 
         if not operations:
             return "❌ Нет операций для данного пользователя."
@@ -749,74 +1449,78 @@ def get_user_operations(vk_id):
             created_at = operation[3]
             operations_list += f"{operation_type} - {amount} (Детали: {details}) - {created_at}\n"
 
-        return operations_list
+        return operations_list + next_page_hint(next_cursor, next_command)
+    except ValueError:
+        return "❌ Некорректный курсор страницы."
     except Exception as e:
-        logging.error(f"Ошибка при получении операций для пользователя {vk_id}: {e}")
+        logger.error("Ошибка при получении операций для пользователя %s: %s", vk_id, e)
         return "❌ Ошибка при получении операций."
 
-def add_funds(vk_id, amount):
+def add_funds(vk_id, amount, session=None, idempotency_key=None):
     """Пополнение баланса пользователя."""
     try:
-        current_balance = get_user_balance(vk_id)
-
-        if current_balance is None:
-            return "❌ Ошибка получения текущего баланса."
-
-        new_balance = current_balance + amount
-        update_user_balance(vk_id, new_balance)
-
-        # Записываем операцию пополнения
-        record_operation(vk_id, "пополнение", amount, f"Пополнение баланса на {amount}.")
-
+        new_balance = apply_balance_delta(vk_id, amount, "пополнение", f"Пополнение баланса на {amount}.", session=session, idempotency_key=idempotency_key).balance
         return f"✅ Баланс успешно пополнен на {amount}. Новый баланс: {new_balance}."
+    except IdempotencyConflictError:
+        return "❌ Ключ идемпотентности уже использован для другой операции."
+    except UserNotFoundError:
+        return "❌ Ошибка получения текущего баланса."
     except Exception as e:
-        logging.error(f"Ошибка при пополнении баланса для пользователя {vk_id}: {e}")
+        logger.error("Ошибка при пополнении баланса для пользователя %s: %s", vk_id, e)
         return "❌ Ошибка при пополнении баланса."
 
-def withdraw_funds(vk_id, amount):
+def withdraw_funds(vk_id, amount, session=None, idempotency_key=None):
     """Снятие средств с баланса пользователя."""
     try:
-        current_balance = get_user_balance(vk_id)
-
-        if current_balance is None:
-            return "❌ Ошибка получения текущего баланса."
-
-        if current_balance < amount:
-            return "❌ Недостаточно средств для снятия."
-
-        new_balance = current_balance - amount
-        update_user_balance(vk_id, new_balance)
-
-        # Записываем операцию снятия
-        record_operation(vk_id, "снятие", -amount, f"Снятие баланса на {amount}.")
-
+        new_balance = apply_balance_delta(vk_id, -amount, "снятие", f"Снятие баланса на {amount}.", session=session, idempotency_key=idempotency_key).balance
         return f"✅ Баланс успешно снят на {amount}. Новый баланс: {new_balance}."
+    except IdempotencyConflictError:
+        return "❌ Ключ идемпотентности уже использован для другой операции."
+    except UserNotFoundError:
+        return "❌ Ошибка получения текущего баланса."
+    except InsufficientFundsError:
+        return "❌ Недостаточно средств для снятия."
     except Exception as e:
-        logging.error(f"Ошибка при снятии средств для пользователя {vk_id}: {e}")
+        logger.error("Ошибка при снятии средств для пользователя %s: %s", vk_id, e)
         return "❌ Ошибка при снятии средств."
 
-def get_system_info():
-    """Получает общую информацию о системе."""
-    try:
-        conn = get_db_connection()
-        if conn is None:
-            return "❌ Ошибка подключения к базе данных."
-
-        cursor = conn.cursor()
-        cursor.execute("SELECT count(*) FROM users")
-        total_users = cursor.fetchone()[0]
-
-        cursor.execute("SELECT sum(balance) FROM users")
-        total_balance = cursor.fetchone()[0]
+def get_system_info(verify=False, session=None):
+    """Получает общую информацию о системе.
 
-        cursor.close()
-        conn.close()
+    Значения берутся из поддерживаемых счетчиков system_counters. С
+    verify=True они дополнительно пересчитываются по таблицам, и в ответ
+    добавляются найденные расхождения.
+    """
+    try:
+        counters = read_system_counters(session=session)
+        total_users = counters.get("users", 0)
+        total_balance = counters.get("total_balance", 0)
+        operations = sorted(
+            (name.split(":", 1)[1], count) for name, count in counters.items() if name.startswith("operations:")
+        )
 
-        return f"📊 Общая информация:\n" \
+        info = f"📊 Общая информация:\n" \
                f"Пользователей: {total_users}\n" \
-               f"Общий баланс: {total_balance if total_balance else 0}💰"
+               f"Общий баланс: {total_balance if total_balance else 0}💰\n" \
+               f"Операций: {sum(count for _, count in operations)}\n"
+        for operation_type, count in operations:
+            info += f"  {operation_type}: {count}\n"
+
+        if verify:
+            actual = compute_system_counters(session=session)
+            drift = [
+                f"  {name}: счетчик {counters.get(name, 0)}, фактически {actual.get(name, 0)}\n"
+                for name in sorted(set(counters) | set(actual))
+                if counters.get(name, 0) != actual.get(name, 0)
+            ]
+            if drift:
+                info += "⚠️ Расхождения счетчиков:\n" + "".join(drift)
+                logger.warning("Расхождение системных счетчиков: %s", ''.join(drift).strip())
+            else:
+                info += "✅ Счетчики совпадают с данными.\n"
+        return info
     except Exception as e:
-        logging.error(f"Ошибка при получении информации о системе: {e}")
+        logger.error("Ошибка при получении информации о системе: %s", e)
         return "❌ Ошибка при получении системной информации."
 
 # Пример использования:
@@ -842,132 +1546,85 @@ if __name__ == "__main__":
     print(get_system_info())
 # Продолжение работы с функциями и логикой
 
-def update_user_balance(vk_id, new_balance):
+def update_user_balance(vk_id, new_balance, session=None):
     """Обновляет баланс пользователя в базе данных."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return "❌ Ошибка подключения к базе данных."
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("UPDATE users SET balance = %s WHERE vk_id = %s"),
-            [new_balance, vk_id]
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with db_cursor(session=session) as cursor:
+            cursor.execute(
+                SET_USER_BALANCE_SQL,
+                [new_balance, vk_id]
+            )
+        invalidate_user(vk_id, session=session)
 
         return f"✅ Баланс успешно обновлен: {new_balance}."
     except Exception as e:
-        logging.error(f"Ошибка при обновлении баланса для пользователя {vk_id}: {e}")
+        logger.error("Ошибка при обновлении баланса для пользователя %s: %s", vk_id, e)
         return "❌ Ошибка при обновлении баланса."
 
-def get_user_balance(vk_id):
+def get_user_balance(vk_id, session=None):
     """Получает текущий баланс пользователя."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return None  # Если нет соединения, возвращаем None
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("SELECT balance FROM users WHERE vk_id = %s"),
-            [vk_id]
-        )
-        balance = cursor.fetchone()
-
-        cursor.close()
-        conn.close()
+        user = get_cached_user(vk_id, session=session)
 
-        if balance is None:
-            return None  # Если баланс не найден, возвращаем None
+        if user is None:
+            return None  # Если пользователь не найден, возвращаем None
 
-        return balance[0]  # Возвращаем сам баланс
+        return user['balance']  # Возвращаем сам баланс
     except Exception as e:
-        logging.error(f"Ошибка при получении баланса для пользователя {vk_id}: {e}")
+        logger.error("Ошибка при получении баланса для пользователя %s: %s", vk_id, e)
         return None
 
-def register_user(vk_id):
+def register_user(vk_id, session=None):
     """Регистрация нового пользователя в системе."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return "❌ Ошибка подключения к базе данных."
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("INSERT INTO users (vk_id, balance) VALUES (%s, %s) ON CONFLICT (vk_id) DO NOTHING"),
-            [vk_id, 0]
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with db_cursor(session=session) as cursor:
+            cursor.execute(
+                with_counters("INSERT INTO users (vk_id, balance) VALUES (%s, %s) "
+                              "ON CONFLICT (vk_id) DO NOTHING RETURNING vk_id", USERS_INSERTED_DELTAS),
+                [vk_id, 0]
+            )
+        invalidate_user(vk_id, session=session)
 
         return "✅ Пользователь успешно зарегистрирован."
     except Exception as e:
-        logging.error(f"Ошибка при регистрации пользователя {vk_id}: {e}")
+        logger.error("Ошибка при регистрации пользователя %s: %s", vk_id, e)
         return "❌ Ошибка при регистрации пользователя."
 
-def get_user_info(vk_id):
+def get_user_info(vk_id, session=None):
     """Получает информацию о пользователе."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return "❌ Ошибка подключения к базе данных."
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("SELECT vk_id, balance FROM users WHERE vk_id = %s"),
-            [vk_id]
-        )
-        user = cursor.fetchone()
-
-        cursor.close()
-        conn.close()
+        user = get_cached_user(vk_id, session=session)
 
         if user is None:
             return "❌ Пользователь не найден."
 
-        return f"🧑‍💼 Информация о пользователе:\nVK ID: {user[0]}\nБаланс: {user[1]}💰"
+        return f"🧑‍💼 Информация о пользователе:\nVK ID: {user['vk_id']}\nБаланс: {user['balance']}💰"
     except Exception as e:
-        logging.error(f"Ошибка при получении информации о пользователе {vk_id}: {e}")
+        logger.error("Ошибка при получении информации о пользователе %s: %s", vk_id, e)
         return "❌ Ошибка при получении информации о пользователе."
 
-def record_system_event(event_type, message):
+def record_system_event(event_type, message, session=None, durable=False):
     """Записывает системные события в базу данных для аудита."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return "❌ Ошибка подключения к базе данных."
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("INSERT INTO system_events (event_type, message, created_at) VALUES (%s, %s, now())"),
-            [event_type, message]
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
+        if journal_audit_row("system_events", (event_type, message, _utcnow()), session=session, durable=durable):
+            return "✅ Системное событие успешно записано."
+        with db_cursor(session=session) as cursor:
+            cursor.execute(
+                sql.SQL("INSERT INTO system_events (event_type, message, created_at) VALUES (%s, %s, now())"),
+                [event_type, message]
+            )
 
         return "✅ Системное событие успешно записано."
     except Exception as e:
-        logging.error(f"Ошибка при записи системного события: {e}")
+        logger.error("Ошибка при записи системного события: %s", e)
         return "❌ Ошибка при записи системного события."
 
-def get_system_events():
+def get_system_events(session=None):
     """Получает список всех системных событий."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return "❌ Ошибка подключения к базе данных."
-
-        cursor = conn.cursor()
-        cursor.execute("SELECT event_type, message, created_at FROM system_events ORDER BY created_at DESC")
-        events = cursor.fetchall()
-
-        cursor.close()
-        conn.close()
+        with db_cursor(session=session) as cursor:
+            cursor.execute("SELECT event_type, message, created_at FROM system_events ORDER BY created_at DESC")
+            events = cursor.fetchall()
 
         if not events:
             return "❌ Нет системных событий."
@@ -981,7 +1638,7 @@ def get_system_events():
 
         return events_list
     except Exception as e:
-        logging.error(f"Ошибка при получении системных событий: {e}")
+        logger.error("Ошибка при получении системных событий: %s", e)
         return "❌ Ошибка при получении системных событий."
 
 # Пример использования:
@@ -1013,83 +1670,58 @@ if __name__ == "__main__":
     print(record_system_event("INFO", "Бот запущен успешно"))
 # Дополнительные функции для работы с базой данных и расширения функционала
 
-def add_funds(vk_id, amount):
+def add_funds(vk_id, amount, session=None, idempotency_key=None):
     """Функция для добавления средств на счет пользователя."""
     try:
-        # Проверяем текущий баланс пользователя перед добавлением средств
-        current_balance = get_user_balance(vk_id)
-        if current_balance is None:
-            return "❌ Пользователь не найден."
-
-        new_balance = current_balance + amount
-        update_balance_result = update_user_balance(vk_id, new_balance)
-
-        # Записываем операцию пополнения
-        record_user_operation(vk_id, 'deposit', amount, f"Пополнение на {amount} рублей")
-
+        new_balance = apply_balance_delta(vk_id, amount, 'deposit', f"Пополнение на {amount} рублей", session=session, idempotency_key=idempotency_key).balance
         return f"✅ Пополнение счета на {amount} рублей. Новый баланс: {new_balance}."
+    except IdempotencyConflictError:
+        return "❌ Ключ идемпотентности уже использован для другой операции."
+    except UserNotFoundError:
+        return "❌ Пользователь не найден."
     except Exception as e:
-        logging.error(f"Ошибка при добавлении средств на счет пользователя {vk_id}: {e}")
+        logger.error("Ошибка при добавлении средств на счет пользователя %s: %s", vk_id, e)
         return "❌ Ошибка при добавлении средств на счет."
 
-def withdraw_funds(vk_id, amount):
+def withdraw_funds(vk_id, amount, session=None, idempotency_key=None):
     """Функция для снятия средств с аккаунта пользователя."""
     try:
-        current_balance = get_user_balance(vk_id)
-        if current_balance is None:
-            return "❌ Пользователь не найден."
-
-        if current_balance < amount:
-            return "❌ Недостаточно средств на счете для снятия."
-
-        new_balance = current_balance - amount
-        update_balance_result = update_user_balance(vk_id, new_balance)
-
-        # Записываем операцию снятия
-        record_user_operation(vk_id, 'withdraw', amount, f"Снятие {amount} рублей")
-
+        new_balance = apply_balance_delta(vk_id, -amount, 'withdraw', f"Снятие {amount} рублей", session=session, idempotency_key=idempotency_key).balance
         return f"✅ Снятие {amount} рублей. Новый баланс: {new_balance}."
+    except IdempotencyConflictError:
+        return "❌ Ключ идемпотентности уже использован для другой операции."
+    except UserNotFoundError:
+        return "❌ Пользователь не найден."
+    except InsufficientFundsError:
+        return "❌ Недостаточно средств на счете для снятия."
     except Exception as e:
-        logging.error(f"Ошибка при снятии средств с аккаунта пользователя {vk_id}: {e}")
+        logger.error("Ошибка при снятии средств с аккаунта пользователя %s: %s", vk_id, e)
         return "❌ Ошибка при снятии средств."
 
-def record_user_operation(vk_id, operation_type, amount, details):
+def record_user_operation(vk_id, operation_type, amount, details, session=None, durable=False):
     """Записывает операцию пользователя (пополнение/снятие) в базу данных."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return "❌ Ошибка подключения к базе данных."
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("INSERT INTO operations (vk_id, operation_type, amount, details) VALUES (%s, %s, %s, %s)"),
-            [vk_id, operation_type, amount, details]
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
+        if journal_audit_row("operations", (vk_id, operation_type, amount, details, _utcnow()), session=session, durable=durable):
+            return "✅ Операция успешно записана."
+        with db_cursor(session=session) as cursor:
+            cursor.execute(
+                with_counters("INSERT INTO operations (vk_id, operation_type, amount, details, created_at) "
+                              "VALUES (%s, %s, %s, %s, now()) RETURNING operation_type", OPERATIONS_INSERTED_DELTAS),
+                [vk_id, operation_type, amount, details]
+            )
 
         return "✅ Операция успешно записана."
     except Exception as e:
-        logging.error(f"Ошибка при записи операции пользователя {vk_id}: {e}")
+        logger.error("Ошибка при записи операции пользователя %s: %s", vk_id, e)
         return "❌ Ошибка при записи операции."
 
-def get_user_operations(vk_id):
-    """Получает список операций пользователя по его VK ID."""
+def get_user_operations(vk_id, page_size=None, cursor=None, next_command=None, session=None):
+    """Получает страницу списка операций пользователя по его VK ID."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return "❌ Ошибка подключения к базе данных."
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("SELECT operation_type, amount, details, created_at FROM operations WHERE vk_id = %s ORDER BY created_at DESC"),
-            [vk_id]
+        operations, next_cursor = fetch_user_history_page(
+            "operations", ["operation_type", "amount", "details"], vk_id,
+            page_size=page_size, cursor=cursor, session=session
         )
-        operations = cursor.fetchall()
-
-        cursor.close()
-        conn.close()
 
         if not operations:
             return "❌ Нет операций для данного пользователя."
@@ -1102,30 +1734,27 @@ def get_user_operations(vk_id):
             op_created_at = op[3]
             operations_list += f"{op_type} - {op_amount} - {op_details} - {op_created_at}\n"
 
-        return operations_list
+        return operations_list + next_page_hint(next_cursor, next_command)
+    except ValueError:
+        return "❌ Некорректный курсор страницы."
     except Exception as e:
-        logging.error(f"Ошибка при получении операций пользователя {vk_id}: {e}")
+        logger.error("Ошибка при получении операций пользователя %s: %s", vk_id, e)
         return "❌ Ошибка при получении операций."
 
-def record_error_message(vk_id, error_message):
+def record_error_message(vk_id, error_message, session=None, durable=False):
     """Записывает сообщение об ошибке в базу данных."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return "❌ Ошибка подключения к базе данных."
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("INSERT INTO system_errors (vk_id, error_message, created_at) VALUES (%s, %s, now())"),
-            [vk_id, error_message]
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
+        if journal_audit_row("system_errors", (vk_id, error_message, _utcnow()), session=session, durable=durable):
+            return "✅ Сообщение об ошибке успешно записано."
+        with db_cursor(session=session) as cursor:
+            cursor.execute(
+                sql.SQL("INSERT INTO system_errors (vk_id, error_message, created_at) VALUES (%s, %s, now())"),
+                [vk_id, error_message]
+            )
 
         return "✅ Сообщение об ошибке успешно записано."
     except Exception as e:
-        logging.error(f"Ошибка при записи сообщения об ошибке пользователя {vk_id}: {e}")
+        logger.error("Ошибка при записи сообщения об ошибке пользователя %s: %s", vk_id, e)
         return "❌ Ошибка при записи сообщения об ошибке."
 
 # Пример обработки ошибок, вызов функций
@@ -1151,30 +1780,23 @@ if __name__ == "__main__":
     print(get_system_events())
 # Дальше продолжаем добавление дополнительных функций для работы с базой данных, обеспечения логирования и взаимодействия с другими частями системы.
 
-def get_system_events(event_type=None):
+def get_system_events(event_type=None, session=None):
     """Получает системные события из базы данных (по типу события или все)."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return "❌ Ошибка подключения к базе данных."
-
-        cursor = conn.cursor()
-
-        # Если тип события не передан, получаем все события
-        if event_type:
-            cursor.execute(
-                sql.SQL("SELECT event_type, message, created_at FROM system_events WHERE event_type = %s ORDER BY created_at DESC"),
-                [event_type]
-            )
-        else:
-            cursor.execute(
-                sql.SQL("SELECT event_type, message, created_at FROM system_events ORDER BY created_at DESC")
-            )
+        with db_cursor(session=session) as cursor:
+
+            # Если тип события не передан, получаем все события
+            if event_type:
+                cursor.execute(
+                    sql.SQL("SELECT event_type, message, created_at FROM system_events WHERE event_type = %s ORDER BY created_at DESC"),
+                    [event_type]
+                )
+            else:
+                cursor.execute(
+                    sql.SQL("SELECT event_type, message, created_at FROM system_events ORDER BY created_at DESC")
+                )
         
-        events = cursor.fetchall()
-
-        cursor.close()
-        conn.close()
+            events = cursor.fetchall()
 
         if not events:
             return "❌ Нет системных событий."
@@ -1188,53 +1810,36 @@ def get_system_events(event_type=None):
 
         return events_list
     except Exception as e:
-        logging.error(f"Ошибка при получении системных событий: {e}")
+        logger.error("Ошибка при получении системных событий: %s", e)
         return "❌ Ошибка при получении системных событий."
 
-def record_system_event(event_type, message):
+def record_system_event(event_type, message, session=None, durable=False):
     """Записывает системное событие в базу данных."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return "❌ Ошибка подключения к базе данных."
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("INSERT INTO system_events (event_type, message, created_at) VALUES (%s, %s, now())"),
-            [event_type, message]
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
+        if journal_audit_row("system_events", (event_type, message, _utcnow()), session=session, durable=durable):
+            return "✅ Системное событие успешно записано."
+        with db_cursor(session=session) as cursor:
+            cursor.execute(
+                sql.SQL("INSERT INTO system_events (event_type, message, created_at) VALUES (%s, %s, now())"),
+                [event_type, message]
+            )
 
         return "✅ Системное событие успешно записано."
     except Exception as e:
-        logging.error(f"Ошибка при записи системного события: {e}")
+        logger.error("Ошибка при записи системного события: %s", e)
         return "❌ Ошибка при записи системного события."
 
-def get_user_info(vk_id):
+def get_user_info(vk_id, session=None):
     """Получает информацию о пользователе, включая баланс и количество операций."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return "❌ Ошибка подключения к базе данных."
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("SELECT vk_id, balance, created_at FROM users WHERE vk_id = %s"),
-            [vk_id]
-        )
-        user_info = cursor.fetchone()
-
-        cursor.close()
-        conn.close()
+        user_info = get_cached_user(vk_id, session=session)
 
         if not user_info:
             return "❌ Пользователь не найден."
 
-        vk_id = user_info[0]
-        balance = user_info[1]
-        created_at = user_info[2]
+        vk_id = user_info['vk_id']
+        balance = user_info['balance']
+        created_at = user_info['created_at']
 
         user_info_str = f"📋 Информация о пользователе:\n"
         user_info_str += f"ID пользователя: {vk_id}\n"
@@ -1243,52 +1848,35 @@ def get_user_info(vk_id):
 
         return user_info_str
     except Exception as e:
-        logging.error(f"Ошибка при получении информации о пользователе {vk_id}: {e}")
+        logger.error("Ошибка при получении информации о пользователе %s: %s", vk_id, e)
         return "❌ Ошибка при получении информации о пользователе."
 
-def update_user_balance(vk_id, new_balance):
+def update_user_balance(vk_id, new_balance, session=None):
     """Обновляет баланс пользователя в базе данных."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return "❌ Ошибка подключения к базе данных."
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("UPDATE users SET balance = %s WHERE vk_id = %s"),
-            [new_balance, vk_id]
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with db_cursor(session=session) as cursor:
+            cursor.execute(
+                SET_USER_BALANCE_SQL,
+                [new_balance, vk_id]
+            )
+        invalidate_user(vk_id, session=session)
 
         return "✅ Баланс успешно обновлен."
     except Exception as e:
-        logging.error(f"Ошибка при обновлении баланса пользователя {vk_id}: {e}")
+        logger.error("Ошибка при обновлении баланса пользователя %s: %s", vk_id, e)
         return "❌ Ошибка при обновлении баланса."
 
-def get_user_balance(vk_id):
+def get_user_balance(vk_id, session=None):
     """Получает текущий баланс пользователя."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return None  # если нет подключения, возвращаем None
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("SELECT balance FROM users WHERE vk_id = %s"),
-            [vk_id]
-        )
-        result = cursor.fetchone()
-        cursor.close()
-        conn.close()
+        user = get_cached_user(vk_id, session=session)
 
-        if result:
-            return result[0]
+        if user:
+            return user['balance']
         else:
             return None
     except Exception as e:
-        logging.error(f"Ошибка при получении баланса пользователя {vk_id}: {e}")
+        logger.error("Ошибка при получении баланса пользователя %s: %s", vk_id, e)
         return None
 
 # Пример использования:
@@ -1303,141 +1891,123 @@ if __name__ == "__main__":
     print(get_system_events())  # Получаем все события
 # Завершаем дополнительные функции для работы с базой данных и взаимодействие с другими частями системы.
 
-def log_user_activity(vk_id, action_type, details):
+def log_user_activity(vk_id, action_type, details, session=None, durable=False):
     """Записывает действия пользователя в журнал."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return "❌ Ошибка подключения к базе данных."
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("INSERT INTO user_activity (vk_id, action_type, details, created_at) VALUES (%s, %s, %s, now())"),
-            [vk_id, action_type, details]
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
+        if journal_audit_row("user_activity", (vk_id, action_type, details, _utcnow()), session=session, durable=durable):
+            return "✅ Действие пользователя успешно записано."
+        with db_cursor(session=session) as cursor:
+            cursor.execute(
+                sql.SQL("INSERT INTO user_activity (vk_id, action_type, details, created_at) VALUES (%s, %s, %s, now())"),
+                [vk_id, action_type, details]
+            )
 
         return "✅ Действие пользователя успешно записано."
     except Exception as e:
-        logging.error(f"Ошибка при записи действия пользователя {vk_id}: {e}")
+        logger.error("Ошибка при записи действия пользователя %s: %s", vk_id, e)
         return "❌ Ошибка при записи действия пользователя."
 
-def get_user_activity(vk_id):
-    """Получает активность пользователя (действия) за все время."""
+def get_user_activity(vk_id, page_size=None, cursor=None, next_command=None, session=None):
+    """Получает страницу активности пользователя (действий), от новых к старым."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return "❌ Ошибка подключения к базе данных."
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("SELECT action_type, details, created_at FROM user_activity WHERE vk_id = %s ORDER BY created_at DESC"),
-            [vk_id]
+        activities, next_cursor = fetch_user_history_page(
+            "user_activity", ["action_type", "details"], vk_id,
+            page_size=page_size, cursor=cursor, session=session
         )
-        activities = cursor.fetchall()
-
-        cursor.close()
-        conn.close()
 
-        if not activities:
-            return "❌ Нет активности для данного пользователя."
-
-        activity_list = "🗂 История действий пользователя:\n"
-        for activity in activities:
-            action_type = activity[0]
-            details = activity[1]
-            created_at = activity[2]
-            activity_list += f"{action_type} - {details} - {created_at}\n"
-
-        return activity_list
+        return render_activity_page(activities, next_cursor, next_command)
+    except ValueError:
+        return "❌ Некорректный курсор страницы."
     except Exception as e:
-        logging.error(f"Ошибка при получении активности пользователя {vk_id}: {e}")
+        logger.error("Ошибка при получении активности пользователя %s: %s", vk_id, e)
         return "❌ Ошибка при получении активности пользователя."
 
-def delete_user_account(vk_id):
+def delete_user_account(vk_id, session=None):
     """Удаляет аккаунт пользователя и всю его информацию."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return "❌ Ошибка подключения к базе данных."
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("DELETE FROM users WHERE vk_id = %s"),
-            [vk_id]
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with db_cursor(session=session) as cursor:
+            cursor.execute(
+                DELETE_USER_SQL,
+                [vk_id]
+            )
+        invalidate_user(vk_id, session=session)
 
         return "✅ Аккаунт пользователя успешно удален."
     except Exception as e:
-        logging.error(f"Ошибка при удалении аккаунта пользователя {vk_id}: {e}")
+        logger.error("Ошибка при удалении аккаунта пользователя %s: %s", vk_id, e)
         return "❌ Ошибка при удалении аккаунта пользователя."
 
-def get_all_users():
-    """Получает информацию обо всех пользователях."""
-    try:
-        conn = get_db_connection()
-        if conn is None:
-            return "❌ Ошибка подключения к базе данных."
-
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("SELECT vk_id, balance, created_at FROM users ORDER BY created_at DESC")
-        )
-        users = cursor.fetchall()
-
-        cursor.close()
-        conn.close()
-
-        if not users:
-            return "❌ Нет пользователей в системе."
-
-        users_list = "🗂 Все пользователи:\n"
-        for user in users:
-            vk_id = user[0]
-            balance = user[1]
-            created_at = user[2]
-            users_list += f"ID пользователя: {vk_id} - Баланс: {balance} - Дата регистрации: {created_at}\n"
+def get_all_users(session=None):
+    """Получает информацию обо всех пользователях одной строкой.
 
-        return users_list
+    Для больших баз используйте iter_all_users_messages: она не держит
+    весь список в памяти.
+    """
+    try:
+        return "".join(iter_all_users_messages(max_length=None, session=session))
     except Exception as e:
-        logging.error(f"Ошибка при получении списка всех пользователей: {e}")
+        logger.error("Ошибка при получении списка всех пользователей: %s", e)
         return "❌ Ошибка при получении списка пользователей."
 
-def get_transaction_history(vk_id):
-    """Получает историю транзакций пользователя."""
+def users_page_query(after=None, limit=None):
+    """Запрос порции пользователей после after = (created_at, vk_id) и его параметры.
+
+    Порядок — created_at DESC, vk_id, как у индекса users_created_at_vk_id_idx.
+    Отдельное created_at <= ... задает начало прохода по индексу: одно
+    условие с OR индекс не ограничивает, и каждая порция читала бы его с начала.
+    """
+    conditions, args = [], []
+    if after is not None:
+        created_at, vk_id = after
+        conditions.append("created_at <= %s AND (created_at < %s OR vk_id > %s)")
+        args += [created_at, created_at, vk_id]
+    where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+    query = f"SELECT vk_id, balance, created_at FROM users {where}ORDER BY created_at DESC, vk_id LIMIT %s"
+    return query, args + [limit or USERS_CHUNK_SIZE]
+
+def iter_user_chunks(chunk_size=None, session=None):
+    """Генератор: отдает пользователей (vk_id, balance, created_at) списками по chunk_size.
+
+    Каждая порция — отдельный короткий запрос с продолжением после
+    последней строки (как broadcast.iter_recipients), поэтому между
+    порциями соединение не занято и транзакция не открыта, сколько бы
+    ни отправлялись сообщения. С session порции читаются на ее соединении.
+    """
+    chunk_size = chunk_size or USERS_CHUNK_SIZE
+    after = None
+    while True:
+        query, args = users_page_query(after, chunk_size)
+        with db_cursor(session=session) as cursor:
+            cursor.execute(query, args)
+            users = cursor.fetchall()
+        if not users:
+            return
+        yield users
+        if len(users) < chunk_size:
+            return
+        after = (users[-1][2], users[-1][0])
+
+def iter_all_users_messages(chunk_size=None, max_length=MESSAGE_MAX_LENGTH, session=None):
+    """Генератор готовых сообщений со списком всех пользователей."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return "❌ Ошибка подключения к базе данных."
+        yield from render_users_messages(iter_user_chunks(chunk_size, session=session), max_length)
+    except Exception as e:
+        logger.error("Ошибка при выгрузке списка пользователей: %s", e)
+        yield "❌ Ошибка при получении списка пользователей."
 
-        cursor = conn.cursor()
-        cursor.execute(
-            sql.SQL("SELECT transaction_type, amount, created_at FROM transactions WHERE vk_id = %s ORDER BY created_at DESC"),
-            [vk_id]
+def get_transaction_history(vk_id, page_size=None, cursor=None, next_command=None, session=None):
+    """Получает страницу истории транзакций пользователя."""
+    try:
+        transactions, next_cursor = fetch_user_history_page(
+            "transactions", ["transaction_type", "amount"], vk_id,
+            page_size=page_size, cursor=cursor, session=session
         )
-        transactions = cursor.fetchall()
-
-        cursor.close()
-        conn.close()
-
-        if not transactions:
-            return "❌ Нет транзакций для данного пользователя."
 
-        transactions_list = "🗂 История транзакций:\n"
-        for transaction in transactions:
-            transaction_type = transaction[0]
-            amount = transaction[1]
-            created_at = transaction[2]
-            transactions_list += f"{transaction_type} - Сумма: {amount} - Дата: {created_at}\n"
-
-        return transactions_list
+        return render_transactions_page(transactions, next_cursor, next_command)
+    except ValueError:
+        return "❌ Некорректный курсор страницы."
     except Exception as e:
-        logging.error(f"Ошибка при получении истории транзакций пользователя {vk_id}: {e}")
+        logger.error("Ошибка при получении истории транзакций пользователя %s: %s", vk_id, e)
         return "❌ Ошибка при получении истории транзакций."
 
 # Пример использования:
@@ -1457,3 +2027,12 @@ if __name__ == "__main__":
 
     # Пример получения истории транзакций пользователя
     print(get_transaction_history("12345"))
+
+# Время, ошибки и число строк каждой функции db — в metrics (kind "db").
+# Служебные функции без обращения к базе не оборачиваются.
+metrics.instrument(sys.modules[__name__], "db", exclude=(
+    "get_pool", "close_pool", "get_db_connection", "release_db_connection", "invalidate_user",
+    "user_cache_stats", "get_audit_journal", "close_audit_journal", "journal_audit_row",
+    "history_page_query", "users_page_query", "with_counters", "telegram_api_url", "get_dispatcher", "close_dispatcher",
+    "get_query_log", "slow_queries", "start_idempotency_purger", "stop_idempotency_purger",
+))
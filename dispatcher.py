@@ -0,0 +1,293 @@
+import atexit
+import heapq
+import itertools
+import logging
+import queue
+import random
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import Future
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+_EMPTY = object()       # из очереди ничего не пришло
+
+
+class _Message:
+    __slots__ = ("chat_id", "text", "future", "attempt", "started")
+
+    def __init__(self, chat_id, text, future):
+        self.chat_id = chat_id
+        self.text = text
+        self.future = future
+        self.attempt = 0
+        self.started = False
+
+
+class Dispatcher:
+    """Фоновая отправка сообщений в Bot API.
+
+    Сообщения раскладываются по workers очередям по хэшу chat_id, поэтому
+    сообщения одного чата уходят строго по порядку. У каждого потока своя
+    keep-alive сессия requests. Скорость ограничена общим ведром
+    (global_rate) и ведром на чат (per_chat_rate); ответы 429 и 5xx, а также
+    сетевые ошибки повторяются с экспоненциальной задержкой. submit()
+    возвращает Future с результатом True/False.
+
+    Поток не спит, ожидая токен или повтор: чат откладывается в куче
+    таймеров потока, и тем временем уходят сообщения других чатов.
+    """
+
+    def __init__(self, url, workers=8, global_rate=30.0, global_burst=30,
+                 per_chat_rate=1.0, per_chat_burst=3, max_retries=5,
+                 backoff_base=0.5, backoff_max=30.0, timeout=10.0, max_queue=10000):
+        self.url = url
+        self.workers = workers
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.max_queue = max_queue
+
+        self._global = TokenBucket(global_rate, global_burst)
+        self._lock = threading.Lock()
+        self._paused_until = 0.0      # после 429 с retry_after ждут все потоки
+        self._queues = []
+        self._held = []               # сообщений, взятых из очереди потока и еще не отправленных
+        self._threads = []
+        self._started = False
+        self._stopped = False
+        self._abandon = False         # close(wait=False): отложенные сообщения не отправлять
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+
+    def start(self):
+        """Запускает потоки отправки (вызывается при первом submit)."""
+        with self._lock:
+            if self._started or self._stopped:
+                return
+            for index in range(self.workers):
+                messages = queue.Queue(self.max_queue)
+                thread = threading.Thread(target=self._run, args=(index, messages), name=f"dispatcher-{index}",
+                                          daemon=True)
+                self._queues.append(messages)
+                self._held.append(0)
+                self._threads.append(thread)
+                thread.start()
+            self._started = True
+        atexit.register(self.close)
+
+    def submit(self, chat_id, text):
+        """Ставит сообщение в очередь; возвращает Future (True — доставлено)."""
+        if not self._started:
+            self.start()
+        if self._stopped:
+            raise RuntimeError("Диспетчер сообщений остановлен")
+        future = Future()
+        index = zlib.crc32(str(chat_id).encode()) % self.workers
+        self._queues[index].put(_Message(chat_id, text, future))
+        return future
+
+    def _new_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def _run(self, index, messages):
+        session = self._new_session()
+        chat_buckets = {}
+        chats = {}          # chat_id -> deque сообщений чата; первое — в работе
+        timers = []         # куча (не раньше, номер, chat_id): когда заняться первым сообщением чата
+        order = itertools.count()
+        stopping = False
+        try:
+            while chats or not stopping:
+                now = time.monotonic()
+                wait = max(0.0, timers[0][0] - now) if timers else None
+                if stopping:
+                    time.sleep(wait)
+                else:
+                    try:
+                        item = messages.get(timeout=wait) if wait != 0 else messages.get_nowait()
+                    except queue.Empty:
+                        item = _EMPTY
+                    if item is None:
+                        stopping = True
+                        if self._abandon:
+                            self._abandon_held(chats, timers)
+                            self._held[index] = 0
+                    elif item is not _EMPTY:
+                        chat = chats.get(item.chat_id)
+                        if chat is None:
+                            chats[item.chat_id] = deque([item])
+                            heapq.heappush(timers, (time.monotonic(), next(order), item.chat_id))
+                        else:
+                            chat.append(item)
+                        self._held[index] += 1
+
+                now = time.monotonic()
+                while timers and timers[0][0] <= now:
+                    _, _, chat_id = heapq.heappop(timers)
+                    chat = chats[chat_id]
+                    retry_in = self._step(session, chat_buckets, chat[0])
+                    if retry_in is None:
+                        chat.popleft()
+                        self._held[index] -= 1
+                        if not chat:
+                            del chats[chat_id]
+                            continue
+                        retry_in = 0.0
+                    heapq.heappush(timers, (time.monotonic() + retry_in, next(order), chat_id))
+                    now = time.monotonic()
+
+                if len(chat_buckets) > self.max_queue:
+                    for idle_chat in [c for c, b in chat_buckets.items() if b.idle() and c not in chats]:
+                        del chat_buckets[idle_chat]
+        finally:
+            session.close()
+
+    def _abandon_held(self, chats, timers):
+        """close(wait=False): сообщения, отложенные потоком, не отправляются."""
+        for chat in chats.values():
+            for message in chat:
+                if message.started:
+                    message.future.set_result(False)
+                    self._count("failed")
+                else:
+                    message.future.cancel()
+        chats.clear()
+        timers.clear()
+
+    def _step(self, session, chat_buckets, message):
+        """Одна попытка отправить сообщение; None — с ним покончено, иначе через сколько секунд повторить."""
+        if not message.started:
+            if not message.future.set_running_or_notify_cancel():
+                return None
+            message.started = True
+        chat_bucket = chat_buckets.get(message.chat_id)
+        if chat_bucket is None:
+            chat_bucket = chat_buckets[message.chat_id] = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+        delay = self._turn_delay(chat_bucket)
+        if delay > 0:
+            return delay
+        try:
+            delivered, retry_in = self._attempt(session, message)
+        except Exception as e:
+            message.future.set_exception(e)
+            return None
+        if retry_in is not None:
+            return retry_in
+        message.future.set_result(delivered)
+        return None
+
+    def _turn_delay(self, chat_bucket):
+        """Забирает токены чата и общий и возвращает 0 или, если токена нет, сколько ждать."""
+        now = time.monotonic()
+        delay = chat_bucket.delay(now)
+        if delay > 0:
+            return delay
+        with self._lock:
+            delay = max(self._global.delay(now), self._paused_until - now)
+            if delay <= 0:
+                self._global.reserve(now)
+        if delay > 0:
+            return delay
+        chat_bucket.reserve(now)
+        return 0.0
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _backoff(self, attempt):
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        return delay * random.uniform(0.5, 1.0)
+
+    def _retry_after(self, response):
+        """Задержка из ответа 429: parameters.retry_after или заголовок Retry-After."""
+        try:
+            retry_after = response.json().get("parameters", {}).get("retry_after")
+        except ValueError:
+            retry_after = None
+        if retry_after is None:
+            retry_after = response.headers.get("Retry-After")
+        try:
+            return float(retry_after) if retry_after is not None else None
+        except ValueError:
+            return None
+
+    def _attempt(self, session, message):
+        """POST сообщения: (доставлено, None) — итог, (None, задержка) — повторить позже."""
+        chat_id = message.chat_id
+        try:
+            response = session.post(self.url, data={"chat_id": chat_id, "text": message.text}, timeout=self.timeout)
+        except requests.RequestException as e:
+            reason = str(e)
+            delay = self._backoff(message.attempt)
+        else:
+            if response.status_code == 200:
+                self._count("sent")
+                return True, None
+            if response.status_code != 429 and response.status_code < 500:
+                logger.error("Сообщение для %s отклонено: HTTP %s %s", chat_id, response.status_code, response.text[:200])
+                self._count("failed")
+                return False, None
+            reason = f"HTTP {response.status_code}"
+            delay = self._backoff(message.attempt)
+            if response.status_code == 429:
+                retry_after = self._retry_after(response)
+                if retry_after is not None:
+                    delay = retry_after
+                    with self._lock:
+                        self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+        if message.attempt < self.max_retries:
+            message.attempt += 1
+            self._count("retries")
+            return None, delay
+
+        logger.error("Не удалось отправить сообщение для %s после %s попыток: %s", chat_id, self.max_retries + 1, reason)
+        self._count("failed")
+        return False, None
+
+    def close(self, wait=True):
+        """Останавливает потоки; с wait=True сначала отправляет все сообщения из очередей."""
+        with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+            started = self._started
+        if not started:
+            return
+        if not wait:
+            self._abandon = True
+            for messages in self._queues:
+                while True:
+                    try:
+                        item = messages.get_nowait()
+                    except queue.Empty:
+                        break
+                    item.future.cancel()
+        for messages in self._queues:
+            messages.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def stats(self):
+        return {
+            "queued": sum(messages.qsize() for messages in self._queues) + sum(self._held),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+        }
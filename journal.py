@@ -0,0 +1,144 @@
+import atexit
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class Journal:
+    """Буфер записей аудита с пакетной записью в базу.
+
+    Строки копятся в памяти по таблицам и сбрасываются функцией writer
+    одним пакетом, когда их набирается max_rows или прошло flush_interval
+    секунд. writer получает OrderedDict {таблица: [строки]} и должен
+    записать все строки в одной транзакции.
+
+    Строки из буфера не отбрасываются: если в нем уже max_buffer строк
+    (база долго недоступна или сброс не успевает), append отказывает, и
+    вызывающий пишет строку сам, синхронно.
+    """
+
+    def __init__(self, writer, max_rows=500, flush_interval=1.0, max_buffer=100000):
+        self.writer = writer
+        self.max_rows = max_rows
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+
+        self._cond = threading.Condition(threading.Lock())
+        self._flush_lock = threading.Lock()   # один сброс за раз, порядок строк сохраняется
+        self._buffer = OrderedDict()
+        self._pending = 0
+        self._thread = None
+        self._stopped = False
+        self.flushed_rows = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.rejected_rows = 0      # строки, которые append не принял из-за полного буфера
+
+    def start(self):
+        """Запускает фоновый поток сброса (вызывается при первой записи)."""
+        with self._cond:
+            if self._thread is not None or self._stopped:
+                return
+            self._thread = threading.Thread(target=self._run, name="audit-journal", daemon=True)
+            self._thread.start()
+        atexit.register(self.close)
+
+    def append(self, table, row):
+        """Добавляет строку в буфер таблицы; возвращает False, если буфер полон.
+
+        Непринятую строку вызывающий должен записать сам.
+        """
+        if self._thread is None:
+            self.start()
+        with self._cond:
+            if self._pending >= self.max_buffer:
+                self.rejected_rows += 1
+                rejected = self.rejected_rows
+            else:
+                self._buffer.setdefault(table, []).append(row)
+                self._pending += 1
+                if self._pending >= self.max_rows:
+                    self._cond.notify()
+                return True
+        logger.warning("Журнал аудита полон (%s строк): строка %s пишется синхронно, всего таких %s",
+                       self.max_buffer, table, rejected)
+        return False
+
+    def _take(self):
+        with self._cond:
+            batches, self._buffer, self._pending = self._buffer, OrderedDict(), 0
+            return batches
+
+    def _put_back(self, batches):
+        """Возвращает несброшенные строки в начало буфера.
+
+        Ничего не отбрасывается; буфер может временно превысить max_buffer,
+        но не больше чем вдвое: append сверх max_buffer строк не принимает.
+        """
+        with self._cond:
+            for table, rows in self._buffer.items():
+                batches.setdefault(table, []).extend(rows)
+            self._buffer = OrderedDict((table, rows) for table, rows in batches.items() if rows)
+            self._pending = sum(len(rows) for rows in self._buffer.values())
+
+    def flush(self):
+        """Сбрасывает накопленные строки; возвращает их число."""
+        with self._flush_lock:
+            batches = self._take()
+            count = sum(len(rows) for rows in batches.values())
+            if not count:
+                return 0
+            try:
+                self.writer(batches)
+            except Exception as e:
+                self.failed_flushes += 1
+                logger.error("Ошибка при сбросе журнала аудита (%s строк): %s", count, e)
+                self._put_back(batches)
+                return 0
+            self.flushes += 1
+            self.flushed_rows += count
+            return count
+
+    def _run(self):
+        failed = False
+        while True:
+            with self._cond:
+                # После неудачного сброса ждем полный интервал, даже если буфер полон
+                if not self._stopped and (failed or self._pending < self.max_rows):
+                    self._cond.wait(self.flush_interval)
+                stopped = self._stopped
+            failures = self.failed_flushes
+            self.flush()
+            failed = self.failed_flushes != failures
+            if stopped:
+                return
+
+    def close(self):
+        """Останавливает фоновый поток и сбрасывает остаток."""
+        with self._cond:
+            if self._stopped:
+                return
+            self._stopped = True
+            thread = self._thread
+            self._cond.notify()
+        if thread is not None:
+            thread.join()
+        self.flush()
+        with self._cond:
+            lost = self._pending
+        if lost:
+            logger.error("Журнал аудита закрыт с несброшенными строками: %s", lost)
+
+    def stats(self):
+        with self._cond:
+            pending = self._pending
+        return {
+            "pending": pending,
+            "flushes": self.flushes,
+            "flushed_rows": self.flushed_rows,
+            "failed_flushes": self.failed_flushes,
+            "rejected_rows": self.rejected_rows,
+        }
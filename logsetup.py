@@ -0,0 +1,141 @@
+import atexit
+import datetime
+import json
+import logging
+import queue
+import sys
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+# Настройка логирования бота. Обработчик корневого логгера только кладет
+# запись в очередь; форматирование и запись в поток/файл выполняет фоновый
+# QueueListener, поэтому медленный приемник логов не задерживает команды.
+# Сообщения передаются в %-стиле (logger.info("... %s", x)) и собираются
+# уже в фоновом потоке.
+
+LOGGING = {
+    'level': 'INFO',            # уровень корневого логгера
+    'levels': {                 # уровни отдельных модулей
+        'db': 'INFO',
+        'main': 'INFO',
+        'querylog': 'WARNING',
+    },
+    'json': True,               # JSON-строка на запись; False — обычный текст
+    'filename': None,           # писать в файл вместо stderr
+    'queue_size': 10000,        # записей в очереди; лишние отбрасываются
+}
+
+# Поля, которые обработчики передают через extra= и которые попадают в JSON
+RECORD_FIELDS = ("command", "vk_id", "duration")
+
+TEXT_FORMAT = '%(asctime)s - %(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись: время, уровень, логгер, сообщение и поля RECORD_FIELDS."""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in RECORD_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _LazyQueueHandler(QueueHandler):
+    """QueueHandler без форматирования на вызывающем потоке.
+
+    Стандартный prepare() собирает сообщение до постановки в очередь; здесь
+    запись уходит как есть — очередь внутрипроцессная, и сообщение
+    соберет поток QueueListener. Переполненная очередь не блокирует
+    вызывающего: запись отбрасывается и учитывается в dropped.
+    """
+
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener = None
+_handler = None
+_lock = threading.Lock()
+
+
+def setup_logging(config=None, force=False):
+    """Подключает очередь логов к корневому логгеру и запускает фоновый поток записи.
+
+    Как и logging.basicConfig, ничего не делает, если у корневого логгера
+    уже есть обработчики (если не передан force=True). Возвращает
+    QueueListener или None.
+    """
+    global _listener, _handler
+    config = dict(LOGGING, **(config or {}))
+    root = logging.getLogger()
+    with _lock:
+        if _listener is not None and not force:
+            return _listener
+        if root.handlers and not force:
+            return None
+        if _listener is not None:
+            _stop_locked()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+
+        if config['filename']:
+            target = logging.FileHandler(config['filename'], encoding="utf-8")
+        else:
+            target = logging.StreamHandler(sys.stderr)
+        target.setFormatter(JsonFormatter() if config['json'] else logging.Formatter(TEXT_FORMAT))
+
+        records = queue.Queue(config['queue_size'])
+        _handler = _LazyQueueHandler(records)
+        root.addHandler(_handler)
+        root.setLevel(config['level'])
+        for name, level in config['levels'].items():
+            logging.getLogger(name).setLevel(level)
+
+        _listener = QueueListener(records, target, respect_handler_level=True)
+        _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+def _stop_locked():
+    global _listener, _handler
+    logging.getLogger().removeHandler(_handler)
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener, _handler = None, None
+
+
+def stop_logging():
+    """Дописывает записи из очереди и останавливает фоновый поток."""
+    with _lock:
+        if _listener is not None:
+            _stop_locked()
+
+
+def stats():
+    """Состояние очереди логов."""
+    with _lock:
+        if _handler is None:
+            return {"queued": 0, "dropped": 0}
+        return {"queued": _handler.queue.qsize(), "dropped": _handler.dropped}
@@ -1,85 +1,162 @@
 import logging
+import math
 import re
-from db import get_user_data, update_user_balance, log_user_activity, get_user_activity, get_transaction_history, delete_user_account, get_all_users
+import time
+import types
+import metrics
+from logsetup import setup_logging
+from ratelimit import get_rate_limiter, RateLimited
+from replies import render_users_messages, render_activity_page, render_transactions_page
+from storage import (get_storage, check_amount, UserNotFoundError, InsufficientFundsError, IdempotencyConflictError,
+                     UnitOfWorkAborted)
 from utils import is_valid_vk_id, is_valid_username
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+# Настройка логирования: запись идет в фоновом потоке (см. logsetup.LOGGING)
+setup_logging()
+logger = logging.getLogger(__name__)
+
+def _get_user(user_id, session):
+    try:
+        return get_storage().get_user(user_id, session=session)
+    except Exception as e:
+        logger.error("Ошибка при получении данных пользователя %s: %s", user_id, e)
+        return None
+
+def _log_activity(user_id, action_type, details, session):
+    try:
+        get_storage().log_activity(user_id, action_type, details, session=session)
+    except Exception as e:
+        logger.error("Ошибка при записи действия пользователя %s: %s", user_id, e)
 
 # Функция обработки команды /start
-def start_command(user_id):
+def start_command(user_id, session=None):
     """Обработчик команды /start."""
-    logging.info(f"Команда /start для пользователя {user_id}")
-    user_data = get_user_data(user_id)
+    logger.info("Команда /start для пользователя %s", user_id)
+    user_data = _get_user(user_id, session)
     if user_data:
         return f"👋 Привет, {user_data['username']}! Ваш баланс: {user_data['balance']}."
     else:
         return "❌ Пользователь не найден."
 
 # Функция обработки команды /balance
-def balance_command(user_id):
+def balance_command(user_id, session=None):
     """Обработчик команды /balance."""
-    logging.info(f"Команда /balance для пользователя {user_id}")
-    user_data = get_user_data(user_id)
+    logger.info("Команда /balance для пользователя %s", user_id)
+    user_data = _get_user(user_id, session)
     if user_data:
         return f"💰 Ваш баланс: {user_data['balance']}."
     else:
         return "❌ Пользователь не найден."
 
 # Функция обработки команды /deposit
-def deposit_command(user_id, amount):
-    """Обработчик команды /deposit для пополнения счета."""
-    logging.info(f"Пополнение счета пользователя {user_id} на {amount} рублей")
-    user_data = get_user_data(user_id)
-    if user_data:
-        new_balance = update_user_balance(user_id, amount)
-        log_user_activity(user_id, "Пополнение", f"Пополнение на {amount} рублей.")
-        return f"✅ Баланс пополнен! Новый баланс: {new_balance}."
-    else:
+def deposit_command(user_id, amount, session=None, idempotency_key=None):
+    """Обработчик команды /deposit для пополнения счета.
+
+    Повтор с тем же idempotency_key возвращает ответ первого пополнения и
+    не пишет действие в историю активности еще раз.
+    """
+    logger.info("Пополнение счета пользователя %s на %s рублей", user_id, amount)
+    try:
+        check_amount(amount)
+    except ValueError:
+        return "❌ Сумма пополнения должна быть положительным числом."
+    try:
+        result = get_storage().apply_balance_delta(user_id, amount, "deposit", f"Пополнение на {amount} рублей.",
+                                                   session=session, idempotency_key=idempotency_key)
+    except IdempotencyConflictError:
+        return "❌ Этот ключ уже использован для другой операции."
+    except UserNotFoundError:
         return "❌ Пользователь не найден."
+    except InsufficientFundsError:
+        return "❌ Недостаточно средств на счете."
+    except Exception as e:
+        logger.error("Ошибка при пополнении счета пользователя %s: %s", user_id, e)
+        return "❌ Ошибка при пополнении баланса. Попробуйте позже."
+    if not result.replayed:
+        _log_activity(user_id, "Пополнение", f"Пополнение на {amount} рублей.", session)
+    return f"✅ Баланс пополнен! Новый баланс: {result.balance}."
 
 # Функция обработки команды /withdraw
-def withdraw_command(user_id, amount):
-    """Обработчик команды /withdraw для снятия средств."""
-    logging.info(f"Снятие средств с баланса пользователя {user_id} на {amount} рублей")
-    user_data = get_user_data(user_id)
-    if user_data:
-        if user_data['balance'] >= amount:
-            new_balance = update_user_balance(user_id, -amount)
-            log_user_activity(user_id, "Снятие", f"Снятие на {amount} рублей.")
-            return f"✅ Средства сняты! Новый баланс: {new_balance}."
-        else:
-            return "❌ Недостаточно средств на счете."
-    else:
+def withdraw_command(user_id, amount, session=None, idempotency_key=None):
+    """Обработчик команды /withdraw для снятия средств.
+
+    Повтор с тем же idempotency_key возвращает ответ первого снятия и не
+    пишет действие в историю активности еще раз.
+    """
+    logger.info("Снятие средств с баланса пользователя %s на %s рублей", user_id, amount)
+    try:
+        check_amount(amount)
+    except ValueError:
+        return "❌ Сумма снятия должна быть положительным числом."
+    try:
+        result = get_storage().apply_balance_delta(user_id, -amount, "withdraw", f"Снятие на {amount} рублей.",
+                                                   session=session, idempotency_key=idempotency_key)
+    except IdempotencyConflictError:
+        return "❌ Этот ключ уже использован для другой операции."
+    except UserNotFoundError:
         return "❌ Пользователь не найден."
+    except InsufficientFundsError:
+        return "❌ Недостаточно средств на счете."
+    except Exception as e:
+        logger.error("Ошибка при снятии средств пользователя %s: %s", user_id, e)
+        return "❌ Ошибка при снятии средств. Попробуйте позже."
+    if not result.replayed:
+        _log_activity(user_id, "Снятие", f"Снятие на {amount} рублей.", session)
+    return f"✅ Средства сняты! Новый баланс: {result.balance}."
 
 # Функция обработки команды /history
-def history_command(user_id):
-    """Обработчик команды /history для получения истории транзакций."""
-    logging.info(f"Запрос истории транзакций пользователя {user_id}")
-    transactions = get_transaction_history(user_id)
-    return transactions if transactions else "❌ История транзакций пуста."
+def history_command(user_id, cursor=None, session=None):
+    """Обработчик команды /history: страница истории транзакций (cursor — с какого места)."""
+    logger.info("Запрос истории транзакций пользователя %s", user_id)
+    try:
+        transactions, next_cursor = get_storage().transactions_page(user_id, cursor=cursor, session=session)
+    except ValueError:
+        return "❌ Некорректный курсор страницы."
+    except Exception as e:
+        logger.error("Ошибка при получении истории транзакций пользователя %s: %s", user_id, e)
+        return "❌ Ошибка при получении истории транзакций."
+    return render_transactions_page(transactions, next_cursor, f"/history {user_id}")
 
 # Функция обработки команды /activity
-def activity_command(user_id):
-    """Обработчик команды /activity для получения истории активности пользователя."""
-    logging.info(f"Запрос истории активности пользователя {user_id}")
-    activities = get_user_activity(user_id)
-    return activities if activities else "❌ Нет активности для данного пользователя."
+def activity_command(user_id, cursor=None, session=None):
+    """Обработчик команды /activity: страница истории активности (cursor — с какого места)."""
+    logger.info("Запрос истории активности пользователя %s", user_id)
+    try:
+        activities, next_cursor = get_storage().activity_page(user_id, cursor=cursor, session=session)
+    except ValueError:
+        return "❌ Некорректный курсор страницы."
+    except Exception as e:
+        logger.error("Ошибка при получении активности пользователя %s: %s", user_id, e)
+        return "❌ Ошибка при получении активности пользователя."
+    return render_activity_page(activities, next_cursor, f"/activity {user_id}")
 
 # Функция обработки команды /delete_account
-def delete_account_command(user_id):
+def delete_account_command(user_id, session=None):
     """Обработчик команды /delete_account для удаления аккаунта."""
-    logging.info(f"Удаление аккаунта пользователя {user_id}")
-    result = delete_user_account(user_id)
-    return result
+    logger.info("Удаление аккаунта пользователя %s", user_id)
+    try:
+        get_storage().delete_user(user_id, session=session)
+    except Exception as e:
+        logger.error("Ошибка при удалении аккаунта пользователя %s: %s", user_id, e)
+        return "❌ Ошибка при удалении аккаунта пользователя."
+    return "✅ Аккаунт пользователя успешно удален."
 
 # Функция обработки команды /users
-def all_users_command():
-    """Обработчик команды /users для получения списка всех пользователей."""
-    logging.info("Запрос списка всех пользователей")
-    users = get_all_users()
-    return users if users else "❌ Нет пользователей в системе."
+def all_users_command(session=None):
+    """Обработчик команды /users: генератор сообщений со списком всех пользователей.
+
+    Список читается порциями на отдельном соединении уже после выхода из
+    единицы работы команды, поэтому сессия сюда не передается.
+    """
+    logger.info("Запрос списка всех пользователей")
+    return _iter_users_messages()
+
+def _iter_users_messages():
+    try:
+        yield from render_users_messages(get_storage().iter_user_chunks())
+    except Exception as e:
+        logger.error("Ошибка при выгрузке списка пользователей: %s", e)
+        yield "❌ Ошибка при получении списка пользователей."
 
 # Проверка валидности ID или username
 def validate_vk_user(identifier):
@@ -91,25 +168,117 @@ def validate_vk_user(identifier):
     else:
         return "❌ Невалидный идентификатор. Пожалуйста, укажите корректный VK ID или username."
 
+# Команды, по которым ведутся отдельные метрики; остальные — под меткой "other"
+COMMANDS = {"/start", "/balance", "/deposit", "/withdraw", "/history", "/activity", "/delete_account", "/users", "/validate"}
+
+def _command_label(command, *args):
+    return command if command in COMMANDS else "other"
+
 # Основной обработчик входящих команд
-def handle_command(command, *args):
-    """Обработчик команд."""
+@metrics.timed("command", label_of=_command_label)
+def handle_command(command, *args, sender_id=None):
+    """Обработчик команд: вся работа команды с хранилищем идет в одной транзакции.
+
+    Перед выполнением команда проходит ограничитель частоты (ratelimit) по
+    ключу sender_id — отправителю команды. Без sender_id ключом служит
+    args[0], а его выбирает сам отправитель (для /history это vk_id, чью
+    историю смотрят): перебирая id, можно обойти ведра. Команды без
+    аргументов (/users) без sender_id делят одно ведро на весь процесс, и
+    один частый отправитель задерживает их для всех.
+    """
+    started = time.perf_counter()
+    limiter_key = sender_id if sender_id is not None else (args[0] if args else None)
+    try:
+        try:
+            release = get_rate_limiter().acquire(limiter_key, command)
+        except RateLimited as e:
+            logger.warning("Команда %s отклонена ограничителем (%s)", command, e.reason,
+                           extra={"command": command, "vk_id": limiter_key})
+            return f"❌ Слишком много запросов. Повторите через {max(1, math.ceil(e.retry_after))} с."
+        if release is None:
+            return _run_in_unit(command, *args)
+        try:
+            reply = _run_in_unit(command, *args)
+        except BaseException:
+            release()
+            raise
+        if isinstance(reply, types.GeneratorType):
+            # /users отдает сообщения лениво: слот занят, пока их читают
+            return _Releasing(reply, release)
+        release()
+        return reply
+    finally:
+        duration = time.perf_counter() - started
+        logger.info("Команда %s выполнена за %.1f мс", command, duration * 1000,
+                    extra={"command": command, "vk_id": args[0] if args else None, "duration": duration})
+
+def _run_in_unit(command, *args):
+    """Выполняет команду в единице работы.
+
+    Если транзакцию откатили из-за ошибки SQL, которую перехватил
+    обработчик (например, _log_activity), вместо его ответа об успехе
+    возвращается ответ об ошибке: изменения команды не сохранены.
+    """
+    try:
+        with get_storage().unit_of_work() as session:
+            return dispatch_command(session, command, *args)
+    except UnitOfWorkAborted as e:
+        logger.error("Команда %s не выполнена: %s", command, e)
+        return "❌ Команда не выполнена из-за ошибки базы данных. Попробуйте позже."
+
+class _Releasing:
+    """Генератор сообщений, который освобождает слот ограничителя, когда его дочитали,
+    закрыли или выбросили непрочитанным."""
+
+    def __init__(self, messages, release):
+        self._messages = messages
+        self._release = release
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._messages)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        release, self._release = self._release, None
+        if release is not None:
+            self._messages.close()
+            release()
+
+    __del__ = close
+
+def _parse_amount(text):
+    """Сумма из аргумента команды; нечисловой текст дает NaN, который отклонит check_amount."""
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return math.nan
+
+def dispatch_command(session, command, *args):
+    """Вызывает обработчик команды в рамках переданной сессии."""
     if command == "/start":
-        return start_command(args[0])
+        return start_command(args[0], session=session)
     elif command == "/balance":
-        return balance_command(args[0])
+        return balance_command(args[0], session=session)
     elif command == "/deposit":
-        return deposit_command(args[0], float(args[1]))
+        return deposit_command(args[0], _parse_amount(args[1]), session=session,
+                               idempotency_key=args[2] if len(args) > 2 else None)
     elif command == "/withdraw":
-        return withdraw_command(args[0], float(args[1]))
+        return withdraw_command(args[0], _parse_amount(args[1]), session=session,
+                                idempotency_key=args[2] if len(args) > 2 else None)
     elif command == "/history":
-        return history_command(args[0])
+        return history_command(args[0], args[1] if len(args) > 1 else None, session=session)
     elif command == "/activity":
-        return activity_command(args[0])
+        return activity_command(args[0], args[1] if len(args) > 1 else None, session=session)
     elif command == "/delete_account":
-        return delete_account_command(args[0])
+        return delete_account_command(args[0], session=session)
     elif command == "/users":
-        return all_users_command()
+        return all_users_command(session=session)
     elif command == "/validate":
         return validate_vk_user(args[0])
     else:
@@ -125,5 +294,6 @@ if __name__ == "__main__":
     print(handle_command("/history", user_id))  # Команда /history
     print(handle_command("/activity", user_id))  # Команда /activity
     print(handle_command("/delete_account", user_id))  # Команда /delete_account
-    print(handle_command("/users"))  # Команда /users
+    for message in handle_command("/users"):  # Команда /users
+        print(message)
     print(handle_command("/validate", "username"))  # Команда /validate
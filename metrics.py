@@ -0,0 +1,364 @@
+import bisect
+import functools
+import inspect
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Метрики вызовов: число вызовов, ошибок, возвращенных строк и гистограмма
+# времени выполнения для команд main.handle_command и функций db/storage.
+# Вызов только добавляет свое время в список, без блокировок; в гистограмму
+# образцы сворачиваются пачками, поэтому пока endpoint никто не опрашивает,
+# накладные расходы — доли микросекунды на вызов. Квантили оцениваются по
+# корзинам гистограммы.
+#
+# snapshot() отдает метрики словарем, serve() поднимает локальный
+# HTTP endpoint в формате Prometheus (GET /metrics; /metrics.json — снимок).
+
+METRICS = {
+    'enabled': True,
+    'host': '127.0.0.1',
+    'port': 9108,
+}
+
+# Верхние границы корзин, секунды: от 1 мкс до 10 с
+LATENCY_BUCKETS = (
+    0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+_BUCKETS_NS = tuple(int(bound * 1e9) for bound in LATENCY_BUCKETS)
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+FOLD_EVERY = 1024       # образцов, после которых вызов сворачивает их в гистограмму
+
+# Ответ-строка с таким началом — ошибка, которую функция перехватила сама
+ERROR_REPLY_PREFIX = "❌ Ошибка"
+
+# Название семейства метрик в Prometheus и имя его метки
+KINDS = {
+    "command": ("bot_command", "command"),
+    "db": ("bot_db_call", "function"),
+    "storage": ("bot_storage_call", "method"),
+    "sql": ("bot_sql_sampled", "query"),
+    "db_pool": ("bot_db_pool", "event"),
+}
+
+
+class CallStats:
+    """Счетчики и гистограмма времени одного вызываемого объекта.
+
+    Горячий путь только добавляет время вызова (нс) в список samples —
+    list.append атомарен под GIL и не требует блокировки. В гистограмму
+    образцы сворачиваются пачками по FOLD_EVERY и перед каждым снимком.
+    Строки и ошибки пишутся в flagged только у вызовов, где они есть.
+    """
+
+    __slots__ = ("samples", "flagged", "calls", "errors", "rows", "total", "counts", "_lock")
+
+    def __init__(self):
+        self.samples = []
+        self.flagged = []
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._drain()
+            self.calls = 0
+            self.errors = 0
+            self.rows = 0
+            self.total = 0
+            self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def _drain(self):
+        # del по срезу атомарен: образцы, добавленные во время свертки, остаются в списке
+        count = len(self.samples)
+        samples = self.samples[:count]
+        del self.samples[:count]
+        count = len(self.flagged)
+        flagged = self.flagged[:count]
+        del self.flagged[:count]
+        return samples, flagged
+
+    def fold(self):
+        with self._lock:
+            samples, flagged = self._drain()
+            for elapsed in samples:
+                self.counts[bisect.bisect_left(_BUCKETS_NS, elapsed)] += 1
+            self.calls += len(samples)
+            self.total += sum(samples)
+            for rows, error in flagged:
+                self.rows += rows
+                self.errors += error
+
+    def observe(self, elapsed_ns, rows=0, error=False):
+        if rows or error:
+            self.flagged.append((rows, bool(error)))
+        self.samples.append(elapsed_ns)
+        if len(self.samples) >= FOLD_EVERY:
+            self.fold()
+
+    def observe_result(self, elapsed_ns, result):
+        self.observe(elapsed_ns, count_rows(result), is_error_reply(result))
+
+    def copy(self):
+        """(calls, errors, rows, total секунд, counts) после свертки накопленных образцов."""
+        self.fold()
+        with self._lock:
+            return self.calls, self.errors, self.rows, self.total / 1e9, list(self.counts)
+
+
+def quantile(counts, q):
+    """Оценка квантиля по корзинам: линейная интерполяция внутри корзины."""
+    total = sum(counts)
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for index, count in enumerate(counts):
+        if count and seen + count >= rank:
+            lower = LATENCY_BUCKETS[index - 1] if index else 0.0
+            if index == len(LATENCY_BUCKETS):
+                return lower
+            return lower + (LATENCY_BUCKETS[index] - lower) * (rank - seen) / count
+        seen += count
+    return LATENCY_BUCKETS[-1]
+
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def get_stats(kind, label):
+    """Возвращает CallStats для (kind, label), создавая при первом обращении."""
+    stats = _stats.get((kind, label))
+    if stats is None:
+        with _stats_lock:
+            stats = _stats.setdefault((kind, label), CallStats())
+    return stats
+
+
+def reset():
+    """Обнуляет все метрики (для тестов и замеров)."""
+    with _stats_lock:
+        items = list(_stats.values())
+    for stats in items:
+        stats.clear()
+
+
+def count_rows(result):
+    """Число строк в результате: список строк или пара (строки, курсор) страницы истории."""
+    if type(result) is list:
+        return len(result)
+    if type(result) is tuple and len(result) == 2 and type(result[0]) is list:
+        return len(result[0])
+    return 0
+
+
+def is_error_reply(result):
+    return type(result) is str and result.startswith(ERROR_REPLY_PREFIX)
+
+
+_now_ns = time.perf_counter_ns
+
+
+def _timed_generator(stats, func, args, kwargs):
+    # Учитывается только время внутри генератора, а не время потребителя
+    elapsed, rows, error = 0, 0, False
+    started = _now_ns()
+    try:
+        iterator = func(*args, **kwargs)
+        elapsed += _now_ns() - started
+        while True:
+            started = _now_ns()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                elapsed += _now_ns() - started
+                return
+            elapsed += _now_ns() - started
+            rows += len(item) if type(item) is list else 0
+            error = error or is_error_reply(item)
+            yield item
+    except BaseException as e:
+        error = not isinstance(e, GeneratorExit)
+        raise
+    finally:
+        stats.observe(elapsed, rows, error)
+
+
+def timed(kind, label=None, label_of=None):
+    """Декоратор: записывает время, ошибки и строки каждого вызова.
+
+    label — метка метрики (по умолчанию имя функции); label_of(*args) —
+    метка по аргументам вызова, например по команде. Ошибкой считается
+    исключение или ответ, начинающийся с ERROR_REPLY_PREFIX.
+    """
+    def decorate(func):
+        if not METRICS['enabled']:
+            return func
+        fixed = get_stats(kind, label or func.__name__) if label_of is None else None
+
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                stats = fixed or get_stats(kind, label_of(*args))
+                return _timed_generator(stats, func, args, kwargs)
+            return generator_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            stats = fixed or get_stats(kind, label_of(*args))
+            started = _now_ns()
+            try:
+                result = func(*args, **kwargs)
+            except BaseException:
+                stats.observe(_now_ns() - started, error=True)
+                raise
+            stats.observe_result(_now_ns() - started, result)
+            return result
+
+        if fixed is not None:
+            # Горячий путь без поиска метрики и без лишних вызовов
+            samples, observe_result = fixed.samples, fixed.observe_result
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                started = _now_ns()
+                try:
+                    result = func(*args, **kwargs)
+                except BaseException:
+                    fixed.observe(_now_ns() - started, error=True)
+                    raise
+                elapsed = _now_ns() - started
+                result_type = type(result)
+                if result_type is list or result_type is tuple or result_type is str:
+                    observe_result(elapsed, result)
+                else:
+                    samples.append(elapsed)
+                    if len(samples) >= FOLD_EVERY:
+                        fixed.fold()
+                return result
+        return wrapper
+    return decorate
+
+
+def instrument(namespace, kind, exclude=()):
+    """Оборачивает timed() все публичные функции модуля или методы класса.
+
+    Уже обернутые функции (например, @contextmanager) пропускаются: их
+    время — это время блока with, а не самой функции. Внутренние вызовы
+    модуля идут через его глобальные имена, поэтому тоже учитываются.
+    """
+    if not METRICS['enabled']:
+        return
+    is_class = inspect.isclass(namespace)
+    module_name = namespace.__module__ if is_class else namespace.__name__
+    for name, value in list(vars(namespace).items()):
+        if name.startswith("_") or name in exclude or not inspect.isfunction(value):
+            continue
+        if value.__module__ != module_name or hasattr(value, "__wrapped__"):
+            continue
+        label = f"{namespace.__name__}.{name}" if is_class else name
+        setattr(namespace, name, timed(kind, label)(value))
+
+
+def snapshot():
+    """Снимок метрик: {kind: {label: {calls, errors, rows, avg, p50, p95, p99}}}, время в секундах."""
+    with _stats_lock:
+        items = list(_stats.items())
+    result = {}
+    for (kind, label), stats in sorted(items):
+        calls, errors, rows, total, counts = stats.copy()
+        entry = {"calls": calls, "errors": errors, "rows": rows, "avg": total / calls if calls else None}
+        for q in QUANTILES:
+            entry[f"p{int(q * 100)}"] = quantile(counts, q)
+        result.setdefault(kind, {})[label] = entry
+    return result
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render_prometheus():
+    """Метрики в текстовом формате Prometheus 0.0.4."""
+    with _stats_lock:
+        items = list(_stats.items())
+    families = {}
+    for (kind, label), stats in sorted(items):
+        families.setdefault(kind, []).append((label, stats.copy()))
+
+    lines = []
+    for kind, entries in families.items():
+        family, label_name = KINDS.get(kind, (f"bot_{kind}", "name"))
+        lines.append(f"# HELP {family}_seconds Время выполнения, секунды")
+        lines.append(f"# TYPE {family}_seconds histogram")
+        for label, (calls, _, _, total, counts) in entries:
+            tag = f'{label_name}="{_escape(label)}"'
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, counts):
+                cumulative += count
+                lines.append(f'{family}_seconds_bucket{{{tag},le="{bound}"}} {cumulative}')
+            lines.append(f'{family}_seconds_bucket{{{tag},le="+Inf"}} {calls}')
+            lines.append(f"{family}_seconds_sum{{{tag}}} {total}")
+            lines.append(f"{family}_seconds_count{{{tag}}} {calls}")
+        for suffix, index, help_text in (("errors", 1, "Вызовы с ошибкой"), ("rows", 2, "Возвращено строк")):
+            lines.append(f"# HELP {family}_{suffix}_total {help_text}")
+            lines.append(f"# TYPE {family}_{suffix}_total counter")
+            for label, values in entries:
+                lines.append(f'{family}_{suffix}_total{{{label_name}="{_escape(label)}"}} {values[index]}')
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path in ("/metrics", "/"):
+            body, content_type = render_prometheus(), "text/plain; version=0.0.4; charset=utf-8"
+        elif self.path == "/metrics.json":
+            body, content_type = json.dumps(snapshot(), ensure_ascii=False), "application/json; charset=utf-8"
+        else:
+            self.send_error(404)
+            return
+        data = body.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug("metrics: " + format, *args)
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def serve(host=None, port=None):
+    """Запускает HTTP endpoint метрик в фоновом потоке (один на процесс); возвращает сервер."""
+    global _server
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((host or METRICS['host'], METRICS['port'] if port is None else port),
+                                          _MetricsHandler)
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, name="metrics-http", daemon=True).start()
+            logger.info("Метрики доступны на http://%s:%s/metrics", *_server.server_address[:2])
+    return _server
+
+
+def stop():
+    """Останавливает HTTP endpoint метрик."""
+    global _server
+    with _server_lock:
+        server, _server = _server, None
+    if server is not None:
+        server.shutdown()
+        server.server_close()
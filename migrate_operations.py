@@ -0,0 +1,200 @@
+import argparse
+import json
+import logging
+import time
+
+from psycopg2 import sql
+
+import db
+import schema
+
+logger = logging.getLogger(__name__)
+
+# Онлайн-миграция operations на индексированную колонку vk_id. Старый
+# record_operation хранил id пользователя только в тексте details
+# ("vk_id: 123 - ..."), старый get_operations искал его через
+# details LIKE '%vk_id: 123%' — полный проход по таблице и ложные совпадения
+# (123 и 1234). Шаги:
+#   1. добавить колонку vk_id (без значения по умолчанию — мгновенно);
+#   2. заполнить ее пачками по id с сохранением прогресса в migration_progress
+#      (прерванный запуск продолжается с последней пачки);
+#   3. построить индекс (vk_id, created_at, id) через CREATE INDEX CONCURRENTLY;
+#   4. дозаполнить строки, записанные старым кодом во время миграции.
+
+MIGRATION_NAME = "operations_vk_id"
+INDEX_NAME = "operations_vk_id_created_at_id_idx"
+LEGACY_DETAILS_PATTERN = r"^vk_id: (\S+) - "
+
+PROGRESS_DDL = """
+    CREATE TABLE IF NOT EXISTS migration_progress (
+        name text PRIMARY KEY,
+        watermark text,
+        rows_done bigint NOT NULL DEFAULT 0,
+        finished boolean NOT NULL DEFAULT false,
+        updated_at timestamptz NOT NULL DEFAULT now()
+    )
+"""
+
+SAVE_PROGRESS_SQL = """
+    INSERT INTO migration_progress (name, watermark, rows_done, finished, updated_at)
+    VALUES (%(name)s, %(watermark)s, %(rows_done)s, %(finished)s, now())
+    ON CONFLICT (name) DO UPDATE
+    SET watermark = EXCLUDED.watermark, rows_done = EXCLUDED.rows_done,
+        finished = EXCLUDED.finished, updated_at = now()
+"""
+
+
+def add_vk_id_column(lock_timeout="5s"):
+    """Добавляет колонку operations.vk_id, не ожидая блокировку дольше lock_timeout."""
+    with db.db_cursor(transaction=True) as cursor:
+        cursor.execute(sql.SQL("SET LOCAL lock_timeout = {}").format(sql.Literal(lock_timeout)))
+        cursor.execute("ALTER TABLE operations ADD COLUMN IF NOT EXISTS vk_id text")
+        cursor.execute(PROGRESS_DDL)
+
+
+def _legacy_source(cursor):
+    """Выражение, из которого берется vk_id: колонка user_id (если есть) или текст details."""
+    cursor.execute(
+        "SELECT 1 FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND table_name = 'operations' AND column_name = 'user_id'"
+    )
+    parsed = sql.SQL("substring(o.details from %(pattern)s)")
+    if cursor.fetchone() is None:
+        return parsed
+    return sql.SQL("coalesce(o.user_id::text, {})").format(parsed)
+
+
+def load_progress():
+    """Возвращает (watermark, rows_done, finished) или (None, 0, False) для нового запуска."""
+    with db.db_cursor() as cursor:
+        cursor.execute(
+            "SELECT watermark, rows_done, finished FROM migration_progress WHERE name = %s",
+            [MIGRATION_NAME]
+        )
+        row = cursor.fetchone()
+    return tuple(row) if row else (None, 0, False)
+
+
+def backfill(batch_size=5000, pause=0.05, max_batches=None):
+    """Заполняет vk_id пачками по возрастанию id; возвращает число заполненных строк.
+
+    Каждая пачка — короткая транзакция: UPDATE не больше batch_size строк и
+    сохранение последнего id в migration_progress. Пауза между пачками
+    оставляет место рабочей нагрузке.
+    """
+    watermark, rows_done, finished = load_progress()
+    if finished:
+        return 0
+    filled_total = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        with db.db_cursor(transaction=True) as cursor:
+            source = _legacy_source(cursor)
+            after = sql.SQL("WHERE id > %(after)s") if watermark is not None else sql.SQL("")
+            cursor.execute(sql.SQL("""
+                WITH batch AS (
+                    SELECT id FROM operations {after} ORDER BY id LIMIT %(batch_size)s
+                ), filled AS (
+                    UPDATE operations o SET vk_id = {source}
+                    FROM batch
+                    WHERE o.id = batch.id AND o.vk_id IS NULL AND {source} IS NOT NULL
+                    RETURNING o.id
+                )
+                SELECT (SELECT id::text FROM batch ORDER BY id DESC LIMIT 1),
+                       (SELECT count(*) FROM filled)
+            """).format(after=after, source=source), {
+                "after": watermark, "batch_size": batch_size, "pattern": LEGACY_DETAILS_PATTERN,
+            })
+            last_id, filled = cursor.fetchone()
+            finished = last_id is None
+            if not finished:
+                watermark = last_id
+                rows_done += filled
+                filled_total += filled
+            cursor.execute(SAVE_PROGRESS_SQL, {
+                "name": MIGRATION_NAME, "watermark": watermark,
+                "rows_done": rows_done, "finished": finished,
+            })
+        if finished:
+            break
+        batches += 1
+        logger.info("Миграция %s: до id %s, заполнено строк %s", MIGRATION_NAME, watermark, rows_done)
+        if pause:
+            time.sleep(pause)
+    return filled_total
+
+
+def create_index():
+    """Строит индекс (vk_id, created_at, id) без блокировки записи.
+
+    CREATE INDEX CONCURRENTLY нельзя выполнять в транзакции, поэтому запрос
+    идет в autocommit.
+    """
+    with db.db_cursor() as cursor:
+        return schema.ensure_index(cursor, INDEX_NAME, "ON operations (vk_id, created_at, id)")
+
+
+def catch_up(batch_size=1000):
+    """Дозаполняет строки без vk_id, записанные старым кодом после прохода их id."""
+    filled_total = 0
+    while True:
+        with db.db_cursor(transaction=True) as cursor:
+            source = _legacy_source(cursor)
+            cursor.execute(sql.SQL("""
+                WITH batch AS (
+                    SELECT o.id FROM operations o WHERE o.vk_id IS NULL AND {source} IS NOT NULL
+                    LIMIT %(batch_size)s FOR UPDATE SKIP LOCKED
+                )
+                UPDATE operations o SET vk_id = {source} FROM batch WHERE o.id = batch.id
+            """).format(source=source), {"batch_size": batch_size, "pattern": LEGACY_DETAILS_PATTERN})
+            filled = cursor.rowcount
+        filled_total += filled
+        if filled < batch_size:
+            return filled_total
+
+
+def unmatched_rows():
+    """Число строк, для которых vk_id так и не удалось определить."""
+    with db.db_cursor() as cursor:
+        cursor.execute("SELECT count(*) FROM operations WHERE vk_id IS NULL")
+        return cursor.fetchone()[0]
+
+
+def run(batch_size=5000, pause=0.05):
+    """Выполняет все шаги миграции; повторный запуск продолжает с места остановки."""
+    started = time.perf_counter()
+    add_vk_id_column()
+    filled = backfill(batch_size=batch_size, pause=pause)
+    index_created = create_index()
+    caught_up = catch_up()
+    return {
+        "filled": filled,
+        "caught_up": caught_up,
+        "index_created": index_created,
+        "unmatched": unmatched_rows(),
+        "elapsed_s": round(time.perf_counter() - started, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Перенос vk_id из operations.details в индексированную колонку")
+    parser.add_argument("--batch-size", type=int, default=5000, help="строк в одной пачке")
+    parser.add_argument("--pause", type=float, default=0.05, help="пауза между пачками (сек)")
+    parser.add_argument("--dbname", default=None)
+    parser.add_argument("--host", default=None)
+    parser.add_argument("--user", default=None)
+    parser.add_argument("--password", default=None)
+    args = parser.parse_args()
+
+    for key in ("dbname", "host", "user", "password"):
+        if getattr(args, key) is not None:
+            db.DB_CONNECTION[key] = getattr(args, key)
+
+    logging.basicConfig(level=logging.INFO)
+    result = run(args.batch_size, args.pause)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    db.close_pool()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+import base64
+import datetime
+import json
+
+# Курсор страницы — непрозрачная строка с ключом (created_at, id) последней
+# показанной записи. Следующая страница начинается строго после него.
+
+
+def encode_cursor(created_at, row_id):
+    """Упаковывает ключ последней записи страницы в строку-курсор."""
+    if isinstance(created_at, (datetime.datetime, datetime.date)):
+        created_at = created_at.isoformat()
+    payload = json.dumps([created_at, row_id], separators=(",", ":"), default=str)
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(token):
+    """Распаковывает курсор в (created_at, id); ValueError, если курсор испорчен."""
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return datetime.datetime.fromisoformat(created_at), row_id
+    except Exception as e:
+        raise ValueError(f"Некорректный курсор страницы: {token!r}") from e
+
+
+def next_page_hint(next_cursor, next_command=None):
+    """Строка-подсказка о следующей странице (пустая, если страниц больше нет)."""
+    if not next_cursor:
+        return ""
+    if next_command:
+        return f"➡️ Следующая страница: {next_command} {next_cursor}\n"
+    return f"➡️ Курсор следующей страницы: {next_cursor}\n"
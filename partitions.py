@@ -0,0 +1,302 @@
+import argparse
+import datetime
+import json
+import logging
+import time
+
+from psycopg2 import sql
+
+import db
+import schema
+
+logger = logging.getLogger(__name__)
+
+# Помесячное секционирование журналов по created_at. operations,
+# user_activity, system_events и system_errors только растут, и каждый
+# запрос истории и каждый VACUUM платит за всю таблицу. После перевода на
+# секции горячими остаются индексы последних месяцев, а старые месяцы
+# отключаются целиком, без DELETE.
+#
+# Перевод существующей таблицы (convert_table) не копирует данные:
+#   1. на таблицу вешается CHECK (created_at < граница) NOT VALID и
+#      проверяется без блокировки записи; строится уникальный индекс
+#      (id, created_at) — без него у секционированной таблицы нет ключа;
+#   2. в короткой транзакции с lock_timeout таблица переименовывается в
+#      <имя>_legacy, создается секционированная <имя> с тем же набором
+#      колонок, старая таблица подключается секцией (MINVALUE, граница) —
+#      благодаря проверенному CHECK без прохода по данным, — а ее индексы
+#      подключаются к индексам родителя;
+#   3. создаются секции <имя>_pYYYYMM от границы на premake_months вперед.
+#
+# run_maintenance() (раз в сутки по cron) создает будущие секции и
+# отключает секции старше срока хранения: drop — удаляет, archive — переносит
+# в схему archive (оттуда их забирает archive.py). Операции отключенных
+# месяцев уже учтены в ledger_totals, поэтому инкрементальная сверка
+# reconcile.py продолжает работать; полный пересчет (--full) читает их из
+# схемы archive и архивных файлов (с drop строки пропадают насовсем).
+
+PARTITIONING = {
+    'premake_months': 3,        # сколько будущих месяцев держать созданными
+    'lock_timeout': '5s',       # ожидание блокировки при переводе таблицы
+    'archive_schema': 'archive',
+    'tables': {                 # срок хранения (месяцев, None — бессрочно) и что делать со старыми
+        'operations': {'retention_months': 12, 'action': 'archive'},
+        'user_activity': {'retention_months': 12, 'action': 'archive'},
+        'system_events': {'retention_months': 6, 'action': 'drop'},
+        'system_errors': {'retention_months': 6, 'action': 'drop'},
+    },
+}
+
+LEGACY_SUFFIX = "_legacy"
+# Граница старой секции не ближе этого к концу месяца: иначе строки успели бы
+# в следующий месяц между проверкой CHECK и переименованием
+MIN_LEGACY_MARGIN = datetime.timedelta(days=7)
+
+
+def month_start(moment, shift=0):
+    """Начало месяца moment (UTC), сдвинутое на shift месяцев."""
+    index = moment.year * 12 + moment.month - 1 + shift
+    return datetime.datetime(index // 12, index % 12 + 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def partition_name(table, start):
+    return f"{table}_p{start:%Y%m}"
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def table_indexes(table):
+    """Индексы таблицы из schema.MIGRATIONS (имя, определение)."""
+    prefix = f"ON {table} "
+    return [index for migration in schema.MIGRATIONS for index in migration.indexes
+            if index.definition.startswith(prefix)]
+
+
+def is_partitioned(cursor, table):
+    cursor.execute(
+        "SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s)", [table]
+    )
+    row = cursor.fetchone()
+    return bool(row and row[0])
+
+
+def list_partitions(cursor, table):
+    """Имена секций таблицы по возрастанию (старая <имя>_legacy — первой)."""
+    cursor.execute(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass(%s)",
+        [table]
+    )
+    names = [row[0] for row in cursor.fetchall()]
+    return sorted(names, key=lambda name: (not name.endswith(LEGACY_SUFFIX), name))
+
+
+def ensure_partitions(table, months_ahead=None, now=None):
+    """Создает секции от текущего месяца на months_ahead вперед; возвращает имена созданных."""
+    months_ahead = PARTITIONING['premake_months'] if months_ahead is None else months_ahead
+    now = now or _now()
+    created = []
+    with db.db_cursor() as cursor:
+        existing = set(list_partitions(cursor, table))
+        first = _first_monthly_start(cursor, table, existing)
+        for shift in range(months_ahead + 1):
+            start = month_start(now, shift)
+            name = partition_name(table, start)
+            if name in existing or (first is not None and start < first):
+                continue
+            cursor.execute(sql.SQL(
+                "CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s)"
+            ).format(sql.Identifier(name), sql.Identifier(table)), [start, month_start(start, 1)])
+            created.append(name)
+    return created
+
+
+def _first_monthly_start(cursor, table, partitions):
+    """Начало первой помесячной секции (верхняя граница <имя>_legacy) или None."""
+    legacy = f"{table}{LEGACY_SUFFIX}"
+    if legacy not in partitions:
+        return None
+    cursor.execute(
+        r"SELECT (regexp_match(pg_get_expr(relpartbound, oid), 'TO \(''([^'']+)''\)'))[1]::timestamptz "
+        "FROM pg_class WHERE oid = to_regclass(%s)",
+        [legacy]
+    )
+    return cursor.fetchone()[0]
+
+
+def _partition_end(cursor, table, name, partitions):
+    if name.endswith(LEGACY_SUFFIX):
+        return _first_monthly_start(cursor, table, partitions)
+    start = datetime.datetime.strptime(name[len(table) + 2:], "%Y%m").replace(tzinfo=datetime.timezone.utc)
+    return month_start(start, 1)
+
+
+def convert_table(table, now=None, lock_timeout=None):
+    """Переводит обычную таблицу на помесячные секции; False, если она уже секционирована."""
+    lock_timeout = lock_timeout or PARTITIONING['lock_timeout']
+    now = now or _now()
+    boundary = month_start(now, 1)
+    if boundary - now < MIN_LEGACY_MARGIN:
+        boundary = month_start(now, 2)
+    legacy = f"{table}{LEGACY_SUFFIX}"
+    check = f"{legacy}_range"
+    key_index = f"{legacy}_id_created_at_key"
+
+    with db.db_cursor() as cursor:
+        if is_partitioned(cursor, table):
+            return False
+        # Шаг 1: все, что требует прохода по таблице, — без блокировки записи
+        for index in table_indexes(table):
+            schema.ensure_index(cursor, index.name, index.definition)
+        cursor.execute(sql.SQL("CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} (id, created_at)").format(
+            sql.Identifier(key_index), sql.Identifier(table)
+        ))
+        cursor.execute(sql.SQL("ALTER TABLE {} DROP CONSTRAINT IF EXISTS {}").format(
+            sql.Identifier(table), sql.Identifier(check)
+        ))
+        cursor.execute(sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} CHECK (created_at < {}) NOT VALID").format(
+            sql.Identifier(table), sql.Identifier(check), sql.Literal(boundary)
+        ))
+        try:
+            cursor.execute(sql.SQL("ALTER TABLE {} VALIDATE CONSTRAINT {}").format(
+                sql.Identifier(table), sql.Identifier(check)
+            ))
+            _swap_to_partitioned(table, legacy, check, key_index, boundary, lock_timeout)
+        except Exception:
+            # CHECK без перевода остановил бы запись в следующем месяце
+            cursor.execute(sql.SQL("ALTER TABLE {} DROP CONSTRAINT IF EXISTS {}").format(
+                sql.Identifier(table), sql.Identifier(check)
+            ))
+            raise
+    ensure_partitions(table, now=now)
+    logger.info("Таблица %s переведена на помесячные секции с %s", table, format(boundary, "%Y-%m"))
+    return True
+
+
+def _swap_to_partitioned(table, legacy, check, key_index, boundary, lock_timeout):
+    """Шаг 2: переименование и подключение старой таблицы секцией в одной короткой транзакции."""
+    ident = sql.Identifier
+    sequence = f"{table}_id_seq"
+    with db.db_cursor(transaction=True) as cursor:
+        cursor.execute(sql.SQL("SET LOCAL lock_timeout = {}").format(sql.Literal(lock_timeout)))
+        cursor.execute(sql.SQL("LOCK TABLE {} IN ACCESS EXCLUSIVE MODE").format(ident(table)))
+        cursor.execute(sql.SQL("ALTER TABLE {} RENAME TO {}").format(ident(table), ident(legacy)))
+        # Идентичность колонки не переносится на секционированную таблицу:
+        # id берется из обычной последовательности, продолжающей старую
+        cursor.execute(sql.SQL("SELECT coalesce(max(id), 0) FROM {}").format(ident(legacy)))
+        last_id = cursor.fetchone()[0]
+        cursor.execute(sql.SQL("ALTER TABLE {} ALTER COLUMN id DROP IDENTITY IF EXISTS").format(ident(legacy)))
+        cursor.execute(sql.SQL("CREATE SEQUENCE IF NOT EXISTS {}").format(ident(sequence)))
+        cursor.execute("SELECT setval(%s, %s, false)", [sequence, last_id + 1])
+        # INCLUDING DEFAULTS: без него created_at DEFAULT now() пропал бы, и
+        # вставка без created_at не нашла бы секцию
+        cursor.execute(sql.SQL("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS) PARTITION BY RANGE (created_at)").format(
+            ident(table), ident(legacy)
+        ))
+        cursor.execute(sql.SQL("ALTER TABLE {} ALTER COLUMN id SET DEFAULT nextval({})").format(
+            ident(table), sql.Literal(sequence)
+        ))
+        cursor.execute(sql.SQL("ALTER SEQUENCE {} OWNED BY {}.id").format(ident(sequence), ident(table)))
+
+        # Индексы родителя создаются ON ONLY (мгновенно), индексы старой
+        # таблицы подключаются к ним; новые секции получают их при создании
+        indexes = [(f"{table}_id_created_at_key", f"ON {table} (id, created_at)", key_index, True)]
+        for index in table_indexes(table):
+            partition_index = f"{index.name}{LEGACY_SUFFIX}"
+            cursor.execute(sql.SQL("ALTER INDEX {} RENAME TO {}").format(ident(index.name), ident(partition_index)))
+            indexes.append((index.name, index.definition, partition_index, False))
+        for name, definition, _, unique in indexes:
+            cursor.execute(sql.SQL("CREATE {}INDEX {} {}").format(
+                sql.SQL("UNIQUE " if unique else ""), ident(name), sql.SQL(definition.replace("ON ", "ON ONLY ", 1))
+            ))
+        cursor.execute(sql.SQL("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM (MINVALUE) TO ({})").format(
+            ident(table), ident(legacy), sql.Literal(boundary)
+        ))
+        for name, _, partition_index, _ in indexes:
+            cursor.execute(sql.SQL("ALTER INDEX {} ATTACH PARTITION {}").format(ident(name), ident(partition_index)))
+        cursor.execute(sql.SQL("ALTER TABLE {} DROP CONSTRAINT {}").format(ident(legacy), ident(check)))
+
+
+def apply_retention(table, now=None):
+    """Отключает секции, целиком вышедшие за срок хранения; возвращает их имена.
+
+    DETACH ... CONCURRENTLY не блокирует запись в таблицу. Строки
+    отключенных секций operations переходят в счетчики archived:operations:<тип>.
+    """
+    policy = PARTITIONING['tables'][table]
+    if not policy['retention_months']:
+        return []
+    cutoff = month_start(now or _now(), -policy['retention_months'])
+    archive_schema = PARTITIONING['archive_schema']
+    detached = []
+    with db.db_cursor() as cursor:
+        partitions = list_partitions(cursor, table)
+        for name in partitions:
+            end = _partition_end(cursor, table, name, partitions)
+            if end is None or end > cutoff:
+                continue
+            cursor.execute(sql.SQL("ALTER TABLE {} DETACH PARTITION {} CONCURRENTLY").format(
+                sql.Identifier(table), sql.Identifier(name)
+            ))
+            # DETACH CONCURRENTLY не выполняется в транзакции, поэтому строки
+            # секции учитываются в счетчиках в одной транзакции с ее удалением
+            # или переносом
+            with db.db_cursor(transaction=True) as tx:
+                if table == "operations":
+                    db.count_archived_operations(tx, sql.Identifier(name))
+                if policy['action'] == 'drop':
+                    tx.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(name)))
+                else:
+                    tx.execute(sql.SQL("CREATE SCHEMA IF NOT EXISTS {}").format(sql.Identifier(archive_schema)))
+                    tx.execute(sql.SQL("ALTER TABLE {} SET SCHEMA {}").format(
+                        sql.Identifier(name), sql.Identifier(archive_schema)
+                    ))
+            logger.info("Секция %s отключена (%s)", name, policy['action'])
+            detached.append(name)
+    return detached
+
+
+def run_maintenance(convert=False, now=None):
+    """Создает будущие секции и применяет сроки хранения для всех таблиц PARTITIONING."""
+    started = time.perf_counter()
+    result = {}
+    for table in PARTITIONING['tables']:
+        with db.db_cursor() as cursor:
+            partitioned = is_partitioned(cursor, table)
+        if not partitioned:
+            if not convert:
+                result[table] = {"partitioned": False}
+                continue
+            convert_table(table, now=now)
+        result[table] = {
+            "partitioned": True,
+            "created": ensure_partitions(table, now=now),
+            "detached": apply_retention(table, now=now),
+        }
+    result["elapsed_s"] = round(time.perf_counter() - started, 3)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Помесячные секции журналов и сроки их хранения")
+    parser.add_argument("--convert", action="store_true", help="перевести несекционированные таблицы")
+    parser.add_argument("--dbname", default=None)
+    parser.add_argument("--host", default=None)
+    parser.add_argument("--user", default=None)
+    parser.add_argument("--password", default=None)
+    args = parser.parse_args()
+
+    for key in ("dbname", "host", "user", "password"):
+        if getattr(args, key) is not None:
+            db.DB_CONNECTION[key] = getattr(args, key)
+
+    logging.basicConfig(level=logging.INFO)
+    result = run_maintenance(convert=args.convert)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    db.close_pool()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    """Не удалось получить соединение из пула за отведенное время."""
+
+
+class ConnectionPool:
+    """Потокобезопасный пул соединений с PostgreSQL.
+
+    Соединения выдаются в режиме autocommit: одиночный запрос не требует
+    отдельного COMMIT. Перед выдачей соединение проверяется, а по истечении
+    max_lifetime пересоздается.
+    """
+
+    def __init__(self, connect_kwargs, minconn=1, maxconn=10, max_lifetime=1800.0,
+                 health_check_after=30.0, timeout=5.0):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("Некорректные размеры пула: minconn=%s, maxconn=%s" % (minconn, maxconn))
+        self.connect_kwargs = dict(connect_kwargs)
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.max_lifetime = max_lifetime
+        self.health_check_after = health_check_after
+        self.timeout = timeout
+
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = deque()      # (conn, last_used) — свободные соединения, LIFO
+        self._created = {}        # id(conn) -> время создания
+        self._size = 0            # выдано + свободно + создается
+        self._closed = False
+        self._prefilled = False
+
+    # --- создание и проверка соединений ---
+
+    def _connect(self):
+        conn = psycopg2.connect(**self.connect_kwargs)
+        conn.autocommit = True
+        return conn
+
+    def _discard(self, conn):
+        """Закрывает соединение и освобождает место в пуле (вызывать под блокировкой)."""
+        self._created.pop(id(conn), None)
+        self._size -= 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _expired(self, conn, now):
+        created = self._created.get(id(conn))
+        return created is None or now - created > self.max_lifetime
+
+    def _is_healthy(self, conn, last_used, now):
+        if conn.closed:
+            return False
+        if now - last_used < self.health_check_after:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            return True
+        except Exception as e:
+            logger.warning("Соединение из пула не прошло проверку: %s", e)
+            return False
+
+    def _prefill(self):
+        """Открывает minconn соединений при первом обращении к пулу.
+
+        Места резервируются под блокировкой, а соединения открываются вне
+        ее, как и в getconn.
+        """
+        with self._cond:
+            if self._prefilled:
+                return
+            self._prefilled = True
+            missing = max(0, self.minconn - self._size)
+            self._size += missing
+        opened = []
+        try:
+            for _ in range(missing):
+                opened.append(self._connect())
+        finally:
+            with self._cond:
+                self._size -= missing - len(opened)
+                now = time.monotonic()
+                for conn in opened:
+                    self._created[id(conn)] = now
+                    if self._closed:
+                        self._discard(conn)
+                    else:
+                        self._idle.append((conn, now))
+                self._cond.notify_all()
+
+    # --- выдача и возврат ---
+
+    def getconn(self, timeout=None):
+        """Выдает соединение из пула, при необходимости создавая новое.
+
+        Под блокировкой соединение только берется из списка свободных (или
+        резервируется место для нового); проверка SELECT 1 и открытие
+        соединения идут вне ее, чтобы выдачи не ждали чужой сетевой запрос.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        if not self._prefilled:
+            self._prefill()
+        while True:
+            conn = None
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise psycopg2.InterfaceError("Пул соединений закрыт")
+                    now = time.monotonic()
+                    if self._idle:
+                        conn, last_used = self._idle.pop()
+                        if self._expired(conn, now):
+                            self._discard(conn)
+                            conn = None
+                            continue
+                        break
+                    if self._size < self.maxconn:
+                        self._size += 1
+                        break
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        raise PoolTimeout(f"Нет свободных соединений за {timeout} с (maxconn={self.maxconn})")
+                    self._cond.wait(remaining)
+            if conn is None:
+                return self._open_reserved()
+            if self._is_healthy(conn, last_used, time.monotonic()):
+                return conn
+            with self._cond:
+                self._discard(conn)
+                self._cond.notify()
+
+    def _open_reserved(self):
+        """Открывает соединение на зарезервированное в getconn место."""
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._created[id(conn)] = time.monotonic()
+        return conn
+
+    def putconn(self, conn, discard=False):
+        """Возвращает соединение в пул; сломанные и устаревшие закрываются."""
+        if not discard and not conn.closed:
+            status = conn.get_transaction_status()
+            if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                discard = True
+            elif status != extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except Exception:
+                    discard = True
+            if not discard and not conn.autocommit:
+                try:
+                    conn.autocommit = True
+                except Exception:
+                    discard = True
+
+        with self._cond:
+            now = time.monotonic()
+            if discard or conn.closed or self._closed or self._expired(conn, now):
+                self._discard(conn)
+            else:
+                self._idle.append((conn, now))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """Контекстный менеджер: выдает соединение и гарантированно возвращает его в пул."""
+        conn = self.getconn(timeout)
+        try:
+            yield conn
+        except psycopg2.OperationalError:
+            # Соединение могло оборваться — не возвращаем его в оборот
+            self.putconn(conn, discard=True)
+            raise
+        except BaseException:
+            self.putconn(conn)
+            raise
+        else:
+            self.putconn(conn)
+
+    def closeall(self):
+        """Закрывает все свободные соединения; выданные закроются при возврате."""
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._discard(conn)
+            self._cond.notify_all()
+
+    def stats(self):
+        """Возвращает текущее состояние пула."""
+        with self._cond:
+            idle = len(self._idle)
+            return {"size": self._size, "idle": idle, "in_use": self._size - idle, "maxconn": self.maxconn}
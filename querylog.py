@@ -0,0 +1,197 @@
+import datetime
+import logging
+import random
+import re
+import threading
+import time
+from collections import deque
+
+import metrics
+
+# Журнал SQL-запросов. Курсоры db открываются с примесью LoggedCursorMixin:
+# каждый execute замеряется (два вызова perf_counter_ns), а полностью —
+# с нормализованным текстом, числом строк и ожиданием соединения — в
+# metrics (kind "sql") записывается только выборка sample_rate запросов,
+# плюс все медленные и все упавшие. Медленные попадают в журнал в памяти,
+# в лог и, если задан sink, пакетами в базу.
+
+logger = logging.getLogger(__name__)
+
+_now_ns = time.perf_counter_ns
+
+# Нормализация: значения заменяются на ?, длинные списки VALUES сворачиваются
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+_PLACEHOLDER = re.compile(r"%\(\w+\)s|%s")
+_VALUES_LIST = re.compile(r"\((?:\?, )*\?\)(?:, \((?:\?, )*\?\))+")
+_SPACES = re.compile(r"\s+")
+
+NORMALIZED_MAX_LENGTH = 1000
+
+
+def normalize_query(query, context=None):
+    """Текст запроса без значений: одинаковые запросы дают одинаковую строку.
+
+    query — строка, bytes или объект psycopg2.sql (для него нужен context —
+    соединение или курсор).
+    """
+    if isinstance(query, bytes):
+        text = query.decode("utf-8", "replace")
+    elif isinstance(query, str):
+        text = query
+    else:
+        text = query.as_string(context)
+    text = _STRING_LITERAL.sub("?", text)
+    text = _PLACEHOLDER.sub("?", text)
+    text = _NUMBER.sub("?", text)
+    text = _SPACES.sub(" ", text).strip()
+    text = _VALUES_LIST.sub("(...)", text)
+    return text[:NORMALIZED_MAX_LENGTH]
+
+
+class QueryLog:
+    """Статистика запросов и журнал медленных.
+
+    sample_rate — доля обычных запросов, попадающих в metrics;
+    slow_threshold — порог медленного запроса, секунды; sink(entry) —
+    необязательная запись медленных запросов и ошибок во внешнее
+    хранилище (вызывается на потоке запроса и должна быть быстрой).
+    """
+
+    def __init__(self, sample_rate=0.01, slow_threshold=0.5, sink=None, max_entries=1000):
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.sink = sink
+        self._slow_ns = int(slow_threshold * 1e9)
+        self._entries = deque(maxlen=max_entries)
+        self._local = threading.local()
+        self._normalized = {}
+        self.statements = 0
+        self.slow = 0
+        self.failed = 0
+
+    def observe(self, cursor, query, elapsed_ns, wait_ns, error=None):
+        """Вызывается курсором после каждого execute."""
+        self.statements += 1
+        if error is None and elapsed_ns < self._slow_ns and random.random() >= self.sample_rate:
+            return
+        rows = max(cursor.rowcount, 0) if error is None else 0
+        text = self._normalize(query, cursor)
+        metrics.get_stats("sql", text).observe(elapsed_ns, rows, error is not None)
+        if wait_ns:
+            metrics.get_stats("db_pool", "wait").observe(wait_ns)
+        if error is None and elapsed_ns < self._slow_ns:
+            return
+
+        entry = {
+            "query": text,
+            "duration": elapsed_ns / 1e9,
+            "rows": rows,
+            "connection_wait": wait_ns / 1e9,
+            "error": str(error).strip() if error is not None else None,
+            "created_at": datetime.datetime.now(datetime.timezone.utc),
+        }
+        self._entries.append(entry)
+        if error is None:
+            self.slow += 1
+            logger.warning("Медленный запрос (%.3f с, строк: %s): %s", entry['duration'], rows, text)
+        else:
+            self.failed += 1
+            logger.error("Ошибка запроса (%.3f с): %s — %s", entry['duration'], entry['error'], text)
+        if self.sink is not None and not getattr(self._local, "paused", False):
+            try:
+                self.sink(entry)
+            except Exception as e:
+                logger.error("Ошибка при записи медленного запроса: %s", e)
+
+    def _normalize(self, query, cursor):
+        key = query if isinstance(query, (str, bytes)) else None
+        text = self._normalized.get(key) if key is not None else None
+        if text is None:
+            text = normalize_query(query, cursor)
+            if key is not None:
+                if len(self._normalized) >= 10000:
+                    self._normalized.clear()
+                self._normalized[key] = text
+        return text
+
+    def paused(self):
+        """Контекст: запросы этого потока не передаются в sink (например, сама запись в sink)."""
+        return _Paused(self._local)
+
+    def entries(self, limit=None):
+        """Последние медленные и упавшие запросы, от новых к старым."""
+        entries = list(self._entries)[::-1]
+        return entries[:limit] if limit else entries
+
+    def stats(self):
+        return {
+            "statements": self.statements,
+            "slow": self.slow,
+            "failed": self.failed,
+            "sample_rate": self.sample_rate,
+            "slow_threshold": self.slow_threshold,
+        }
+
+
+class _Paused:
+    def __init__(self, local):
+        self.local = local
+
+    def __enter__(self):
+        self.previous = getattr(self.local, "paused", False)
+        self.local.paused = True
+
+    def __exit__(self, *exc):
+        self.local.paused = self.previous
+
+
+class LoggedCursorMixin:
+    """Примесь к классу курсора psycopg2: передает каждый execute в query_log.
+
+    connection_wait — сколько ждали соединение (нс); учитывается у первого
+    запроса курсора.
+    """
+
+    query_log = None
+    connection_wait = 0
+
+    def _logged(self, method, query, *args):
+        log = self.query_log
+        if log is None:
+            return method(query, *args)
+        started = _now_ns()
+        try:
+            result = method(query, *args)
+        except Exception as e:
+            log.observe(self, query, _now_ns() - started, self.connection_wait, e)
+            self.connection_wait = 0
+            raise
+        log.observe(self, query, _now_ns() - started, self.connection_wait)
+        self.connection_wait = 0
+        return result
+
+    def execute(self, query, vars=None):
+        return self._logged(super().execute, query, vars)
+
+    def executemany(self, query, vars_list):
+        return self._logged(super().executemany, query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        return self._logged(super().copy_expert, sql, file, size)
+
+
+_logged_classes = {}
+_logged_lock = threading.Lock()
+
+
+def logged_cursor_factory(cursor_factory):
+    """Класс курсора cursor_factory с примесью LoggedCursorMixin (создается один раз)."""
+    logged = _logged_classes.get(cursor_factory)
+    if logged is None:
+        with _logged_lock:
+            logged = _logged_classes.get(cursor_factory)
+            if logged is None:
+                logged = type(f"Logged{cursor_factory.__name__}", (LoggedCursorMixin, cursor_factory), {})
+                _logged_classes[cursor_factory] = logged
+    return logged
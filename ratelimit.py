@@ -0,0 +1,257 @@
+import heapq
+import threading
+import time
+from collections import Counter
+
+# Ограничение частоты команд перед main.handle_command. У каждого
+# пользователя общее ведро токенов на все команды и отдельные ведра на
+# команды из 'commands'; дорогие команды ('expensive') дополнительно
+# ограничены числом одновременно выполняемых на весь процесс. У команд без
+# пользователя (/users) вместо ведра пользователя — ведро на команду.
+# Команда, которой не досталось слота, возвращает забранные токены.
+#
+# mode "reject" сразу отказывает, "queue" ждет токен или слот не дольше
+# max_wait секунд (в потоке команды). Ведра разложены по LOCK_STRIPES
+# блокировкам по хэшу пользователя, поэтому разные пользователи не ждут
+# друг друга. Полное ведро ничем не отличается от нового, поэтому раз в
+# sweep_interval такие ведра удаляются; если ведер все равно больше
+# max_buckets, самые полные удаляются до доли SWEEP_LOW_WATER от
+# max_buckets — следующие новые ведра не запускают очистку сразу же.
+#
+# Ключ пользователя — тот, что передал вызывающий (main.handle_command:
+# sender_id, а без него первый аргумент команды). Ограничитель не знает,
+# кто на самом деле отправил команду, поэтому ключ, выбранный
+# отправителем, позволяет обойти ведра, а команды без ключа делят одно
+# ведро на команду на весь процесс.
+
+RATE_LIMIT = {
+    'enabled': True,
+    'user': {'rate': 5.0, 'burst': 10},     # все команды пользователя, в секунду
+    'commands': {                           # отдельные ведра (пользователь, команда)
+        '/history': {'rate': 0.5, 'burst': 5},
+        '/activity': {'rate': 0.5, 'burst': 5},
+        '/users': {'rate': 0.05, 'burst': 1},
+    },
+    'expensive': ('/history', '/activity', '/users'),
+    'max_concurrent': 8,        # одновременно выполняемых дорогих команд
+    'mode': 'reject',           # reject — отказ; queue — ожидание не дольше max_wait
+    'max_wait': 2.0,            # сек
+    'sweep_interval': 60.0,     # сек между удалениями полных ведер
+    'max_buckets': 100000,
+}
+
+LOCK_STRIPES = 64
+SWEEP_LOW_WATER = 0.9       # доля max_buckets, до которой очистка удаляет лишние ведра
+
+
+class TokenBucket:
+    """Ведро токенов: в среднем rate событий в секунду, не больше burst подряд.
+
+    reserve() всегда забирает токен (уходя в долг) и возвращает, сколько
+    секунд подождать перед событием, — так очередность сохраняется и при
+    нескольких ожидающих.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now=None):
+        """Забирает токен; возвращает задержку в секундах (0, если токен был)."""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def delay(self, now=None):
+        """Сколько секунд ждать токен (0, если он есть); токен не забирается."""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def refund(self):
+        """Возвращает токен, забранный reserve() для отмененного события."""
+        self.tokens = min(self.burst, self.tokens + 1)
+
+    def idle(self, now=None):
+        """Ведро полное — владелец давно ничего не отправлял."""
+        now = time.monotonic() if now is None else now
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class RateLimited(Exception):
+    """Команда отклонена ограничителем; reason — user, command или concurrency."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason, retry_after)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    """Ведра токенов на пользователя и команду плюс общий предел дорогих команд."""
+
+    def __init__(self, config=None):
+        config = dict(RATE_LIMIT, **(config or {}))
+        self.enabled = config['enabled']
+        self.user = config['user']
+        self.commands = config['commands']
+        self.expensive = frozenset(config['expensive'])
+        self.max_concurrent = config['max_concurrent']
+        self.max_wait = config['max_wait'] if config['mode'] == 'queue' else 0.0
+        self.sweep_interval = config['sweep_interval']
+        self.max_buckets = config['max_buckets']
+        self._buckets = {}
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self._slots = threading.BoundedSemaphore(self.max_concurrent)
+        self._sweep_lock = threading.Lock()
+        self._next_sweep = time.monotonic() + self.sweep_interval
+        self._counters_lock = threading.Lock()
+        self._throttled = Counter()     # (причина, команда) -> отказов
+        # Счетчики пропущенных и ожидавших — по полосам, под их блокировками
+        self._passed = [0] * LOCK_STRIPES
+        self._queued = [0] * LOCK_STRIPES
+        self.in_flight = 0
+        self.evicted = 0
+
+    def _bucket(self, key, spec, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(spec['rate'], spec['burst'])
+            bucket.updated = now
+        return bucket
+
+    def _reject(self, reason, command, retry_after):
+        label = command if command in self.commands or command in self.expensive else "other"
+        with self._counters_lock:
+            self._throttled[reason, label] += 1
+        raise RateLimited(reason, retry_after)
+
+    def acquire(self, user_id, command):
+        """Пропускает команду или бросает RateLimited.
+
+        Возвращает функцию, освобождающую слот дорогой команды (вызвать
+        после ее выполнения), или None.
+        """
+        if not self.enabled:
+            return None
+        now = time.monotonic()
+        spec = self.commands.get(command)
+        stripe = hash(user_id) % LOCK_STRIPES
+        # Ключ ведра пользователя; анонимные команды не делят одно ведро на всех
+        user_key = (user_id, None) if user_id is not None else (None, "user", command)
+        with self._locks[stripe]:
+            user_bucket = self._bucket(user_key, self.user, now)
+            command_bucket = self._bucket((user_id, command), spec, now) if spec else None
+            wait = user_bucket.delay(now)
+            if wait > self.max_wait:
+                self._reject("user", command, wait)
+            if command_bucket is not None:
+                command_wait = command_bucket.delay(now)
+                if command_wait > self.max_wait:
+                    self._reject("command", command, command_wait)
+                wait = max(wait, command_bucket.reserve(now))
+            user_bucket.reserve(now)
+            self._passed[stripe] += 1
+            if wait:
+                self._queued[stripe] += 1
+        if len(self._buckets) > self.max_buckets or now >= self._next_sweep:
+            self.sweep(now)
+        if wait:
+            time.sleep(wait)
+
+        release = None
+        if command in self.expensive:
+            acquired = (self._slots.acquire(timeout=self.max_wait) if self.max_wait
+                        else self._slots.acquire(blocking=False))
+            if not acquired:
+                # Команда не выполнится: токены, забранные выше, возвращаются
+                with self._locks[stripe]:
+                    user_bucket.refund()
+                    if command_bucket is not None:
+                        command_bucket.refund()
+                self._reject("concurrency", command, self.max_wait or 1.0)
+            with self._counters_lock:
+                self.in_flight += 1
+            release = self._release_slot
+        return release
+
+    def _release_slot(self):
+        with self._counters_lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    def sweep(self, now=None):
+        """Удаляет полные ведра, а сверх max_buckets — самые полные до SWEEP_LOW_WATER; возвращает число удаленных."""
+        if not self._sweep_lock.acquire(blocking=False):
+            return 0
+        try:
+            now = time.monotonic() if now is None else now
+            self._next_sweep = now + self.sweep_interval
+            removed = 0
+            for key, bucket in list(self._buckets.items()):
+                if bucket.idle(now):
+                    with self._locks[hash(key[0]) % LOCK_STRIPES]:
+                        if bucket.idle(now) and self._buckets.get(key) is bucket:
+                            del self._buckets[key]
+                            removed += 1
+            excess = 0
+            if len(self._buckets) > self.max_buckets:
+                excess = len(self._buckets) - int(self.max_buckets * SWEEP_LOW_WATER)
+            if excess > 0:
+                fullest = heapq.nlargest(excess, list(self._buckets.items()), key=lambda item: item[1].tokens)
+                for key, bucket in fullest:
+                    with self._locks[hash(key[0]) % LOCK_STRIPES]:
+                        if self._buckets.pop(key, None) is not None:
+                            removed += 1
+            self.evicted += removed
+            return removed
+        finally:
+            self._sweep_lock.release()
+
+    def stats(self):
+        """Счетчики ограничителя: пропущено, ожидало, отказы по причинам и командам, ведра."""
+        with self._counters_lock:
+            throttled = dict(self._throttled)
+        by_reason = Counter()
+        by_command = Counter()
+        for (reason, command), count in throttled.items():
+            by_reason[reason] += count
+            by_command[command] += count
+        return {
+            "allowed": sum(self._passed) - by_reason["concurrency"],
+            "queued": sum(self._queued),
+            "throttled": sum(by_reason.values()),
+            "throttled_by_reason": dict(by_reason),
+            "throttled_by_command": dict(by_command),
+            "in_flight": self.in_flight,
+            "buckets": len(self._buckets),
+            "evicted": self.evicted,
+        }
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """Общий ограничитель процесса, создается при первом обращении."""
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = RateLimiter()
+    return _limiter
+
+
+def set_rate_limiter(limiter):
+    """Заменяет общий ограничитель (например, с другим RATE_LIMIT в тестах и бенчмарках)."""
+    global _limiter
+    with _limiter_lock:
+        _limiter = limiter
@@ -0,0 +1,330 @@
+import argparse
+import json
+import logging
+import time
+import uuid
+from decimal import Decimal, ROUND_HALF_UP
+
+import numpy as np
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+
+import archive
+import db
+
+logger = logging.getLogger(__name__)
+
+# Сверка балансов с журналом операций: users.balance должен равняться сумме
+# amount всех строк operations пользователя. Построчный обход через
+# get_user_operations занял бы дни, поэтому:
+#   1. новые строки operations (id больше сохраненного watermark) читаются
+#      серверным курсором порциями по RECONCILE['chunk_size'] и сворачиваются
+#      по vk_id в NumPy (сортировка + np.add.reduceat);
+#   2. суммы порции прибавляются к ledger_totals и в той же транзакции
+#      сохраняется watermark — прерванный запуск продолжается с последней
+#      порции, а ночной запуск читает только строки за сутки;
+#   3. users сравнивается с ledger_totals (плюс строки после watermark) одним
+#      запросом в одном снимке, расхождения выбираются по порциям в NumPy.
+#
+# Суммы считаются в целых единицах 10^-scale (копейках), поэтому сравнение
+# точное и не зависит от float. Строки моложе safety_lag не читаются:
+# транзакция с меньшим id могла еще не зафиксироваться, и watermark
+# перескочил бы через нее. Транзакции длиннее safety_lag так можно
+# пропустить — для них есть полный пересчет (--full).
+#
+# Старые строки уходят из operations в архив (partitions.py, archive.py).
+# Инкрементальная сверка их уже учла, а полный пересчет (и первый запуск)
+# начинает ledger_totals с архивных сумм: отключенных секций схемы archive
+# и файлов archive.py за месяцы, которых в базе больше нет. Строки секций,
+# удаленных с action 'drop', не восстановить — они покажутся расхождением.
+
+RECONCILE = {
+    'chunk_size': 200000,       # строк operations в одной порции
+    'scale': 2,                 # знаков после запятой в суммах
+    'safety_lag': 300,          # сек: строки моложе не попадают под watermark
+    'tolerance': 0,             # допустимое расхождение, в единицах 10^-scale
+    'report_limit': 100,        # крупнейших расхождений в отчете
+}
+
+STATE_NAME = "ledger"
+
+SAVE_STATE_SQL = """
+    INSERT INTO reconcile_state (name, watermark, scale, rows_done, updated_at)
+    VALUES (%(name)s, %(watermark)s, %(scale)s, %(rows_done)s, now())
+    ON CONFLICT (name) DO UPDATE
+    SET watermark = EXCLUDED.watermark, scale = EXCLUDED.scale,
+        rows_done = EXCLUDED.rows_done, updated_at = now()
+"""
+
+ADD_TOTALS_SQL = """
+    INSERT INTO ledger_totals (vk_id, units, operations) VALUES %s
+    ON CONFLICT (vk_id) DO UPDATE
+    SET units = ledger_totals.units + EXCLUDED.units,
+        operations = ledger_totals.operations + EXCLUDED.operations,
+        updated_at = now()
+"""
+
+# Балансы и суммы журнала в одном снимке; строки после watermark
+# досчитываются здесь же, иначе свежие операции выглядели бы расхождением
+COMPARE_SQL = """
+    WITH recent AS (
+        SELECT vk_id, sum(round(amount * %(factor)s))::bigint AS units
+        FROM operations
+        WHERE id > %(watermark)s AND vk_id IS NOT NULL
+        GROUP BY vk_id
+    )
+    SELECT u.vk_id, round(u.balance * %(factor)s)::bigint,
+           coalesce(t.units, 0) + coalesce(r.units, 0)
+    FROM users u
+    LEFT JOIN ledger_totals t USING (vk_id)
+    LEFT JOIN recent r USING (vk_id)
+"""
+
+
+def aggregate_chunk(vk_ids, units):
+    """Сворачивает порцию по vk_id: (уникальные vk_id, суммы units, число строк).
+
+    vk_ids и units — массивы одинаковой длины; суммы считаются в int64.
+    """
+    vk_ids = np.asarray(vk_ids)
+    units = np.asarray(units, dtype=np.int64)
+    if not len(vk_ids):
+        return vk_ids, units, np.zeros(0, dtype=np.int64)
+    order = np.argsort(vk_ids, kind="stable")
+    vk_sorted = vk_ids[order]
+    starts = np.flatnonzero(np.concatenate(([True], vk_sorted[1:] != vk_sorted[:-1])))
+    sums = np.add.reduceat(units[order], starts)
+    counts = np.diff(np.append(starts, len(vk_sorted)))
+    return vk_sorted[starts], sums, counts
+
+
+def find_mismatches(vk_ids, balances, ledger, tolerance=0):
+    """Индексы строк, где |balance - ledger| больше tolerance, и разности."""
+    difference = np.asarray(balances, dtype=np.int64) - np.asarray(ledger, dtype=np.int64)
+    indexes = np.flatnonzero(np.abs(difference) > tolerance)
+    return indexes, difference[indexes]
+
+
+def _from_units(units, scale):
+    return Decimal(int(units)).scaleb(-scale)
+
+
+def load_state():
+    """Возвращает (watermark, scale, rows_done) или (0, None, 0), если сверка еще не запускалась."""
+    with db.db_cursor() as cursor:
+        cursor.execute(
+            "SELECT watermark, scale, rows_done FROM reconcile_state WHERE name = %s", [STATE_NAME]
+        )
+        row = cursor.fetchone()
+    return tuple(row) if row else (0, None, 0)
+
+
+def reset():
+    """Сбрасывает накопленные суммы и watermark: следующий запуск прочитает журнал целиком."""
+    with db.db_cursor(transaction=True) as cursor:
+        cursor.execute("TRUNCATE ledger_totals")
+        cursor.execute("DELETE FROM reconcile_state WHERE name = %s", [STATE_NAME])
+
+
+def _database_months(cursor, sources):
+    """Месяцы (UTC), за которые в sources есть строки."""
+    months = set()
+    for source in sources:
+        cursor.execute(sql.SQL("SELECT DISTINCT date_trunc('month', created_at, 'UTC') FROM {}").format(source))
+        months.update(row[0] for row in cursor.fetchall())
+    return months
+
+
+def _archived_totals(cursor, factor):
+    """{vk_id: [units, строк]} по строкам operations, которых нет в живой таблице.
+
+    Отключенные секции читаются запросом; архивный файл месяца — только
+    если этого месяца нет ни в operations, ни в секциях (выгрузка могла
+    прерваться до удаления источника, и тогда источник точнее).
+    """
+    totals = {}
+    detached = archive.detached_partitions("operations")
+    for partition in detached:
+        cursor.execute(sql.SQL(
+            "SELECT vk_id, sum(round(amount * %s))::bigint, count(*) FROM {} "
+            "WHERE vk_id IS NOT NULL GROUP BY vk_id"
+        ).format(partition), [factor])
+        for vk_id, units, count in cursor.fetchall():
+            entry = totals.setdefault(vk_id, [0, 0])
+            entry[0] += units
+            entry[1] += count
+    in_database = _database_months(cursor, [sql.Identifier("operations"), *detached])
+    for _, vk_id, block in archive.iter_archived_blocks("operations", in_database):
+        if vk_id == archive.NO_USER:
+            continue
+        entry = totals.setdefault(vk_id, [0, 0])
+        entry[0] += sum(int((amount * factor).to_integral_value(ROUND_HALF_UP)) for amount in block["amount"])
+        entry[1] += len(block["amount"])
+    return totals
+
+
+def rebuild(config=None):
+    """Начинает сверку заново с архивных сумм; возвращает число архивных строк.
+
+    Сброс, архивные суммы и нулевой watermark пишутся одной транзакцией,
+    поэтому прерванный пересчет не оставляет ledger_totals без архива.
+    """
+    config = dict(RECONCILE, **(config or {}))
+    with db.db_cursor(transaction=True) as cursor:
+        cursor.execute("TRUNCATE ledger_totals")
+        totals = _archived_totals(cursor, 10 ** config['scale'])
+        if totals:
+            execute_values(cursor, ADD_TOTALS_SQL,
+                           [(vk_id, units, count) for vk_id, (units, count) in totals.items()], page_size=1000)
+        cursor.execute(SAVE_STATE_SQL, {"name": STATE_NAME, "watermark": 0, "scale": config['scale'], "rows_done": 0})
+    return sum(count for _, count in totals.values())
+
+
+def _upper_bound(safety_lag):
+    """Наибольший id, который можно читать: строки моложе safety_lag не трогаются."""
+    with db.db_cursor() as cursor:
+        cursor.execute(
+            "SELECT id FROM operations WHERE created_at < now() - make_interval(secs => %s) "
+            "ORDER BY id DESC LIMIT 1",
+            [safety_lag]
+        )
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def _iter_operation_chunks(after, upto, factor, chunk_size):
+    """Генератор: отдает порции (последний id, vk_ids, units) строк с after < id <= upto."""
+    with db.db_cursor(transaction=True, name=f"reconcile_{uuid.uuid4().hex}") as cursor:
+        cursor.itersize = chunk_size
+        cursor.execute(
+            "SELECT id, vk_id, round(amount * %(factor)s)::bigint FROM operations "
+            "WHERE id > %(after)s AND id <= %(upto)s AND vk_id IS NOT NULL ORDER BY id",
+            {"after": after, "upto": upto, "factor": factor}
+        )
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                return
+            ids, vk_ids, units = zip(*rows)
+            yield ids[-1], np.array(vk_ids), np.fromiter(units, dtype=np.int64, count=len(units))
+
+
+def scan_operations(config=None):
+    """Прибавляет к ledger_totals строки operations после watermark; возвращает статистику прохода."""
+    config = dict(RECONCILE, **(config or {}))
+    scale = config['scale']
+    watermark, saved_scale, rows_done = load_state()
+    if saved_scale is not None and saved_scale != scale:
+        raise ValueError(f"Суммы накоплены с scale={saved_scale}; для scale={scale} нужен полный пересчет")
+
+    upto = _upper_bound(config['safety_lag'])
+    scanned, users_touched = 0, 0
+    if upto is not None and upto > watermark:
+        for last_id, vk_ids, units in _iter_operation_chunks(watermark, upto, 10 ** scale, config['chunk_size']):
+            keys, sums, counts = aggregate_chunk(vk_ids, units)
+            with db.db_cursor(transaction=True) as cursor:
+                execute_values(cursor, ADD_TOTALS_SQL,
+                               list(zip(keys.tolist(), sums.tolist(), counts.tolist())), page_size=1000)
+                cursor.execute(SAVE_STATE_SQL, {
+                    "name": STATE_NAME, "watermark": last_id, "scale": scale,
+                    "rows_done": rows_done + scanned + len(units),
+                })
+            watermark = last_id
+            scanned += len(units)
+            users_touched += len(keys)
+            logger.info("Сверка: прочитано строк operations %s, до id %s", scanned, watermark)
+    return {"scanned_rows": scanned, "users_touched": users_touched, "watermark": watermark, "scale": scale}
+
+
+def compare_balances(watermark, config=None):
+    """Сравнивает users.balance с суммами журнала; возвращает отчет о расхождениях.
+
+    В отчете — число проверенных пользователей и расхождений, суммарный и
+    наибольший дрейф и report_limit крупнейших расхождений (по модулю).
+    """
+    config = dict(RECONCILE, **(config or {}))
+    scale, chunk_size = config['scale'], config['chunk_size']
+    checked = 0
+    found_ids, found_balances, found_differences = [], [], []
+    with db.db_cursor(transaction=True, name=f"reconcile_users_{uuid.uuid4().hex}") as cursor:
+        cursor.itersize = chunk_size
+        cursor.execute(COMPARE_SQL, {"factor": 10 ** scale, "watermark": watermark})
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            vk_ids, balances, ledger = zip(*rows)
+            balances = np.fromiter(balances, dtype=np.int64, count=len(rows))
+            indexes, differences = find_mismatches(
+                vk_ids, balances, np.fromiter(ledger, dtype=np.int64, count=len(rows)), config['tolerance']
+            )
+            found_ids.extend(vk_ids[i] for i in indexes.tolist())
+            found_balances.append(balances[indexes])
+            found_differences.append(differences)
+            checked += len(rows)
+
+    differences = np.concatenate(found_differences) if found_differences else np.zeros(0, dtype=np.int64)
+    balances = np.concatenate(found_balances) if found_balances else np.zeros(0, dtype=np.int64)
+    top = np.argsort(-np.abs(differences), kind="stable")[:config['report_limit']]
+    return {
+        "checked_users": checked,
+        "mismatches": len(found_ids),
+        "drift_total": str(_from_units(differences.sum(), scale)),
+        "drift_abs_total": str(_from_units(np.abs(differences).sum(), scale)),
+        "drift_max": str(_from_units(np.abs(differences).max(), scale)) if len(differences) else "0",
+        "top": [
+            {
+                "vk_id": found_ids[i],
+                "balance": str(_from_units(balances[i], scale)),
+                "ledger": str(_from_units(balances[i] - differences[i], scale)),
+                "difference": str(_from_units(differences[i], scale)),
+            }
+            for i in top.tolist()
+        ],
+    }
+
+
+def run(config=None, full=False):
+    """Догоняет журнал от watermark и сверяет балансы; возвращает отчет.
+
+    С full (и при первом запуске) суммы пересчитываются с начала через rebuild().
+    """
+    started = time.perf_counter()
+    if full or load_state()[1] is None:
+        archived = rebuild(config)
+        logger.info("Сверка начата заново, архивных строк: %s", archived)
+    scan = scan_operations(config)
+    report = compare_balances(scan['watermark'], config)
+    report.update(scan, elapsed_s=round(time.perf_counter() - started, 3))
+    if report['mismatches']:
+        logger.warning("Сверка: расхождений %s, суммарный дрейф %s, наибольший %s",
+                       report['mismatches'], report['drift_total'], report['drift_max'])
+        db.record_system_event("ledger_mismatch", json.dumps(
+            {key: report[key] for key in ("mismatches", "drift_total", "drift_abs_total", "drift_max")}
+        ), durable=True)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сверка users.balance с журналом operations")
+    parser.add_argument("--full", action="store_true", help="пересчитать журнал с начала")
+    parser.add_argument("--chunk-size", type=int, default=RECONCILE['chunk_size'], help="строк в одной порции")
+    parser.add_argument("--limit", type=int, default=RECONCILE['report_limit'], help="расхождений в отчете")
+    parser.add_argument("--dbname", default=None)
+    parser.add_argument("--host", default=None)
+    parser.add_argument("--user", default=None)
+    parser.add_argument("--password", default=None)
+    args = parser.parse_args()
+
+    for key in ("dbname", "host", "user", "password"):
+        if getattr(args, key) is not None:
+            db.DB_CONNECTION[key] = getattr(args, key)
+
+    logging.basicConfig(level=logging.INFO)
+    report = run({"chunk_size": args.chunk_size, "report_limit": args.limit}, full=args.full)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    db.close_pool()
+
+
+if __name__ == "__main__":
+    main()
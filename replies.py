@@ -0,0 +1,55 @@
+from pagination import next_page_hint
+
+# Тексты ответов бота, собираемые из строк хранилища. Модуль не зависит от
+# базы, поэтому им пользуются и db, и обработчики команд с любым хранилищем.
+
+MESSAGE_MAX_LENGTH = 4096       # предел длины одного сообщения бота
+
+
+def render_users_messages(user_chunks, max_length=MESSAGE_MAX_LENGTH):
+    """Разбивает поток порций пользователей на сообщения не длиннее max_length символов."""
+    header = "🗂 Все пользователи:\n"
+    message = header
+    empty = True
+    for users in user_chunks:
+        for vk_id, balance, created_at in users:
+            line = f"ID пользователя: {vk_id} - Баланс: {balance} - Дата регистрации: {created_at}\n"
+            empty = False
+            if max_length and len(message) + len(line) > max_length and message:
+                yield message
+                message = ""
+            message += line
+    if empty:
+        yield "❌ Нет пользователей в системе."
+    elif message:
+        yield message
+
+
+def render_activity_page(activities, next_cursor=None, next_command=None):
+    """Текст страницы активности: строки (action_type, details, created_at, id)."""
+    if not activities:
+        return "❌ Нет активности для данного пользователя."
+
+    activity_list = "🗂 История действий пользователя:\n"
+    for activity in activities:
+        action_type = activity[0]
+        details = activity[1]
+        created_at = activity[2]
+        activity_list += f"{action_type} - {details} - {created_at}\n"
+
+    return activity_list + next_page_hint(next_cursor, next_command)
+
+
+def render_transactions_page(transactions, next_cursor=None, next_command=None):
+    """Текст страницы транзакций: строки (transaction_type, amount, created_at, id)."""
+    if not transactions:
+        return "❌ Нет транзакций для данного пользователя."
+
+    transactions_list = "🗂 История транзакций:\n"
+    for transaction in transactions:
+        transaction_type = transaction[0]
+        amount = transaction[1]
+        created_at = transaction[2]
+        transactions_list += f"{transaction_type} - Сумма: {amount} - Дата: {created_at}\n"
+
+    return transactions_list + next_page_hint(next_cursor, next_command)
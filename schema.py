@@ -0,0 +1,389 @@
+import argparse
+import datetime
+import json
+import logging
+from collections import namedtuple
+
+from psycopg2 import sql
+
+import db
+
+logger = logging.getLogger(__name__)
+
+# Версионированная схема базы. Каждая миграция применяется один раз и
+# записывается в schema_migrations; повторный запуск ничего не меняет, а все
+# DDL дополнительно написаны с IF NOT EXISTS. Одновременные запуски
+# сериализуются advisory-блокировкой.
+#
+# Индексы строятся через CREATE INDEX CONCURRENTLY вне транзакции, поэтому
+# миграцию можно выполнять на работающей базе.
+
+SCHEMA_LOCK_ID = 727274001      # ключ pg_advisory_lock для миграций схемы
+
+# statements выполняются в одной транзакции; indexes — по одному, в autocommit
+# Таблицы, которые db создает и сам (refresh_system_counters). db импортирует
+# этот модуль, поэтому на уровне модуля здесь к db не обращаются — только в
+# функциях
+SYSTEM_COUNTERS_DDL = sql.SQL("""
+    CREATE TABLE IF NOT EXISTS system_counters (
+        name text NOT NULL,
+        shard smallint NOT NULL,
+        value numeric NOT NULL DEFAULT 0,
+        PRIMARY KEY (name, shard)
+    )
+""")
+
+IDEMPOTENCY_KEYS_DDL = """
+    CREATE TABLE IF NOT EXISTS idempotency_keys (
+        key text PRIMARY KEY,
+        request text NOT NULL,
+        result jsonb,
+        created_at timestamptz NOT NULL DEFAULT now(),
+        expires_at timestamptz NOT NULL
+    )
+"""
+
+Migration = namedtuple("Migration", ["version", "name", "statements", "indexes"])
+Index = namedtuple("Index", ["name", "definition"])
+
+MIGRATIONS = [
+    Migration(1, "base tables", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            vk_id text PRIMARY KEY,
+            id uuid UNIQUE DEFAULT gen_random_uuid(),
+            username text,
+            balance numeric NOT NULL DEFAULT 0 CHECK (balance >= 0),
+            created_at timestamptz NOT NULL DEFAULT now()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS operations (
+            id bigint GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            vk_id text,
+            operation_type text NOT NULL,
+            amount numeric NOT NULL,
+            details text,
+            created_at timestamptz NOT NULL DEFAULT now()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_activity (
+            id bigint GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            vk_id text NOT NULL,
+            action_type text NOT NULL,
+            details text,
+            created_at timestamptz NOT NULL DEFAULT now()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS transactions (
+            id bigint GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            vk_id text NOT NULL,
+            transaction_type text NOT NULL,
+            amount numeric NOT NULL,
+            created_at timestamptz NOT NULL DEFAULT now()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS system_events (
+            id bigint GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            event_type text NOT NULL,
+            message text,
+            created_at timestamptz NOT NULL DEFAULT now()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS system_errors (
+            id bigint GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            vk_id text,
+            error_message text,
+            created_at timestamptz NOT NULL DEFAULT now()
+        )
+        """,
+    ], []),
+    Migration(2, "lookup indexes", [], [
+        # get_cached_user_by_username
+        Index("users_username_idx", "ON users (username)"),
+        # iter_user_chunks: порядок списка без сортировки, balance — для index-only scan
+        Index("users_created_at_vk_id_idx", "ON users (created_at DESC, vk_id) INCLUDE (balance)"),
+        # Страницы истории: WHERE vk_id = ... ORDER BY created_at DESC, id DESC
+        Index("operations_vk_id_created_at_id_idx", "ON operations (vk_id, created_at, id)"),
+        Index("user_activity_vk_id_created_at_id_idx", "ON user_activity (vk_id, created_at, id)"),
+        Index("transactions_vk_id_created_at_id_idx",
+              "ON transactions (vk_id, created_at, id) INCLUDE (transaction_type, amount)"),
+        # get_system_events(event_type)
+        Index("system_events_event_type_created_at_idx", "ON system_events (event_type, created_at)"),
+    ]),
+    Migration(3, "brin indexes on append-only tables", [], [
+        # Строки добавляются в порядке времени, поэтому BRIN по created_at
+        # занимает килобайты и отсекает блоки при выборках за период
+        Index("operations_created_at_brin", "ON operations USING brin (created_at)"),
+        Index("user_activity_created_at_brin", "ON user_activity USING brin (created_at)"),
+        Index("transactions_created_at_brin", "ON transactions USING brin (created_at)"),
+        Index("system_events_created_at_brin", "ON system_events USING brin (created_at)"),
+        Index("system_errors_created_at_brin", "ON system_errors USING brin (created_at)"),
+    ]),
+    Migration(4, "system counters", [
+        SYSTEM_COUNTERS_DDL,
+        """
+        INSERT INTO system_counters (name, shard, value)
+        SELECT 'users', 0, count(*) FROM users
+        UNION ALL SELECT 'total_balance', 0, coalesce(sum(balance), 0) FROM users
+        UNION ALL SELECT 'operations:' || operation_type, 0, count(*) FROM operations GROUP BY operation_type
+        ON CONFLICT (name, shard) DO NOTHING
+        """,
+    ], []),
+    Migration(5, "broadcast checkpoints", [
+        """
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id text PRIMARY KEY,
+            message text NOT NULL,
+            min_balance numeric,
+            last_vk_id text,
+            sent bigint NOT NULL DEFAULT 0,
+            failed bigint NOT NULL DEFAULT 0,
+            status text NOT NULL DEFAULT 'pending',
+            created_at timestamptz NOT NULL DEFAULT now(),
+            updated_at timestamptz NOT NULL DEFAULT now()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_failures (
+            broadcast_id text NOT NULL REFERENCES broadcasts (id) ON DELETE CASCADE,
+            vk_id text NOT NULL,
+            PRIMARY KEY (broadcast_id, vk_id)
+        )
+        """,
+    ], []),
+    Migration(6, "idempotency keys", [
+        IDEMPOTENCY_KEYS_DDL,
+        # Таблица новая и пустая, индекс строится в той же транзакции.
+        # Фоновая очистка удаляет просроченные ключи пачками по expires_at
+        "CREATE INDEX IF NOT EXISTS idempotency_keys_expires_at_idx ON idempotency_keys (expires_at)",
+    ], []),
+    Migration(7, "ledger reconciliation", [
+        # reconcile.py: суммы operations по пользователю в единицах 10^-scale
+        """
+        CREATE TABLE IF NOT EXISTS ledger_totals (
+            vk_id text PRIMARY KEY,
+            units bigint NOT NULL DEFAULT 0,
+            operations bigint NOT NULL DEFAULT 0,
+            updated_at timestamptz NOT NULL DEFAULT now()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS reconcile_state (
+            name text PRIMARY KEY,
+            watermark bigint NOT NULL DEFAULT 0,
+            scale integer NOT NULL,
+            rows_done bigint NOT NULL DEFAULT 0,
+            updated_at timestamptz NOT NULL DEFAULT now()
+        )
+        """,
+    ], []),
+    Migration(8, "broadcast deliveries past checkpoint", [
+        # broadcast.py: получатели за last_vk_id, которым сообщение уже
+        # доставлено, — продолженная рассылка их пропускает
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            broadcast_id text NOT NULL REFERENCES broadcasts (id) ON DELETE CASCADE,
+            vk_id text NOT NULL,
+            PRIMARY KEY (broadcast_id, vk_id)
+        )
+        """,
+    ], []),
+]
+
+MIGRATIONS_DDL = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version integer PRIMARY KEY,
+        name text NOT NULL,
+        applied_at timestamptz NOT NULL DEFAULT now()
+    )
+"""
+
+
+def ensure_index(cursor, name, definition):
+    """Строит индекс CREATE INDEX CONCURRENTLY; возвращает True, если он построен сейчас.
+
+    Курсор должен быть в autocommit. Недостроенный (INVALID) индекс от
+    прерванного запуска удаляется и строится заново.
+    """
+    cursor.execute(
+        "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE c.relname = %s AND c.relnamespace = current_schema()::regnamespace",
+        [name]
+    )
+    row = cursor.fetchone()
+    if row is not None and row[0]:
+        return False
+    if row is not None:
+        cursor.execute(sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {}").format(sql.Identifier(name)))
+    cursor.execute(sql.SQL("CREATE INDEX CONCURRENTLY IF NOT EXISTS {} {}").format(
+        sql.Identifier(name), sql.SQL(definition)
+    ))
+    return True
+
+
+def applied_versions(cursor):
+    cursor.execute(MIGRATIONS_DDL)
+    cursor.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cursor.fetchall()}
+
+
+def migrate(target=None):
+    """Применяет недостающие миграции до версии target (по умолчанию — все); возвращает их версии.
+
+    Операторы миграции выполняются в одной транзакции, затем строятся ее
+    индексы. Если сбой случился на индексе, версия не записывается, и
+    миграция повторяется целиком: операторы должны быть идемпотентными
+    (IF NOT EXISTS, ON CONFLICT DO NOTHING).
+    """
+    applied = []
+    with db.get_pool().connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT pg_advisory_lock(%s)", [SCHEMA_LOCK_ID])
+            try:
+                done = applied_versions(cursor)
+                for migration in MIGRATIONS:
+                    if migration.version in done or (target is not None and migration.version > target):
+                        continue
+                    conn.autocommit = False
+                    try:
+                        for statement in migration.statements:
+                            cursor.execute(statement)
+                        conn.commit()
+                    except Exception:
+                        conn.rollback()
+                        raise
+                    finally:
+                        conn.autocommit = True
+                    # Индексы — после операторов: они могут строиться по только что
+                    # созданным таблицам. CONCURRENTLY не работает в транзакции,
+                    # поэтому версия записывается последней, когда готово все
+                    for index in migration.indexes:
+                        if ensure_index(cursor, index.name, index.definition):
+                            logger.info("Построен индекс %s", index.name)
+                    cursor.execute(
+                        "INSERT INTO schema_migrations (version, name) VALUES (%s, %s) "
+                        "ON CONFLICT (version) DO NOTHING",
+                        [migration.version, migration.name]
+                    )
+                    logger.info("Применена миграция %s: %s", migration.version, migration.name)
+                    applied.append(migration.version)
+            finally:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", [SCHEMA_LOCK_ID])
+        finally:
+            cursor.close()
+    return applied
+
+
+# Горячие запросы db.py и индекс, который должен их обслуживать
+HotQuery = namedtuple("HotQuery", ["name", "query", "params", "index"])
+
+
+def hot_queries():
+    """Запросы, план которых проверяет check_query_plans."""
+    users_query, users_params = db.users_page_query((datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc),
+                                                      "12345"))
+    queries = [
+        HotQuery("user by vk_id", "SELECT * FROM users WHERE vk_id = %s", ["12345"], "users_pkey"),
+        HotQuery("user by username", "SELECT * FROM users WHERE username = %s LIMIT 1",
+                 ["User_12345"], "users_username_idx"),
+        HotQuery("users list", users_query, users_params, "users_created_at_vk_id_idx"),
+        HotQuery("system events by type",
+                 "SELECT event_type, message, created_at FROM system_events WHERE event_type = %s "
+                 "ORDER BY created_at DESC",
+                 ["startup"], "system_events_event_type_created_at_idx"),
+    ]
+    for table, columns in (
+        ("operations", ["operation_type", "amount", "details"]),
+        ("user_activity", ["action_type", "details"]),
+        ("transactions", ["transaction_type", "amount"]),
+    ):
+        query, params = db.history_page_query(table, columns, "vk_id = %s", ["12345"], db.HISTORY_PAGE_SIZE)
+        queries.append(HotQuery(f"{table} page", query, params, f"{table}_vk_id_created_at_id_idx"))
+    return queries
+
+
+def _plan_indexes(plan):
+    """Имена индексов, которые использует план EXPLAIN (FORMAT JSON)."""
+    names = set()
+    if "Index Name" in plan:
+        names.add(plan["Index Name"])
+    for child in plan.get("Plans", ()):
+        names |= _plan_indexes(child)
+    return names
+
+
+# Индекс секции и все индексы секционированных таблиц над ним
+PARENT_INDEXES_SQL = """
+    WITH RECURSIVE chain (name, oid) AS (
+        SELECT name, to_regclass(quote_ident(name)) FROM unnest(%s::text[]) AS used (name)
+        UNION ALL
+        SELECT chain.name, i.inhparent FROM chain JOIN pg_inherits i ON i.inhrelid = chain.oid
+    )
+    SELECT c.relname FROM chain JOIN pg_class c ON c.oid = chain.oid
+"""
+
+
+def _with_parent_indexes(cursor, names):
+    """Имена индексов плана вместе с индексами родителей (см. partitions.py).
+
+    В плане запроса к секционированной таблице стоят индексы секций
+    (operations_p202611_..., ..._legacy), а горячий запрос описан индексом
+    родителя.
+    """
+    if not names:
+        return set()
+    cursor.execute(PARENT_INDEXES_SQL, [sorted(names)])
+    return names | {row[0] for row in cursor.fetchall()}
+
+
+def check_query_plans():
+    """Проверяет, что каждый горячий запрос выполняется по своему индексу.
+
+    На маленьких тестовых таблицах планировщик предпочитает Seq Scan,
+    поэтому проверка идет с enable_seqscan = off: она подтверждает, что
+    подходящий индекс есть и применим. Индекс секции засчитывается за
+    индекс секционированной таблицы, к которому он подключен. Возвращает
+    {запрос: индексы плана и их родители}; при несовпадении бросает
+    AssertionError со списком запросов.
+    """
+    plans = {}
+    failures = []
+    with db.db_cursor(transaction=True) as cursor:
+        cursor.execute("SET LOCAL enable_seqscan = off")
+        for hot in hot_queries():
+            cursor.execute(sql.SQL("EXPLAIN (FORMAT JSON) {}").format(
+                sql.SQL(hot.query) if isinstance(hot.query, str) else hot.query
+            ), hot.params)
+            plan = cursor.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            used = _with_parent_indexes(cursor, _plan_indexes(plan[0]["Plan"]))
+            plans[hot.name] = sorted(used)
+            if hot.index not in used:
+                failures.append(f"{hot.name}: ожидался {hot.index}, в плане {sorted(used) or 'Seq Scan'}")
+    if failures:
+        raise AssertionError("Запросы без индекса:\n" + "\n".join(failures))
+    return plans
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Миграции схемы базы данных")
+    parser.add_argument("--target", type=int, default=None, help="применить миграции до этой версии")
+    parser.add_argument("--check", action="store_true", help="проверить планы горячих запросов")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    print(json.dumps({"applied": migrate(args.target)}, ensure_ascii=False))
+    if args.check:
+        print(json.dumps(check_query_plans(), ensure_ascii=False, indent=2))
+    db.close_pool()
+
+
+if __name__ == "__main__":
+    main()
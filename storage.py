@@ -0,0 +1,772 @@
+import abc
+import bisect
+import datetime
+import itertools
+import os
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from decimal import Decimal
+
+import metrics
+from pagination import encode_cursor, decode_cursor
+
+# Хранилище данных бота за общим интерфейсом StorageBackend. PostgresStorage
+# работает через db (psycopg2 импортируется только при его создании),
+# MemoryStorage держит все в памяти процесса — для разработки на одном узле
+# и нагрузочных тестов обработчиков без базы. Выбор — переменная окружения
+# BOT_STORAGE ("postgres" или "memory") или set_storage().
+
+STORAGE_BACKEND = os.environ.get("BOT_STORAGE", "postgres")
+
+# Размеры страниц истории MemoryStorage — те же, что у db
+HISTORY_PAGE_SIZE = 20
+HISTORY_MAX_PAGE_SIZE = 200
+
+
+class BalanceError(Exception):
+    """Изменение баланса не выполнено."""
+
+class UserNotFoundError(BalanceError):
+    """Пользователь с таким vk_id не найден."""
+
+class InsufficientFundsError(BalanceError):
+    """Баланс ушел бы в минус."""
+
+class IdempotencyConflictError(BalanceError):
+    """Ключ идемпотентности уже использован для другого запроса."""
+
+class UnitOfWorkAborted(Exception):
+    """Единица работы откатана: запрос внутри нее завершился ошибкой, которую перехватили."""
+
+# Итог изменения баланса: новый баланс и признак повтора по ключу идемпотентности
+# (replayed — операция уже была выполнена раньше и сейчас ничего не изменила)
+BalanceResult = namedtuple("BalanceResult", ["balance", "replayed"])
+
+# Итог перевода: новые балансы и имена обоих участников
+TransferResult = namedtuple("TransferResult", ["from_balance", "to_balance", "from_username", "to_username"])
+
+# Итог массового изменения балансов: число примененных записей и отклоненные
+BulkAdjustResult = namedtuple("BulkAdjustResult", ["applied", "rejected"])
+# index — номер записи во входных данных; error — invalid, user_not_found
+# или insufficient_funds
+RejectedAdjustment = namedtuple("RejectedAdjustment", ["index", "vk_id", "delta", "reason", "error"])
+
+
+def prepare_adjustments(adjustments):
+    """Проверяет записи (vk_id, delta, reason); возвращает (годные, отклоненные).
+
+    Годные — кортежи (index, vk_id, delta, reason) с vk_id-строкой и
+    delta типа Decimal.
+    """
+    staged, rejected = [], []
+    for index, (vk_id, delta, reason) in enumerate(adjustments):
+        try:
+            amount = Decimal(str(delta))
+        except ArithmeticError:
+            amount = None
+        if vk_id is None or str(vk_id) == "" or amount is None or not amount.is_finite():
+            rejected.append(RejectedAdjustment(index, vk_id, delta, reason, "invalid"))
+            continue
+        staged.append((index, str(vk_id), amount, reason))
+    return staged, rejected
+
+
+def balance_request(vk_id, delta, operation_type):
+    """Отпечаток изменения баланса для проверки повтора по ключу идемпотентности."""
+    return f"balance:{vk_id}:{Decimal(str(delta)).normalize():f}:{operation_type}"
+
+
+def transfer_request(from_vk_id, to_vk_id, amount):
+    """Отпечаток перевода для проверки повтора по ключу идемпотентности."""
+    return f"transfer:{from_vk_id}:{to_vk_id}:{Decimal(str(amount)).normalize():f}"
+
+
+IDEMPOTENCY_TTL = 24 * 3600     # сек, как db.IDEMPOTENCY['ttl']
+
+
+def _page_size(page_size):
+    return max(1, min(int(page_size or HISTORY_PAGE_SIZE), HISTORY_MAX_PAGE_SIZE))
+
+
+def check_amount(amount):
+    """Проверяет сумму пополнения, снятия или перевода; бросает ValueError.
+
+    Сумма должна быть конечным числом больше нуля: NaN проходит сравнение
+    amount <= 0, поэтому конечность проверяется отдельно.
+    """
+    try:
+        value = Decimal(str(amount))
+    except ArithmeticError:
+        raise ValueError(f"Некорректная сумма: {amount!r}") from None
+    if not value.is_finite() or value <= 0:
+        raise ValueError("Сумма должна быть положительным числом")
+
+
+def _check_transfer(from_vk_id, to_vk_id, amount):
+    check_amount(amount)
+    if from_vk_id == to_vk_id:
+        raise ValueError("Нельзя перевести средства самому себе")
+
+
+class StorageBackend(abc.ABC):
+    """Интерфейс хранилища.
+
+    Все методы принимают session из unit_of_work(): изменения в одной
+    сессии фиксируются или отменяются вместе. Страницы истории — строки
+    от новых к старым, в конце каждой строки created_at и id; курсор
+    следующей страницы равен None на последней странице, испорченный
+    курсор дает ValueError. Ошибки баланса — UserNotFoundError и
+    InsufficientFundsError.
+    """
+
+    @abc.abstractmethod
+    def unit_of_work(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_user(self, vk_id, session=None):
+        """Строка пользователя (dict: vk_id, username, balance, created_at) или None."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_user_by_username(self, username, session=None):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def register_user(self, vk_id, username=None, session=None):
+        """Создает пользователя с нулевым балансом; False, если он уже есть."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_user(self, vk_id, session=None):
+        """Удаляет пользователя (история остается); False, если его не было."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def apply_balance_delta(self, vk_id, delta, operation_type, details, session=None, idempotency_key=None):
+        """Меняет баланс на delta, не допуская минуса, и пишет операцию; возвращает BalanceResult.
+
+        Повтор с тем же idempotency_key возвращает баланс первого вызова с
+        replayed=True.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def transfer(self, from_vk_id, to_vk_id, amount, sent_type="перевод", received_type="перевод",
+                 sent_details="Перевод на {to_vk_id}", received_details="Перевод от {from_vk_id}", session=None,
+                 idempotency_key=None):
+        """Переводит amount между пользователями; возвращает TransferResult."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def find_idempotent_result(self, idempotency_key, request, session=None):
+        """Сохраненный результат вызова с этим ключом (dict) или None.
+
+        request — balance_request()/transfer_request(); другой запрос с тем
+        же ключом дает IdempotencyConflictError.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def bulk_adjust_balances(self, adjustments, operation_type="adjustment", session=None):
+        """Применяет записи (vk_id, delta, reason) одной транзакцией; возвращает BulkAdjustResult.
+
+        Записи одного пользователя применяются вместе или отклоняются вместе.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def record_operation(self, vk_id, operation_type, amount, details, session=None):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def record_transaction(self, vk_id, transaction_type, amount, session=None):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def log_activity(self, vk_id, action_type, details, session=None):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def record_event(self, event_type, message, session=None):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def operations_page(self, vk_id, page_size=None, cursor=None, session=None):
+        """(строки (operation_type, amount, details, created_at, id), курсор)."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def activity_page(self, vk_id, page_size=None, cursor=None, session=None):
+        """(строки (action_type, details, created_at, id), курсор)."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def transactions_page(self, vk_id, page_size=None, cursor=None, session=None):
+        """(строки (transaction_type, amount, created_at, id), курсор)."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def events(self, event_type=None, limit=100, session=None):
+        """Последние события (event_type, message, created_at), от новых к старым."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def iter_user_chunks(self, chunk_size=None):
+        """Генератор порций (vk_id, balance, created_at) по created_at DESC, vk_id."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def system_counters(self, session=None):
+        """Счетчики users, total_balance и operations:<тип>."""
+        raise NotImplementedError
+
+
+class PostgresStorage(StorageBackend):
+    """Хранилище в PostgreSQL поверх функций db."""
+
+    def __init__(self):
+        import db
+        self.db = db
+
+    def unit_of_work(self):
+        return self.db.unit_of_work()
+
+    def get_user(self, vk_id, session=None):
+        return self.db.get_cached_user(vk_id, session=session)
+
+    def get_user_by_username(self, username, session=None):
+        return self.db.get_cached_user_by_username(username, session=session)
+
+    def register_user(self, vk_id, username=None, session=None):
+        with self.db.db_cursor(session=session) as cursor:
+            cursor.execute(
+                self.db.with_counters("INSERT INTO users (vk_id, username, balance) VALUES (%s, %s, 0) "
+                                      "ON CONFLICT (vk_id) DO NOTHING RETURNING vk_id", self.db.USERS_INSERTED_DELTAS),
+                [vk_id, username]
+            )
+            created = cursor.fetchone()[0] > 0
+        self.db.invalidate_user(vk_id, session=session)
+        return created
+
+    def delete_user(self, vk_id, session=None):
+        with self.db.db_cursor(session=session) as cursor:
+            cursor.execute(self.db.DELETE_USER_SQL, [vk_id])
+            deleted = cursor.fetchone()[0] > 0
+        self.db.invalidate_user(vk_id, session=session)
+        return deleted
+
+    def apply_balance_delta(self, vk_id, delta, operation_type, details, session=None, idempotency_key=None):
+        return self.db.apply_balance_delta(vk_id, delta, operation_type, details, session=session,
+                                           idempotency_key=idempotency_key)
+
+    def transfer(self, from_vk_id, to_vk_id, amount, sent_type="перевод", received_type="перевод",
+                 sent_details="Перевод на {to_vk_id}", received_details="Перевод от {from_vk_id}", session=None,
+                 idempotency_key=None):
+        return self.db.transfer_funds(from_vk_id, to_vk_id, amount, sent_type, received_type,
+                                      sent_details, received_details, session=session,
+                                      idempotency_key=idempotency_key)
+
+    def find_idempotent_result(self, idempotency_key, request, session=None):
+        return self.db.find_idempotent_result(idempotency_key, request, session=session)
+
+    def bulk_adjust_balances(self, adjustments, operation_type="adjustment", session=None):
+        return self.db.bulk_adjust_balances(adjustments, operation_type, session=session)
+
+    def _insert(self, table, row, session, query=None):
+        """Пишет строку аудита через журнал, а если нельзя — сразу INSERT."""
+        if self.db.journal_audit_row(table, row + (datetime.datetime.now(datetime.timezone.utc),), session=session):
+            return
+        if query is None:
+            columns = self.db.AUDIT_COLUMNS[table]
+            query = self.db.sql.SQL("INSERT INTO {} ({}) VALUES ({}, now())").format(
+                self.db.sql.Identifier(table),
+                self.db.sql.SQL(", ").join(map(self.db.sql.Identifier, columns)),
+                self.db.sql.SQL(", ").join(self.db.sql.Placeholder() * len(row)),
+            )
+        with self.db.db_cursor(session=session) as cursor:
+            cursor.execute(query, list(row))
+
+    def record_operation(self, vk_id, operation_type, amount, details, session=None):
+        self._insert("operations", (vk_id, operation_type, amount, details), session, self.db.with_counters(
+            "INSERT INTO operations (vk_id, operation_type, amount, details, created_at) "
+            "VALUES (%s, %s, %s, %s, now()) RETURNING operation_type", self.db.OPERATIONS_INSERTED_DELTAS
+        ))
+
+    def record_transaction(self, vk_id, transaction_type, amount, session=None):
+        with self.db.db_cursor(session=session) as cursor:
+            cursor.execute(
+                "INSERT INTO transactions (vk_id, transaction_type, amount, created_at) VALUES (%s, %s, %s, now())",
+                [vk_id, transaction_type, amount]
+            )
+
+    def log_activity(self, vk_id, action_type, details, session=None):
+        self._insert("user_activity", (vk_id, action_type, details), session)
+
+    def record_event(self, event_type, message, session=None):
+        self._insert("system_events", (event_type, message), session)
+
+    def _page(self, table, columns, vk_id, page_size, cursor, session):
+        return self.db.fetch_user_history_page(table, columns, vk_id,
+                                               page_size=page_size, cursor=cursor, session=session)
+
+    def operations_page(self, vk_id, page_size=None, cursor=None, session=None):
+        return self._page("operations", ["operation_type", "amount", "details"], vk_id, page_size, cursor, session)
+
+    def activity_page(self, vk_id, page_size=None, cursor=None, session=None):
+        return self._page("user_activity", ["action_type", "details"], vk_id, page_size, cursor, session)
+
+    def transactions_page(self, vk_id, page_size=None, cursor=None, session=None):
+        return self._page("transactions", ["transaction_type", "amount"], vk_id, page_size, cursor, session)
+
+    def events(self, event_type=None, limit=100, session=None):
+        with self.db.db_cursor(session=session) as cursor:
+            if event_type:
+                cursor.execute(
+                    "SELECT event_type, message, created_at FROM system_events WHERE event_type = %s "
+                    "ORDER BY created_at DESC LIMIT %s",
+                    [event_type, limit]
+                )
+            else:
+                cursor.execute(
+                    "SELECT event_type, message, created_at FROM system_events ORDER BY created_at DESC LIMIT %s",
+                    [limit]
+                )
+            return cursor.fetchall()
+
+    def iter_user_chunks(self, chunk_size=None):
+        return self.db.iter_user_chunks(chunk_size)
+
+    def system_counters(self, session=None):
+        return self.db.read_system_counters(session=session)
+
+
+class _History:
+    """История одного пользователя в одной таблице: строки по возрастанию id."""
+
+    __slots__ = ("rows", "ids")
+
+    def __init__(self):
+        self.rows = []
+        self.ids = []
+
+    def append(self, row):
+        self.rows.append(row)
+        self.ids.append(row[-1])
+
+    def pop(self):
+        self.ids.pop()
+        return self.rows.pop()
+
+    def page(self, page_size, cursor):
+        end = len(self.rows)
+        if cursor:
+            _, after_id = decode_cursor(cursor)
+            end = bisect.bisect_left(self.ids, after_id)
+        start = max(0, end - page_size)
+        rows = self.rows[start:end][::-1]
+        next_cursor = encode_cursor(rows[-1][-2], rows[-1][-1]) if start > 0 and rows else None
+        return rows, next_cursor
+
+
+class _MemorySession:
+    def __init__(self):
+        self.undo = []
+        self.held = {}      # vk_id -> блокировка пользователя, взятая до конца единицы работы
+
+
+class MemoryStorage(StorageBackend):
+    """Хранилище в памяти процесса.
+
+    Пользователи — словарь по vk_id плюс индекс username -> vk_id; история
+    каждого пользователя — массивы, в которые строки только добавляются, с
+    возрастающими id и неубывающим created_at, поэтому страница находится
+    двоичным поиском.
+
+    У каждого пользователя своя блокировка. Единица работы берет
+    блокировки пользователей, которых касается, и держит их до конца, а
+    при ошибке откатывает свои изменения в обратном порядке — поэтому
+    проверки баланса и порядок записей такие же, как в PostgreSQL, а
+    команды разных пользователей выполняются параллельно. Несколько
+    пользователей блокируются по возрастанию vk_id, как в transfer_funds;
+    если единица работы уже держит больший vk_id, меньший она ждет не
+    дольше LOCK_TIMEOUT. Общая блокировка защищает только словари и
+    счетчики и берется на короткое время, поэтому список пользователей и
+    счетчики могут включать изменения незавершенных единиц работы.
+    """
+
+    HISTORY_TABLES = ("operations", "user_activity", "transactions")
+    LOCK_TIMEOUT = 5.0      # сек ожидания блокировки пользователя не по порядку vk_id
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._user_locks = {}
+        self._users = {}
+        self._usernames = {}
+        self._history = {table: {} for table in self.HISTORY_TABLES}
+        self._ids = {table: itertools.count(1) for table in self.HISTORY_TABLES + ("system_events",)}
+        self._last_created_at = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+        self._events = []
+        self._counters = {"users": 0, "total_balance": Decimal(0)}
+        self._idempotency = {}      # ключ -> (request, результат или None, пока выполняется; срок по time.monotonic)
+        self._stored_keys = 0
+
+    @contextmanager
+    def unit_of_work(self):
+        session = _MemorySession()
+        try:
+            yield session
+        except BaseException:
+            for undo in reversed(session.undo):
+                undo()
+            raise
+        finally:
+            for lock in reversed(list(session.held.values())):
+                lock.release()
+            session.held.clear()
+
+    def _user_lock(self, vk_id):
+        lock = self._user_locks.get(vk_id)
+        if lock is None:
+            with self._lock:
+                lock = self._user_locks.setdefault(vk_id, threading.RLock())
+        return lock
+
+    def _acquire(self, held, vk_ids):
+        """Берет блокировки vk_ids по возрастанию vk_id и добавляет их в held."""
+        for vk_id in sorted(set(vk_ids) - held.keys(), key=str):
+            lock = self._user_lock(vk_id)
+            if held and str(vk_id) < max(map(str, held)):
+                # Не по порядку: бесконечное ожидание могло бы стать взаимоблокировкой
+                if not lock.acquire(timeout=self.LOCK_TIMEOUT):
+                    raise TimeoutError(f"Не дождались блокировки пользователя {vk_id}")
+            else:
+                lock.acquire()
+            held[vk_id] = lock
+
+    @contextmanager
+    def _locked(self, session, *vk_ids):
+        """Блокирует пользователей: в сессии — до конца единицы работы, без нее — на время блока."""
+        if session is not None:
+            self._acquire(session.held, vk_ids)
+            yield
+            return
+        held = {}
+        try:
+            self._acquire(held, vk_ids)
+            yield
+        finally:
+            for lock in reversed(list(held.values())):
+                lock.release()
+
+    def _now(self):
+        # created_at не убывает, даже если системные часы сдвинулись назад
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if now < self._last_created_at:
+            now = self._last_created_at
+        self._last_created_at = now
+        return now
+
+    def _on_rollback(self, session, undo):
+        if session is not None:
+            session.undo.append(undo)
+
+    def _add_counter(self, name, delta):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + delta
+
+    def _count(self, name, delta, session):
+        self._add_counter(name, delta)
+        self._on_rollback(session, lambda: self._add_counter(name, -delta))
+
+    def _append(self, table, vk_id, values, session):
+        """Добавляет строку в историю пользователя (его блокировка должна быть взята)."""
+        with self._lock:
+            row = values + (self._now(), next(self._ids[table]))
+            history = self._history[table].get(vk_id)
+            if history is None:
+                history = self._history[table][vk_id] = _History()
+        history.append(row)
+        self._on_rollback(session, history.pop)
+        if table == "operations":
+            self._count(f"operations:{values[0]}", 1, session)
+        return row
+
+    def _set_balance(self, user, balance, session):
+        old = user['balance']
+        user['balance'] = balance
+        self._add_counter("total_balance", balance - old)
+        self._on_rollback(session, lambda: self._set_balance(user, old, None))
+
+    def get_user(self, vk_id, session=None):
+        with self._locked(session, vk_id):
+            user = self._users.get(vk_id)
+            return dict(user) if user is not None else None
+
+    def get_user_by_username(self, username, session=None):
+        vk_id = self._usernames.get(username)
+        if vk_id is None:
+            return None
+        user = self.get_user(vk_id, session=session)
+        return user if user is not None and user['username'] == username else None
+
+    def register_user(self, vk_id, username=None, session=None):
+        with self._locked(session, vk_id):
+            if vk_id in self._users:
+                return False
+            user = {"vk_id": vk_id, "username": username, "balance": Decimal(0), "created_at": None}
+            with self._lock:
+                user['created_at'] = self._now()
+                self._restore_user(user)
+            self._count("users", 1, session)
+            self._on_rollback(session, lambda: self._remove_user(vk_id))
+            return True
+
+    def _remove_user(self, vk_id):
+        with self._lock:
+            user = self._users.pop(vk_id)
+            if self._usernames.get(user['username']) == vk_id:
+                del self._usernames[user['username']]
+            return user
+
+    def _restore_user(self, user):
+        with self._lock:
+            self._users[user['vk_id']] = user
+            if user['username'] is not None:
+                self._usernames.setdefault(user['username'], user['vk_id'])
+
+    def delete_user(self, vk_id, session=None):
+        with self._locked(session, vk_id):
+            if vk_id not in self._users:
+                return False
+            user = self._remove_user(vk_id)
+            self._count("users", -1, session)
+            self._count("total_balance", -user['balance'], session)
+            self._on_rollback(session, lambda: self._restore_user(user))
+            return True
+
+    def find_idempotent_result(self, idempotency_key, request, session=None):
+        with self._lock:
+            entry = self._idempotency.get(idempotency_key)
+            if entry is None or entry[2] <= time.monotonic():
+                return None
+            if entry[0] != request:
+                raise IdempotencyConflictError(idempotency_key)
+            return entry[1]
+
+    def _idempotent(self, idempotency_key, request, session, run, encode, decode):
+        """Выполняет run() один раз на ключ; возвращает (результат, повтор ли это).
+
+        Повтор возвращает decode(сохраненного результата).
+
+        Вызывается под блокировкой пользователя запроса, поэтому повтор с
+        тем же запросом ждет завершения первого. Ключ занимается до run():
+        тот же ключ с другим запросом сразу дает IdempotencyConflictError.
+        """
+        if idempotency_key is None:
+            return run(), False
+        with self._lock:
+            stored = self.find_idempotent_result(idempotency_key, request)
+            if stored is not None:
+                return decode(stored), True
+            expires = time.monotonic() + IDEMPOTENCY_TTL
+            self._idempotency[idempotency_key] = (request, None, expires)
+        try:
+            result = run()
+        except BaseException:
+            self._forget_key(idempotency_key)
+            raise
+        with self._lock:
+            self._idempotency[idempotency_key] = (request, encode(result), expires)
+            self._stored_keys += 1
+            if self._stored_keys % 1000 == 0:
+                self.purge_idempotency_keys()
+        self._on_rollback(session, lambda: self._forget_key(idempotency_key))
+        return result, False
+
+    def _forget_key(self, idempotency_key):
+        with self._lock:
+            self._idempotency.pop(idempotency_key, None)
+
+    def purge_idempotency_keys(self):
+        """Удаляет просроченные ключи; возвращает их число."""
+        with self._lock:
+            now = time.monotonic()
+            expired = [key for key, entry in self._idempotency.items() if entry[2] <= now]
+            for key in expired:
+                del self._idempotency[key]
+            return len(expired)
+
+    def apply_balance_delta(self, vk_id, delta, operation_type, details, session=None, idempotency_key=None):
+        def run():
+            user = self._users.get(vk_id)
+            if user is None:
+                raise UserNotFoundError(vk_id)
+            amount = Decimal(str(delta))
+            balance = user['balance'] + amount
+            if balance < 0:
+                raise InsufficientFundsError(vk_id)
+            self._set_balance(user, balance, session)
+            self._append("operations", vk_id, (operation_type, amount, details), session)
+            return balance
+
+        with self._locked(session, vk_id):
+            return BalanceResult(*self._idempotent(
+                idempotency_key, idempotency_key and balance_request(vk_id, delta, operation_type), session, run,
+                lambda balance: {"balance": str(balance)}, lambda stored: Decimal(stored['balance']),
+            ))
+
+    def transfer(self, from_vk_id, to_vk_id, amount, sent_type="перевод", received_type="перевод",
+                 sent_details="Перевод на {to_vk_id}", received_details="Перевод от {from_vk_id}", session=None,
+                 idempotency_key=None):
+        _check_transfer(from_vk_id, to_vk_id, amount)
+        amount = Decimal(str(amount))
+
+        def run():
+            sender, receiver = self._users.get(from_vk_id), self._users.get(to_vk_id)
+            if sender is None:
+                raise UserNotFoundError(from_vk_id)
+            if receiver is None:
+                raise UserNotFoundError(to_vk_id)
+            if sender['balance'] < amount:
+                raise InsufficientFundsError(from_vk_id)
+            names = {"from_vk_id": from_vk_id, "to_vk_id": to_vk_id,
+                     "from_name": sender['username'], "to_name": receiver['username']}
+            self._set_balance(sender, sender['balance'] - amount, session)
+            self._set_balance(receiver, receiver['balance'] + amount, session)
+            self._append("operations", from_vk_id, (sent_type, -amount, sent_details.format(**names)), session)
+            self._append("operations", to_vk_id, (received_type, amount, received_details.format(**names)), session)
+            return TransferResult(sender['balance'], receiver['balance'], names["from_name"], names["to_name"])
+
+        with self._locked(session, from_vk_id, to_vk_id):
+            result, _ = self._idempotent(
+                idempotency_key, idempotency_key and transfer_request(from_vk_id, to_vk_id, amount), session, run,
+                lambda result: {"from_balance": str(result.from_balance), "to_balance": str(result.to_balance),
+                                "from_username": result.from_username, "to_username": result.to_username},
+                lambda stored: TransferResult(Decimal(stored['from_balance']), Decimal(stored['to_balance']),
+                                              stored['from_username'], stored['to_username']),
+            )
+            return result
+
+    def bulk_adjust_balances(self, adjustments, operation_type="adjustment", session=None):
+        staged, rejected = prepare_adjustments(adjustments)
+        totals = {}
+        for _, vk_id, delta, _ in staged:
+            totals[vk_id] = totals.get(vk_id, 0) + delta
+        applied = 0
+        with self._locked(session, *totals):
+            errors = {}
+            for vk_id, total in totals.items():
+                user = self._users.get(vk_id)
+                if user is None:
+                    errors[vk_id] = "user_not_found"
+                elif user['balance'] + total < 0:
+                    errors[vk_id] = "insufficient_funds"
+                else:
+                    self._set_balance(user, user['balance'] + total, session)
+            for index, vk_id, delta, reason in staged:
+                if vk_id in errors:
+                    rejected.append(RejectedAdjustment(index, vk_id, delta, reason, errors[vk_id]))
+                else:
+                    self._append("operations", vk_id, (operation_type, delta, reason), session)
+                    applied += 1
+        rejected.sort(key=lambda entry: entry.index)
+        return BulkAdjustResult(applied, rejected)
+
+    def record_operation(self, vk_id, operation_type, amount, details, session=None):
+        with self._locked(session, vk_id):
+            self._append("operations", vk_id, (operation_type, amount, details), session)
+
+    def record_transaction(self, vk_id, transaction_type, amount, session=None):
+        with self._locked(session, vk_id):
+            self._append("transactions", vk_id, (transaction_type, amount), session)
+
+    def log_activity(self, vk_id, action_type, details, session=None):
+        with self._locked(session, vk_id):
+            self._append("user_activity", vk_id, (action_type, details), session)
+
+    def record_event(self, event_type, message, session=None):
+        with self._lock:
+            event = (event_type, message, self._now())
+            self._events.append(event)
+        self._on_rollback(session, lambda: self._remove_event(event))
+
+    def _remove_event(self, event):
+        with self._lock:
+            # Событие могло быть не последним: после него писали другие единицы работы
+            for index in range(len(self._events) - 1, -1, -1):
+                if self._events[index] is event:
+                    del self._events[index]
+                    return
+
+    def _page(self, table, vk_id, page_size, cursor, session):
+        with self._locked(session, vk_id):
+            history = self._history[table].get(vk_id)
+            if history is None:
+                if cursor:
+                    decode_cursor(cursor)
+                return [], None
+            return history.page(_page_size(page_size), cursor)
+
+    def operations_page(self, vk_id, page_size=None, cursor=None, session=None):
+        return self._page("operations", vk_id, page_size, cursor, session)
+
+    def activity_page(self, vk_id, page_size=None, cursor=None, session=None):
+        return self._page("user_activity", vk_id, page_size, cursor, session)
+
+    def transactions_page(self, vk_id, page_size=None, cursor=None, session=None):
+        return self._page("transactions", vk_id, page_size, cursor, session)
+
+    def events(self, event_type=None, limit=100, session=None):
+        with self._lock:
+            found = []
+            for event in reversed(self._events):
+                if event_type is None or event[0] == event_type:
+                    found.append(event)
+                    if len(found) >= limit:
+                        break
+            return found
+
+    def iter_user_chunks(self, chunk_size=None):
+        chunk_size = chunk_size or 1000
+        with self._lock:
+            users = sorted(self._users.values(), key=lambda u: u['vk_id'])
+            users.sort(key=lambda u: u['created_at'], reverse=True)
+            rows = [(u['vk_id'], u['balance'], u['created_at']) for u in users]
+        for start in range(0, len(rows), chunk_size):
+            yield rows[start:start + chunk_size]
+
+    def system_counters(self, session=None):
+        with self._lock:
+            return {name: value for name, value in self._counters.items() if value}
+
+
+# Методы хранилищ пишут время и число строк в metrics (kind "storage");
+# unit_of_work и iter_user_chunks возвращают контекст и генератор, их время
+# учитывается в вызывающем коде
+for _backend in (PostgresStorage, MemoryStorage):
+    metrics.instrument(_backend, "storage", exclude=("unit_of_work", "iter_user_chunks"))
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_storage():
+    """Возвращает общее хранилище (по STORAGE_BACKEND), создавая его при первом обращении."""
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = MemoryStorage() if STORAGE_BACKEND == "memory" else PostgresStorage()
+    return _storage
+
+
+def set_storage(storage):
+    """Подменяет общее хранилище (тесты, нагрузочные прогоны); возвращает прежнее."""
+    global _storage
+    with _storage_lock:
+        previous, _storage = _storage, storage
+    return previous
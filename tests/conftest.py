@@ -0,0 +1,116 @@
+import json
+import os
+import re
+import sys
+import threading
+import time
+import types
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# Модули бота лежат в корне репозитория, пакета у них нет
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+# utils (проверка vk_id и username) приходит с развертыванием, в репозитории
+# его нет; без него не импортируется main, поэтому в тестах — простая замена
+try:
+    import utils  # noqa: F401
+except ImportError:
+    utils = types.ModuleType("utils")
+    utils.is_valid_vk_id = lambda value: str(value).isdigit()
+    utils.is_valid_username = lambda value: re.fullmatch(r"[A-Za-z0-9_.]{1,32}", str(value)) is not None
+    sys.modules["utils"] = utils
+
+
+class BotApiStub:
+    """Локальный HTTP-сервер вместо Bot API: записывает запросы и отвечает по сценарию.
+
+    respond(status, body=None, headers=None) ставит в очередь ответ на
+    следующий запрос; без сценария отвечает 200 {"ok": true}.
+    """
+
+    def __init__(self):
+        self.requests = []          # (время по time.monotonic, chat_id, text)
+        self._responses = []
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+                form = urllib.parse.parse_qs(body)
+                status, payload, headers = stub._next(form["chat_id"][0], form["text"][0])
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}/botTEST/sendMessage"
+        self._thread = threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True)
+        self._thread.start()
+
+    def _next(self, chat_id, text):
+        with self._lock:
+            self.requests.append((time.monotonic(), chat_id, text))
+            if self._responses:
+                return self._responses.pop(0)
+        return 200, {"ok": True}, None
+
+    def respond(self, status, body=None, headers=None):
+        with self._lock:
+            self._responses.append((status, body if body is not None else {"ok": status == 200}, headers))
+
+    def texts(self, chat_id=None):
+        with self._lock:
+            return [text for _, chat, text in self.requests if chat_id is None or chat == str(chat_id)]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def bot_api():
+    stub = BotApiStub()
+    yield stub
+    stub.close()
+
+
+@pytest.fixture
+def postgres(monkeypatch):
+    """Модуль db, подключенный к пустой тестовой базе.
+
+    Строка подключения libpq берется из BOT_TEST_DATABASE (например,
+    "host=localhost dbname=bot_test user=bot"); без нее тест пропускается.
+    Схема public базы пересоздается, поэтому рабочую базу указывать нельзя.
+    """
+    dsn = os.environ.get("BOT_TEST_DATABASE")
+    if not dsn:
+        pytest.skip("BOT_TEST_DATABASE не задана: тесты с PostgreSQL пропущены")
+    db = pytest.importorskip("db")
+    db.close_pool()
+    monkeypatch.setattr(db, "DB_CONNECTION", {"dsn": dsn})
+    monkeypatch.setitem(db.DB_POOL, "minconn", 0)
+    with db.db_cursor() as cursor:
+        cursor.execute("DROP SCHEMA public CASCADE")
+        cursor.execute("CREATE SCHEMA public")
+    db._user_cache.clear()
+    db._username_index.clear()
+    yield db
+    db.close_pool()
@@ -0,0 +1,85 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("psycopg2")
+pytest.importorskip("requests")
+
+import aio
+import db
+import storage
+from dispatcher import Dispatcher
+from ratelimit import RateLimiter, set_rate_limiter
+
+
+@pytest.fixture
+def bot(bot_api, monkeypatch):
+    """Хранилище в памяти и диспетчер db, отправляющий в локальную заглушку Bot API."""
+    memory = storage.MemoryStorage()
+    previous = storage.set_storage(memory)
+    set_rate_limiter(RateLimiter({"enabled": False}))
+    dispatcher = Dispatcher(bot_api.url, workers=4, global_rate=1000, global_burst=1000,
+                            per_chat_rate=1000, per_chat_burst=1000, backoff_base=0.01)
+    monkeypatch.setattr(db, "_dispatcher", dispatcher)
+    yield memory
+    db.close_dispatcher()
+    set_rate_limiter(None)
+    storage.set_storage(previous)
+
+
+def test_handle_command_async_uses_storage(bot):
+    bot.register_user("1", "alice")
+    reply = asyncio.run(aio.handle_command_async("/deposit", "1", "100"))
+    assert reply == "✅ Баланс пополнен! Новый баланс: 100.0."
+    assert asyncio.run(aio.handle_command_async("/balance", "1")) == "💰 Ваш баланс: 100.0."
+
+
+def test_run_updates_sends_replies_through_stub(bot, bot_api):
+    for vk_id in ("1", "2", "3"):
+        bot.register_user(vk_id, f"user{vk_id}")
+    updates = [(vk_id, "/deposit", vk_id, "10") for vk_id in ("1", "2", "3")]
+    assert asyncio.run(aio.run_updates(updates)) == [1] * 3
+    for vk_id in ("1", "2", "3"):
+        assert bot_api.texts(vk_id) == ["✅ Баланс пополнен! Новый баланс: 10.0."]
+
+
+def test_users_reply_is_streamed_message_by_message(bot, bot_api):
+    for vk_id in range(5):
+        bot.register_user(str(vk_id))
+    sent = asyncio.run(aio.handle_update("42", "/users"))
+    assert sent == len(bot_api.texts("42")) >= 1
+    assert all(f"ID пользователя: {vk_id} " in "\n".join(bot_api.texts("42")) for vk_id in range(5))
+
+
+def test_failed_delivery_is_reported(bot, bot_api):
+    bot_api.respond(400, {"ok": False, "description": "chat not found"})
+    assert asyncio.run(aio.send_message_async("7", "hi")) is False
+    assert asyncio.run(aio.send_message_async("7", "again")) is True
+
+
+def test_db_concurrency_is_bounded(bot, monkeypatch):
+    monkeypatch.setattr(aio, "DB_CONCURRENCY", 2)
+    lock = threading.Lock()
+    active, peak, overlapped = 0, 0, threading.Barrier(2, timeout=5)
+
+    def slow():
+        nonlocal active, peak
+        with lock:
+            active += 1
+            peak = max(peak, active)
+        try:
+            overlapped.wait()       # два вызова действительно идут одновременно
+            time.sleep(0.05)
+        finally:
+            with lock:
+                active -= 1
+
+    async def run():
+        await asyncio.gather(*(aio.run_db(slow) for _ in range(8)))
+
+    started = time.monotonic()
+    asyncio.run(run())
+    assert peak == 2
+    assert time.monotonic() - started >= 4 * 0.05
@@ -0,0 +1,127 @@
+import datetime
+
+import pytest
+
+pytest.importorskip("psycopg2")
+
+NOW = datetime.datetime(2026, 10, 18, tzinfo=datetime.timezone.utc)
+OLD = datetime.datetime(2024, 3, 10, tzinfo=datetime.timezone.utc)
+
+
+@pytest.fixture
+def archive(postgres, tmp_path, monkeypatch):
+    import archive
+    import schema
+    schema.migrate()
+    with postgres.db_cursor() as cursor:
+        cursor.execute("DROP SCHEMA IF EXISTS archive CASCADE")
+    monkeypatch.setitem(archive.ARCHIVE, "directory", str(tmp_path))
+    yield archive
+    archive.close_archives()
+    with postgres.db_cursor() as cursor:
+        cursor.execute("DROP SCHEMA IF EXISTS archive CASCADE")
+
+
+def _insert_operations(cursor, table, rows):
+    for vk_id, amount, created_at in rows:
+        cursor.execute(f"INSERT INTO {table} (vk_id, operation_type, amount, details, created_at) "
+                       "VALUES (%s, 'deposit', %s, 'x', %s)", [vk_id, amount, created_at])
+
+
+def test_old_month_is_exported_with_rows_without_user(archive, postgres):
+    with postgres.db_cursor() as cursor:
+        _insert_operations(cursor, "operations", [("1", 10, OLD), (None, 20, OLD), ("1", 30, NOW)])
+    result = archive.run(now=NOW)
+    assert result["operations"] == {"exported": 2, "deleted": 2, "kept": []}
+    with postgres.db_cursor() as cursor:
+        cursor.execute("SELECT amount FROM operations")
+        assert [row[0] for row in cursor.fetchall()] == [30]
+    month = archive.month_start(OLD)
+    assert archive.archived_rows("operations", month) == 2
+    rows = archive.read_history("operations", "1", ["amount"], 10)
+    assert [row[0] for row in rows] == [10]
+
+
+def test_detached_partition_is_dropped_only_when_archive_matches(archive, postgres, monkeypatch):
+    with postgres.db_cursor() as cursor:
+        cursor.execute("CREATE SCHEMA archive")
+        cursor.execute("CREATE TABLE archive.operations_p202403 (LIKE operations INCLUDING ALL)")
+        _insert_operations(cursor, "archive.operations_p202403", [("1", 10, OLD), (None, 20, OLD)])
+    with monkeypatch.context() as patched:
+        patched.setattr(archive, "archived_rows", lambda table, month, directory=None: 1)
+        assert archive.run(now=NOW)["operations"]["kept"] == ["archive.operations_p202403"]
+    assert archive.run(now=NOW)["operations"]["kept"] == []
+    with postgres.db_cursor() as cursor:
+        cursor.execute("SELECT to_regclass('archive.operations_p202403')")
+        assert cursor.fetchone()[0] is None
+    assert archive.archived_rows("operations", archive.month_start(OLD)) == 2
+
+
+def test_read_history_caches_archived_months(archive, postgres, monkeypatch):
+    with postgres.db_cursor() as cursor:
+        _insert_operations(cursor, "operations", [("1", 10, OLD), ("2", 20, OLD)])
+    archive.run(now=NOW)
+    listed = []
+    real_listdir = archive.os.listdir
+    monkeypatch.setattr(archive.os, "listdir", lambda path: listed.append(path) or real_listdir(path))
+    for vk_id, amount in (("1", 10), ("2", 20), ("1", 10)):
+        assert [row[0] for row in archive.read_history("operations", vk_id, ["amount"], 10)] == [amount]
+    assert archive.read_history("operations", "3", ["amount"], 10) == []
+    assert len(listed) == 1
+    assert archive.read_history("transactions", "1", ["amount"], 10) == []
+    assert len(listed) == 1
+
+    older = archive.month_start(OLD, -1)
+    with postgres.db_cursor() as cursor:
+        _insert_operations(cursor, "operations", [("1", 5, older)])
+    archive.run(now=NOW)
+    assert [row[0] for row in archive.read_history("operations", "1", ["amount"], 10)] == [10, 5]
+
+
+def test_archived_operations_stay_in_counters(archive, postgres):
+    with postgres.db_cursor() as cursor:
+        _insert_operations(cursor, "operations", [("1", 10, OLD), ("1", 20, OLD), ("1", 30, NOW)])
+    before = postgres.refresh_system_counters()
+    archive.run(now=NOW)
+    assert "✅ Счетчики совпадают с данными." in postgres.get_system_info(verify=True)
+    assert postgres.refresh_system_counters()["operations:deposit"] == before["operations:deposit"] == 3
+    assert postgres.read_system_counters()["archived:operations:deposit"] == 2
+
+
+def test_full_reconcile_counts_archived_operations(archive, postgres):
+    pytest.importorskip("numpy")
+    import reconcile
+    postgres.register_user("1")
+    with postgres.db_cursor() as cursor:
+        _insert_operations(cursor, "operations", [("1", 10, OLD), ("1", 20.005, OLD), ("1", 30, NOW)])
+        cursor.execute("UPDATE users SET balance = 60.01 WHERE vk_id = '1'")
+    archive.run(now=NOW)
+    config = {"safety_lag": -60}
+    assert reconcile.run(config, full=True)["mismatches"] == 0
+    assert reconcile.run(config)["mismatches"] == 0
+
+
+def test_full_reconcile_prefers_rows_still_in_database(archive, postgres, monkeypatch):
+    pytest.importorskip("numpy")
+    import reconcile
+    postgres.register_user("1")
+    with postgres.db_cursor() as cursor:
+        _insert_operations(cursor, "operations", [("1", 10, OLD)])
+        cursor.execute("UPDATE users SET balance = 10 WHERE vk_id = '1'")
+    # Выгрузка прервалась до удаления: месяц есть и в файле, и в таблице
+    monkeypatch.setattr(archive, "delete_month", lambda table, month: 0)
+    archive.run(now=NOW)
+    assert archive.archived_rows("operations", archive.month_start(OLD)) == 1
+    assert reconcile.run({"safety_lag": -60}, full=True)["mismatches"] == 0
+
+
+def test_user_without_archived_rows_skips_month_lookups(archive, postgres, monkeypatch):
+    with postgres.db_cursor() as cursor:
+        _insert_operations(cursor, "operations", [("1", 10, OLD), ("2", 30, NOW)])
+    archive.run(now=NOW)
+    looked_up = []
+    monkeypatch.setattr(archive.ArchiveFile, "user_rows", lambda self, vk_id: looked_up.append(vk_id))
+    rows, next_cursor = postgres.fetch_user_history_page("operations", ["amount"], "2")
+    assert [row[0] for row in rows] == [30] and next_cursor is None
+    assert looked_up == []
+    assert archive.archived_users("operations") == {"1"}
@@ -0,0 +1,86 @@
+import time
+
+import pytest
+
+pytest.importorskip("psycopg2")
+
+import bench
+
+
+def _run(*results):
+    return {"results": [
+        {"scenario": scenario, "concurrency": concurrency, "throughput_ops": throughput,
+         "latency_ms": {"p50": p99 / 2, "p95": p99, "p99": p99, "max": p99}}
+        for scenario, concurrency, throughput, p99 in results
+    ]}
+
+
+def test_compare_same_run_has_no_regressions():
+    run = _run(("/balance", 1, 1000.0, 2.0), ("/balance", 8, 5000.0, 4.0))
+    assert bench.compare(run, run) == []
+
+
+def test_compare_flags_slower_p99():
+    baseline = _run(("/balance", 8, 5000.0, 4.0))
+    current = _run(("/balance", 8, 5000.0, 5.0))
+    assert bench.compare(baseline, current) == ["/balance x8: p99 4.0 -> 5.0 ms"]
+
+
+def test_compare_flags_lower_throughput():
+    baseline = _run(("get_user_balance", 32, 10000.0, 3.0))
+    current = _run(("get_user_balance", 32, 7000.0, 3.0))
+    assert bench.compare(baseline, current) == ["get_user_balance x32: 10000.0 -> 7000.0 ops/s"]
+
+
+def test_compare_respects_threshold():
+    baseline = _run(("/history", 1, 100.0, 10.0))
+    current = _run(("/history", 1, 85.0, 11.5))
+    assert bench.compare(baseline, current) == []
+    assert len(bench.compare(baseline, current, threshold=0.1)) == 2
+
+
+def test_compare_ignores_improvements_and_new_scenarios():
+    baseline = _run(("/balance", 1, 1000.0, 2.0))
+    current = _run(("/balance", 1, 2000.0, 1.0), ("/users", 1, 1.0, 900.0))
+    assert bench.compare(baseline, current) == []
+
+
+def test_compare_matches_by_scenario_and_concurrency():
+    baseline = _run(("/balance", 1, 1000.0, 2.0), ("/balance", 8, 8000.0, 2.0))
+    current = _run(("/balance", 1, 1000.0, 2.0), ("/balance", 8, 1000.0, 2.0))
+    assert bench.compare(baseline, current) == ["/balance x8: 8000.0 -> 1000.0 ops/s"]
+
+
+def test_compare_skips_zero_baseline():
+    baseline = _run(("/users", 1, 0.0, 0.0))
+    current = _run(("/users", 1, 5.0, 300.0))
+    assert bench.compare(baseline, current) == []
+
+
+def test_measure_counts_ops_and_errors():
+    calls = []
+
+    def func(rnd):
+        calls.append(rnd.random())
+        if len(calls) % 4 == 0:
+            raise RuntimeError("boom")
+
+    result = bench.measure(func, concurrency=1, max_ops=20)
+    assert result["ops"] == 20 and result["errors"] == 5
+    assert result["latency_ms"]["p50"] <= result["latency_ms"]["p99"] <= result["latency_ms"]["max"]
+
+
+def test_measure_is_reproducible_per_seed():
+    def draws(seed):
+        seen = []
+        bench.measure(lambda rnd: seen.append(rnd.random()), concurrency=1, max_ops=5, seed=seed)
+        return seen
+
+    assert draws(1) == draws(1) != draws(2)
+
+
+def test_measure_detects_slowdown():
+    fast = bench.measure(lambda rnd: None, concurrency=2, max_ops=50)
+    slow = bench.measure(lambda rnd: time.sleep(0.002), concurrency=2, max_ops=50)
+    assert bench.compare({"results": [dict(fast, scenario="op", concurrency=2)]},
+                         {"results": [dict(slow, scenario="op", concurrency=2)]})
@@ -0,0 +1,60 @@
+from concurrent.futures import Future
+
+import pytest
+
+pytest.importorskip("psycopg2")
+pytest.importorskip("requests")
+
+
+def _done(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def _cancelled():
+    future = Future()
+    future.cancel()
+    return future
+
+
+@pytest.fixture
+def broadcast(postgres):
+    import broadcast
+    import schema
+    schema.migrate()
+    with postgres.db_cursor() as cursor:
+        cursor.execute("INSERT INTO users (vk_id, username) SELECT g::text, 'u' || g FROM generate_series(1, 6) g")
+    return broadcast
+
+
+def test_collect_records_deliveries_after_cancelled(broadcast, postgres):
+    broadcast_id = broadcast.create_broadcast("hi")
+    chunk = [("1", _done(True)), ("2", _cancelled()), ("3", _done(True)), ("4", _done(False))]
+    sent, failures, stalled = broadcast._collect(broadcast_id, chunk)
+    assert (sent, failures, stalled) == (2, [], True)
+    row = broadcast.load_broadcast(broadcast_id)
+    assert (row['last_vk_id'], row['sent'], row['failed']) == ("1", 2, 0)
+    assert broadcast._delivered_ahead(broadcast_id) == {"3"}
+
+    # Следующая порция после остановки тоже не сдвигает last_vk_id
+    sent, failures, stalled = broadcast._collect(broadcast_id, [("5", _done(True))], stalled)
+    assert (sent, stalled) == (1, True)
+    assert broadcast.load_broadcast(broadcast_id)['last_vk_id'] == "1"
+    assert broadcast._delivered_ahead(broadcast_id) == {"3", "5"}
+
+
+def test_resume_skips_delivered_recipients(broadcast, bot_api):
+    from dispatcher import Dispatcher
+
+    broadcast_id = broadcast.create_broadcast("hi")
+    broadcast._collect(broadcast_id, [("1", _done(True)), ("2", _cancelled()), ("3", _done(True))])
+    dispatcher = Dispatcher(bot_api.url, workers=2, global_rate=1000, global_burst=1000,
+                            per_chat_rate=1000, per_chat_burst=1000)
+    try:
+        report = broadcast.run_broadcast(broadcast_id, dispatcher=dispatcher, chunk_size=2)
+    finally:
+        dispatcher.close()
+    assert sorted(chat for _, chat, _ in bot_api.requests) == ["2", "4", "5", "6"]
+    assert report['status'] == "done" and report['sent'] == 4
+    assert broadcast.load_broadcast(broadcast_id)['sent'] == 6
@@ -0,0 +1,52 @@
+import types
+
+import pytest
+
+import cache
+from cache import TTLCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache, "time", types.SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+
+def test_entry_expires_after_ttl(clock):
+    c = TTLCache(ttl=10)
+    c.set("1", "alice")
+    clock[0] += 9
+    assert c.get("1") == "alice"
+    clock[0] += 2
+    assert c.get("1", "missing") == "missing"
+    assert c.stats()["hits"] == 1 and c.stats()["misses"] == 1
+
+
+def test_least_recently_used_is_evicted(clock):
+    c = TTLCache(maxsize=2)
+    c.set("1", "a")
+    c.set("2", "b")
+    c.get("1")
+    c.set("3", "c")
+    assert (c.get("1"), c.get("2"), c.get("3")) == ("a", None, "c")
+    assert c.stats()["evictions"] == 1
+
+
+def test_invalidation_rejects_stale_load(clock):
+    c = TTLCache()
+    version = c.version("1")        # загрузчик начал читать из базы
+    c.invalidate("1")               # а запись тем временем изменили
+    assert c.set("1", "stale", version) is False
+    assert c.get("1") is None
+    assert c.set("1", "fresh", c.version("1")) is True
+    assert c.get("1") == "fresh"
+
+
+def test_invalidation_replaces_cached_value(clock):
+    c = TTLCache()
+    c.set("1", "old")
+    c.invalidate("1")
+    assert c.get("1") is None
+    assert c.version("1") == 1
+    assert c.stats()["invalidations"] == 1
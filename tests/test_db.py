@@ -0,0 +1,45 @@
+import pytest
+
+pytest.importorskip("psycopg2")
+
+
+@pytest.fixture
+def db(postgres):
+    import schema
+    schema.migrate()
+    postgres.register_user("1")
+    return postgres
+
+
+def _deposits(db, count):
+    for n in range(count):
+        db.apply_balance_delta("1", n + 1, "deposit", f"Пополнение {n + 1}")
+
+
+def test_full_last_page_has_no_next_page_hint(db):
+    _deposits(db, 3)
+    history = db.get_user_history("1", page_size=3)
+    assert history.count("Тип операции: deposit") == 3
+    assert "Следующая страница" not in history and "Курсор следующей страницы" not in history
+
+
+def test_history_hint_leads_to_the_rest(db):
+    _deposits(db, 4)
+    history = db.get_user_history("1", page_size=3)
+    cursor = history.rsplit(": ", 1)[1].strip()
+    rest = db.get_user_history("1", page_size=3, cursor=cursor)
+    assert "Сумма: 1," in rest and rest.count("Тип операции") == 1
+
+
+def test_user_chunks_are_read_by_short_queries(db):
+    with db.db_cursor() as cursor:
+        cursor.execute("INSERT INTO users (vk_id, username, created_at) "
+                       "SELECT g::text, 'u' || g, '2026-01-01'::timestamptz + (g % 3) * interval '1 day' "
+                       "FROM generate_series(2, 8) g")
+        cursor.execute("SELECT vk_id FROM users ORDER BY created_at DESC, vk_id")
+        expected = [row[0] for row in cursor.fetchall()]
+    chunks = db.iter_user_chunks(chunk_size=3)
+    first = next(chunks)
+    assert db.get_pool().stats()["in_use"] == 0        # между порциями соединение свободно
+    rest = [user for chunk in chunks for user in chunk]
+    assert [user[0] for user in first + rest] == expected
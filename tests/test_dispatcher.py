@@ -0,0 +1,116 @@
+import time
+
+import pytest
+
+pytest.importorskip("requests")
+
+from dispatcher import Dispatcher
+
+
+@pytest.fixture
+def make_dispatcher(bot_api):
+    created = []
+
+    def make(**kwargs):
+        options = dict(workers=2, global_rate=1000, global_burst=1000, per_chat_rate=1000, per_chat_burst=1000,
+                       backoff_base=0.01, backoff_max=0.05, timeout=5)
+        options.update(kwargs)
+        dispatcher = Dispatcher(bot_api.url, **options)
+        created.append(dispatcher)
+        return dispatcher
+
+    yield make
+    for dispatcher in created:
+        dispatcher.close(wait=False)
+
+
+def _times(bot_api, chat_id):
+    return [sent_at for sent_at, chat, _ in bot_api.requests if chat == str(chat_id)]
+
+
+def test_messages_of_one_chat_keep_order(make_dispatcher, bot_api):
+    dispatcher = make_dispatcher(workers=4)
+    futures = [dispatcher.submit(chat, f"{chat}:{n}") for n in range(20) for chat in (1, 2, 3)]
+    assert all(future.result(5) for future in futures)
+    for chat in (1, 2, 3):
+        assert bot_api.texts(chat) == [f"{chat}:{n}" for n in range(20)]
+
+
+def test_retry_keeps_order_within_chat(make_dispatcher, bot_api):
+    dispatcher = make_dispatcher(workers=1)
+    bot_api.respond(502)
+    bot_api.respond(429, {"ok": False, "parameters": {"retry_after": 0.05}})
+    futures = [dispatcher.submit(1, f"m{n}") for n in range(5)]
+    assert [future.result(5) for future in futures] == [True] * 5
+    assert bot_api.texts(1) == ["m0", "m0", "m0", "m1", "m2", "m3", "m4"]
+    assert dispatcher.stats()["retries"] == 2
+
+
+def test_per_chat_rate(make_dispatcher, bot_api):
+    dispatcher = make_dispatcher(per_chat_rate=10, per_chat_burst=1)
+    futures = [dispatcher.submit(1, str(n)) for n in range(5)]
+    assert all(future.result(5) for future in futures)
+    times = _times(bot_api, 1)
+    assert min(b - a for a, b in zip(times, times[1:])) >= 0.08
+    assert times[-1] - times[0] >= 0.35
+
+
+def test_global_rate(make_dispatcher, bot_api):
+    dispatcher = make_dispatcher(workers=4, global_rate=20, global_burst=1)
+    futures = [dispatcher.submit(chat, "hi") for chat in range(10)]
+    assert all(future.result(5) for future in futures)
+    times = sorted(sent_at for sent_at, _, _ in bot_api.requests)
+    assert times[-1] - times[0] >= 0.4
+
+
+def test_waiting_chat_does_not_block_other_chats(make_dispatcher, bot_api):
+    dispatcher = make_dispatcher(workers=1, per_chat_rate=1, per_chat_burst=1)
+    slow = [dispatcher.submit("slow", str(n)) for n in range(3)]
+    started = time.monotonic()
+    assert dispatcher.submit("fast", "x").result(5) is True
+    assert time.monotonic() - started < 0.5
+    assert not slow[2].done()
+    assert [future.result(5) for future in slow] == [True] * 3
+
+
+def test_retry_after_pauses_all_chats(make_dispatcher, bot_api):
+    dispatcher = make_dispatcher(workers=2)
+    bot_api.respond(429, {"ok": False, "parameters": {"retry_after": 0.3}})
+    assert dispatcher.submit(1, "first").result(5) is True
+    times = _times(bot_api, 1)
+    assert times[1] - times[0] >= 0.3
+
+
+def test_client_error_is_not_retried(make_dispatcher, bot_api):
+    dispatcher = make_dispatcher()
+    bot_api.respond(400, {"ok": False, "description": "chat not found"})
+    assert dispatcher.submit(1, "x").result(5) is False
+    assert dispatcher.stats() == {"queued": 0, "sent": 0, "failed": 1, "retries": 0}
+
+
+def test_gives_up_after_max_retries(make_dispatcher, bot_api):
+    dispatcher = make_dispatcher(max_retries=2)
+    for _ in range(3):
+        bot_api.respond(503)
+    assert dispatcher.submit(1, "x").result(5) is False
+    assert len(bot_api.requests) == 3
+    assert dispatcher.stats()["retries"] == 2
+
+
+def test_close_waits_for_queued_messages(make_dispatcher, bot_api):
+    dispatcher = make_dispatcher(per_chat_rate=20, per_chat_burst=1)
+    futures = [dispatcher.submit(1, str(n)) for n in range(4)]
+    dispatcher.close(wait=True)
+    assert all(future.done() and future.result() for future in futures)
+    assert bot_api.texts(1) == ["0", "1", "2", "3"]
+
+
+def test_close_without_wait_drops_pending(make_dispatcher, bot_api):
+    dispatcher = make_dispatcher(workers=1, per_chat_rate=1, per_chat_burst=1)
+    futures = [dispatcher.submit(1, str(n)) for n in range(3)]
+    assert futures[0].result(5) is True
+    dispatcher.close(wait=False)
+    assert all(future.done() for future in futures)
+    assert bot_api.texts(1) == ["0"]
+    with pytest.raises(RuntimeError):
+        dispatcher.submit(1, "late")
@@ -0,0 +1,83 @@
+import threading
+
+import pytest
+
+from journal import Journal
+
+
+class Writer:
+    """writer для Journal: запоминает пакеты и по флагу падает."""
+
+    def __init__(self):
+        self.batches = []
+        self.fail = False
+
+    def __call__(self, batches):
+        if self.fail:
+            raise RuntimeError("database is down")
+        self.batches.append({table: list(rows) for table, rows in batches.items()})
+
+
+@pytest.fixture
+def journal():
+    writer = Writer()
+    created = Journal(writer, max_rows=1000, flush_interval=60, max_buffer=3)
+    created.writer_stub = writer
+    yield created
+    writer.fail = False
+    created.close()
+
+
+def test_flush_writes_rows_grouped_by_table(journal):
+    journal.append("operations", (1,))
+    journal.append("user_activity", (2,))
+    journal.append("operations", (3,))
+    assert journal.flush() == 3
+    assert journal.writer_stub.batches == [{"operations": [(1,), (3,)], "user_activity": [(2,)]}]
+    assert journal.flush() == 0
+    assert journal.stats()["flushed_rows"] == 3
+
+
+def test_failed_flush_keeps_rows_in_order(journal):
+    journal.append("operations", (1,))
+    journal.writer_stub.fail = True
+    assert journal.flush() == 0
+    journal.append("operations", (2,))
+    journal.writer_stub.fail = False
+    assert journal.flush() == 2
+    assert journal.writer_stub.batches == [{"operations": [(1,), (2,)]}]
+    assert journal.stats()["failed_flushes"] == 1
+
+
+def test_full_buffer_rejects_rows_instead_of_dropping(journal):
+    journal.writer_stub.fail = True
+    assert all(journal.append("operations", (n,)) for n in range(3))
+    assert journal.append("operations", (3,)) is False
+    journal.flush()
+    assert journal.append("operations", (4,)) is False
+    stats = journal.stats()
+    assert (stats["pending"], stats["rejected_rows"]) == (3, 2)
+    journal.writer_stub.fail = False
+    journal.flush()
+    assert journal.writer_stub.batches == [{"operations": [(0,), (1,), (2,)]}]
+
+
+def test_rows_appended_during_failed_flush_are_kept(journal):
+    entered, release = threading.Event(), threading.Event()
+
+    def slow_failing(batches):
+        entered.set()
+        release.wait(5)
+        raise RuntimeError("timeout")
+
+    journal.writer = slow_failing
+    journal.append("operations", (1,))
+    flushing = threading.Thread(target=journal.flush)
+    flushing.start()
+    assert entered.wait(5)
+    journal.append("operations", (2,))
+    release.set()
+    flushing.join(5)
+    journal.writer = journal.writer_stub
+    journal.flush()
+    assert journal.writer_stub.batches == [{"operations": [(1,), (2,)]}]
@@ -0,0 +1,70 @@
+import json
+import logging
+import queue
+
+import pytest
+
+import logsetup
+from logsetup import JsonFormatter, _LazyQueueHandler
+
+
+@pytest.fixture
+def restore_logging():
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    levels = {name: logging.getLogger(name).level for name in logsetup.LOGGING['levels']}
+    yield
+    logsetup.stop_logging()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
+    for name, value in levels.items():
+        logging.getLogger(name).setLevel(value)
+
+
+def _record(msg, *args, **extra):
+    record = logging.LogRecord("main", logging.INFO, __file__, 1, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+def test_json_formatter_includes_extra_fields():
+    entry = json.loads(JsonFormatter().format(_record("Команда %s", "/balance", command="/balance", vk_id="1",
+                                                      duration=0.5, other="skipped")))
+    assert entry["message"] == "Команда /balance"
+    assert entry["level"] == "INFO" and entry["logger"] == "main"
+    assert (entry["command"], entry["vk_id"], entry["duration"]) == ("/balance", "1", 0.5)
+    assert "other" not in entry and "exception" not in entry
+    assert entry["time"].endswith("+00:00")
+
+
+def test_queue_handler_drops_records_when_full():
+    handler = _LazyQueueHandler(queue.Queue(1))
+    record = _record("сообщение %s", 1)
+    handler.emit(record)
+    handler.emit(_record("лишнее"))
+    assert handler.dropped == 1
+    queued = handler.queue.get_nowait()
+    assert queued is record and queued.args == (1,)       # сообщение не собрано до очереди
+
+
+def test_setup_logging_writes_through_the_listener(tmp_path, restore_logging):
+    path = tmp_path / "bot.log"
+    listener = logsetup.setup_logging({'filename': str(path), 'levels': {'querylog': 'WARNING'}}, force=True)
+    assert listener is not None
+    assert logsetup.setup_logging() is listener
+    logging.getLogger("main").info("Баланс %s", 100, extra={"vk_id": "7"})
+    logging.getLogger("querylog").info("не попадет в лог")
+    logsetup.stop_logging()
+    (line,) = path.read_text(encoding="utf-8").splitlines()
+    entry = json.loads(line)
+    assert entry["message"] == "Баланс 100" and entry["vk_id"] == "7"
+    assert logsetup.stats() == {"queued": 0, "dropped": 0}
+
+
+def test_setup_logging_keeps_existing_handlers(restore_logging):
+    root = logging.getLogger()
+    root.addHandler(logging.NullHandler())
+    assert logsetup.setup_logging() is None
@@ -0,0 +1,92 @@
+import threading
+
+import pytest
+
+import main
+import storage
+from ratelimit import RateLimiter, set_rate_limiter
+
+
+@pytest.fixture
+def memory():
+    backend = storage.MemoryStorage()
+    previous = storage.set_storage(backend)
+    set_rate_limiter(RateLimiter({"enabled": False}))
+    backend.register_user("1", "alice")
+    yield backend
+    set_rate_limiter(None)
+    storage.set_storage(previous)
+
+
+def test_retried_deposit_is_logged_once(memory):
+    first = main.handle_command("/deposit", "1", "100", "key-1")
+    assert main.handle_command("/deposit", "1", "100", "key-1") == first == "✅ Баланс пополнен! Новый баланс: 100.0."
+    assert memory.get_user("1")["balance"] == 100
+    assert len(memory.activity_page("1")[0]) == 1
+
+
+def test_concurrent_retries_of_withdraw_are_logged_once(memory):
+    memory.apply_balance_delta("1", 100, "deposit", "seed")
+    replies = []
+    threads = [threading.Thread(target=lambda: replies.append(main.handle_command("/withdraw", "1", "30", "key-2")))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert replies == ["✅ Средства сняты! Новый баланс: 70.0."] * 8
+    assert [row[0] for row in memory.activity_page("1")[0]] == ["Снятие"]
+
+
+def test_reused_key_for_other_amount_is_rejected(memory):
+    main.handle_command("/deposit", "1", "100", "key-3")
+    assert main.handle_command("/deposit", "1", "50", "key-3") == "❌ Этот ключ уже использован для другой операции."
+    assert len(memory.activity_page("1")[0]) == 1
+
+
+@pytest.mark.parametrize("amount", ["-50", "0", "nan", "inf", "abc"])
+def test_deposit_rejects_invalid_amounts(memory, amount):
+    assert main.handle_command("/deposit", "1", amount) == "❌ Сумма пополнения должна быть положительным числом."
+    assert memory.get_user("1")["balance"] == 0
+    assert memory.transactions_page("1")[0] == []
+
+
+def test_withdraw_rejects_negative_amount(memory):
+    assert main.handle_command("/withdraw", "1", "-50") == "❌ Сумма снятия должна быть положительным числом."
+    assert memory.get_user("1")["balance"] == 0
+
+
+def test_transfer_rejects_nan(memory):
+    memory.register_user("2", "bob")
+    with pytest.raises(ValueError):
+        memory.transfer("1", "2", float("nan"))
+
+
+def test_failed_statement_rolls_back_command_and_reports_error(postgres, monkeypatch):
+    import schema
+    schema.migrate()
+    monkeypatch.setattr(storage, "_storage", storage.PostgresStorage())
+    set_rate_limiter(RateLimiter({"enabled": False}))
+    postgres.register_user("1")
+    with postgres.db_cursor() as cursor:
+        # Запись в историю активности упадет, и _log_activity перехватит ошибку
+        cursor.execute("ALTER TABLE user_activity RENAME TO user_activity_off")
+    try:
+        reply = main.handle_command("/deposit", "1", "100")
+    finally:
+        set_rate_limiter(None)
+    assert reply == "❌ Команда не выполнена из-за ошибки базы данных. Попробуйте позже."
+    with postgres.db_cursor() as cursor:
+        cursor.execute("SELECT balance FROM users WHERE vk_id = '1'")
+        assert cursor.fetchone()[0] == 0
+        cursor.execute("SELECT count(*) FROM operations")
+        assert cursor.fetchone()[0] == 0
+
+
+def test_rate_limit_is_keyed_on_sender(memory):
+    set_rate_limiter(RateLimiter({'user': {'rate': 0.001, 'burst': 2}}))
+    assert main.handle_command("/balance", "1", sender_id="7").startswith("💰")
+    assert main.handle_command("/balance", "2", sender_id="7") == "❌ Пользователь не найден."
+    # Другой vk_id в аргументе не дает отправителю новое ведро
+    assert main.handle_command("/balance", "3", sender_id="7").startswith("❌ Слишком много запросов")
+    assert main.handle_command("/balance", "1", sender_id="8").startswith("💰")
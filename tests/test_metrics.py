@@ -0,0 +1,88 @@
+import pytest
+
+import metrics
+from metrics import LATENCY_BUCKETS, CallStats, quantile
+
+
+def test_samples_fall_into_buckets_by_upper_bound():
+    stats = CallStats()
+    stats.observe(1000)                     # ровно 1 мкс — первая корзина
+    stats.observe(1001)
+    stats.observe(int(20e9))                # больше 10 с — корзина +Inf
+    calls, errors, rows, total, counts = stats.copy()
+    assert calls == 3 and errors == 0 and rows == 0
+    assert total == pytest.approx(20.000002001)
+    assert counts[0] == 1 and counts[1] == 1 and counts[-1] == 1
+    assert len(counts) == len(LATENCY_BUCKETS) + 1
+
+
+def test_rows_and_errors_are_counted():
+    stats = CallStats()
+    stats.observe_result(10, [1, 2, 3])
+    stats.observe_result(10, ([1, 2], "cursor"))
+    stats.observe_result(10, "❌ Ошибка при получении данных")
+    stats.observe(10, error=True)
+    calls, errors, rows, _, _ = stats.copy()
+    assert (calls, errors, rows) == (4, 2, 5)
+
+
+def test_samples_are_folded_in_batches():
+    stats = CallStats()
+    for _ in range(metrics.FOLD_EVERY - 1):
+        stats.observe(10)
+    assert len(stats.samples) == metrics.FOLD_EVERY - 1
+    stats.observe(10)
+    assert stats.samples == [] and stats.calls == metrics.FOLD_EVERY
+
+
+def test_quantile_interpolates_within_bucket():
+    counts = [0] * (len(LATENCY_BUCKETS) + 1)
+    assert quantile(counts, 0.5) is None
+    counts[1] = 10                          # все образцы в (1 мкс, 2.5 мкс]
+    assert quantile(counts, 0.5) == pytest.approx(0.00000175)
+    counts[-1] = 90
+    assert quantile(counts, 0.99) == LATENCY_BUCKETS[-1]
+
+
+def test_timed_records_calls_and_exceptions():
+    @metrics.timed("test", "timed_call")
+    def call(fail=False):
+        if fail:
+            raise RuntimeError("boom")
+        return [1, 2]
+
+    metrics.get_stats("test", "timed_call").clear()
+    call()
+    with pytest.raises(RuntimeError):
+        call(fail=True)
+    entry = metrics.snapshot()["test"]["timed_call"]
+    assert (entry["calls"], entry["errors"], entry["rows"]) == (2, 1, 2)
+
+
+def test_timed_generator_counts_rows_of_yielded_chunks():
+    @metrics.timed("test", "timed_chunks")
+    def chunks():
+        yield [1, 2]
+        yield [3]
+
+    metrics.get_stats("test", "timed_chunks").clear()
+    assert list(chunks()) == [[1, 2], [3]]
+    entry = metrics.snapshot()["test"]["timed_chunks"]
+    assert (entry["calls"], entry["rows"]) == (1, 3)
+
+
+def test_prometheus_histogram_is_cumulative():
+    stats = metrics.get_stats("test", 'quo"ted')
+    stats.clear()
+    stats.observe(1000)
+    stats.observe(int(2e6), rows=4)
+    stats.observe(int(20e9), error=True)
+    lines = [line for line in metrics.render_prometheus().splitlines() if 'name="quo\\"ted"' in line]
+    buckets = [line for line in lines if "_bucket" in line]
+    assert len(buckets) == len(LATENCY_BUCKETS) + 1
+    assert buckets[0] == 'bot_test_seconds_bucket{name="quo\\"ted",le="1e-06"} 1'
+    assert buckets[-2].endswith('le="10.0"} 2')
+    assert buckets[-1].endswith('le="+Inf"} 3')
+    assert 'bot_test_seconds_count{name="quo\\"ted"} 3' in lines
+    assert 'bot_test_errors_total{name="quo\\"ted"} 1' in lines
+    assert 'bot_test_rows_total{name="quo\\"ted"} 4' in lines
@@ -0,0 +1,32 @@
+import base64
+import datetime
+
+import pytest
+
+from pagination import decode_cursor, encode_cursor, next_page_hint
+
+CREATED_AT = datetime.datetime(2026, 3, 1, 12, 30, 15, 123456, tzinfo=datetime.timezone.utc)
+
+
+def test_cursor_round_trip():
+    token = encode_cursor(CREATED_AT, 42)
+    assert "=" not in token
+    assert decode_cursor(token) == (CREATED_AT, 42)
+
+
+@pytest.mark.parametrize("token", [
+    "",
+    "not a cursor",
+    base64.urlsafe_b64encode(b'["2026-03-01"]').decode(),
+    base64.urlsafe_b64encode(b'["yesterday",1]').decode(),
+    encode_cursor(CREATED_AT, 42)[:-3],
+])
+def test_tampered_cursor_is_rejected(token):
+    with pytest.raises(ValueError, match="Некорректный курсор"):
+        decode_cursor(token)
+
+
+def test_next_page_hint():
+    assert next_page_hint(None) == ""
+    assert next_page_hint("abc", "/history 1") == "➡️ Следующая страница: /history 1 abc\n"
+    assert next_page_hint("abc") == "➡️ Курсор следующей страницы: abc\n"
@@ -0,0 +1,46 @@
+import pytest
+
+pytest.importorskip("psycopg2")
+
+
+@pytest.fixture
+def partitions(postgres):
+    import partitions
+    import schema
+    schema.migrate()
+    for table in ("operations", "user_activity", "transactions"):
+        assert partitions.convert_table(table)
+    return partitions
+
+
+def test_converted_tables_keep_column_defaults(partitions, postgres):
+    with postgres.db_cursor() as cursor:
+        cursor.execute("INSERT INTO users (vk_id, username, balance) VALUES ('1', 'alice', 0)")
+        cursor.execute("INSERT INTO operations (vk_id, operation_type, amount, details) "
+                       "VALUES ('1', 'deposit', 10, 'x') RETURNING id, created_at")
+        row_id, created_at = cursor.fetchone()
+        assert row_id is not None and created_at is not None
+    assert postgres.record_user_operation("1", "deposit", 5, "y") == "✅ Операция успешно записана."
+
+
+def test_hot_queries_use_parent_indexes_after_conversion(partitions):
+    import schema
+    plans = schema.check_query_plans()
+    for table in ("operations", "user_activity", "transactions"):
+        used = plans[f"{table} page"]
+        assert f"{table}_vk_id_created_at_id_idx" in used
+        assert any(name != f"{table}_vk_id_created_at_id_idx" for name in used)
+
+
+def test_retention_keeps_operation_counters_consistent(partitions, postgres):
+    import datetime
+    postgres.register_user("1")
+    postgres.apply_balance_delta("1", 10, "deposit", "x")
+    postgres.refresh_system_counters()
+    later = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=5 * 365)
+    assert partitions.apply_retention("operations", now=later)
+    with postgres.db_cursor() as cursor:
+        cursor.execute("SELECT count(*) FROM operations")
+        assert cursor.fetchone()[0] == 0
+    info = postgres.get_system_info(verify=True)
+    assert "✅ Счетчики совпадают с данными." in info and "deposit: 1" in info
@@ -0,0 +1,232 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("psycopg2")
+
+from psycopg2 import extensions
+
+import pool
+from pool import ConnectionPool, PoolTimeout
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, query, params=None):
+        self.conn.checks += 1
+        if self.conn.stall is not None:
+            self.conn.stall.wait(5)
+        if self.conn.broken:
+            raise RuntimeError("server closed the connection unexpectedly")
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    """Соединение без сервера: считает проверки и умеет «ломаться»."""
+
+    def __init__(self):
+        self.closed = 0
+        self.autocommit = False
+        self.broken = False
+        self.checks = 0
+        self.stall = None           # threading.Event: проверка ждет, пока его не выставят
+        self.status = extensions.TRANSACTION_STATUS_IDLE
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def get_transaction_status(self):
+        return self.status
+
+    def rollback(self):
+        self.status = extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+@pytest.fixture
+def make_pool(monkeypatch):
+    opened = []
+
+    def connect(self):
+        conn = FakeConnection()
+        conn.autocommit = True
+        opened.append(conn)
+        return conn
+
+    monkeypatch.setattr(ConnectionPool, "_connect", connect)
+
+    def make(**kwargs):
+        kwargs.setdefault("minconn", 0)
+        created = ConnectionPool({}, **kwargs)
+        created.opened = opened
+        return created
+
+    return make
+
+
+def test_reuses_returned_connection(make_pool):
+    p = make_pool(maxconn=2)
+    conn = p.getconn()
+    p.putconn(conn)
+    assert p.getconn() is conn
+    assert len(p.opened) == 1
+
+
+def test_prefills_minconn(make_pool):
+    p = make_pool(minconn=3, maxconn=5)
+    p.putconn(p.getconn())
+    assert len(p.opened) == 3
+    assert p.stats() == {"size": 3, "idle": 3, "in_use": 0, "maxconn": 5}
+
+
+def test_exhausted_pool_times_out(make_pool):
+    p = make_pool(maxconn=2)
+    p.getconn(), p.getconn()
+    started = time.monotonic()
+    with pytest.raises(PoolTimeout):
+        p.getconn(timeout=0.1)
+    assert time.monotonic() - started >= 0.1
+    assert p.stats()["in_use"] == 2
+
+
+def test_waiter_gets_returned_connection(make_pool):
+    p = make_pool(maxconn=1)
+    conn = p.getconn()
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(p.getconn(timeout=5)))
+    waiter.start()
+    time.sleep(0.05)
+    assert not got
+    p.putconn(conn)
+    waiter.join(5)
+    assert got == [conn]
+    assert len(p.opened) == 1
+
+
+def test_failed_connect_frees_slot(make_pool, monkeypatch):
+    p = make_pool(maxconn=1)
+    monkeypatch.setattr(ConnectionPool, "_connect", lambda self: (_ for _ in ()).throw(OSError("refused")))
+    with pytest.raises(OSError):
+        p.getconn()
+    assert p.stats()["size"] == 0
+
+
+def test_expired_connection_is_replaced_on_checkout(make_pool):
+    p = make_pool(maxconn=2, max_lifetime=0.05)
+    conn = p.getconn()
+    p.putconn(conn)
+    time.sleep(0.1)
+    fresh = p.getconn()
+    assert fresh is not conn
+    assert conn.closed
+    assert p.stats()["size"] == 1
+
+
+def test_expired_connection_is_closed_on_return(make_pool):
+    p = make_pool(maxconn=2, max_lifetime=0.05)
+    conn = p.getconn()
+    time.sleep(0.1)
+    p.putconn(conn)
+    assert conn.closed
+    assert p.stats() == {"size": 0, "idle": 0, "in_use": 0, "maxconn": 2}
+
+
+def test_health_check_skipped_for_recently_used(make_pool):
+    p = make_pool(maxconn=1, health_check_after=60)
+    conn = p.getconn()
+    p.putconn(conn)
+    assert p.getconn() is conn
+    assert conn.checks == 0
+
+
+def test_broken_connection_fails_health_check(make_pool):
+    p = make_pool(maxconn=1, health_check_after=0)
+    conn = p.getconn()
+    p.putconn(conn)
+    conn.broken = True
+    fresh = p.getconn()
+    assert fresh is not conn
+    assert conn.checks == 1 and conn.closed
+    assert p.stats()["size"] == 1
+
+
+def test_closed_connection_is_not_handed_out(make_pool):
+    p = make_pool(maxconn=1, health_check_after=60)
+    conn = p.getconn()
+    p.putconn(conn)
+    conn.closed = 2
+    assert p.getconn() is not conn
+
+
+def test_open_transaction_is_rolled_back_on_return(make_pool):
+    p = make_pool(maxconn=1)
+    conn = p.getconn()
+    conn.autocommit = False
+    conn.status = extensions.TRANSACTION_STATUS_INTRANS
+    p.putconn(conn)
+    assert conn.status == extensions.TRANSACTION_STATUS_IDLE
+    assert conn.autocommit
+    assert p.getconn() is conn
+
+
+def test_connection_discarded_after_operational_error(make_pool):
+    p = make_pool(maxconn=1)
+    with pytest.raises(pool.psycopg2.OperationalError):
+        with p.connection() as conn:
+            raise pool.psycopg2.OperationalError("terminating connection")
+    assert conn.closed
+    assert p.stats()["size"] == 0
+
+
+def test_closed_pool_refuses_checkout(make_pool):
+    p = make_pool(maxconn=1)
+    conn = p.getconn()
+    p.closeall()
+    with pytest.raises(pool.psycopg2.InterfaceError):
+        p.getconn()
+    p.putconn(conn)
+    assert conn.closed
+
+
+def test_health_check_does_not_block_other_checkouts(make_pool):
+    p = make_pool(maxconn=3, health_check_after=0)
+    slow, fast = p.getconn(), p.getconn()
+    p.putconn(fast)
+    p.putconn(slow)
+    slow.stall = threading.Event()
+    checking = threading.Thread(target=p.getconn)     # берет slow (LIFO) и ждет на проверке
+    checking.start()
+    while slow.checks == 0:
+        time.sleep(0.001)
+    started = time.monotonic()
+    assert p.getconn(timeout=1) is fast
+    assert p.stats()["in_use"] == 2
+    assert time.monotonic() - started < 0.5
+    slow.stall.set()
+    checking.join(5)
+
+
+def test_prefill_opens_connections_outside_the_lock(make_pool, monkeypatch):
+    p = make_pool(minconn=2, maxconn=2)
+    connect, entered, release = ConnectionPool._connect, threading.Event(), threading.Event()
+
+    def slow_connect(self):
+        entered.set()
+        release.wait(5)
+        return connect(self)
+
+    monkeypatch.setattr(ConnectionPool, "_connect", slow_connect)
+    prefilling = threading.Thread(target=lambda: p.putconn(p.getconn()))
+    prefilling.start()
+    assert entered.wait(5)
+    assert p.stats()["size"] == 2           # stats() не ждет открытия соединений
+    release.set()
+    prefilling.join(5)
+    assert p.stats() == {"size": 2, "idle": 2, "in_use": 0, "maxconn": 2}
@@ -0,0 +1,82 @@
+import pytest
+
+import metrics
+from querylog import LoggedCursorMixin, QueryLog, logged_cursor_factory, normalize_query
+
+
+class FakeCursor:
+    rowcount = 3
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.executed = []
+
+    def execute(self, query, vars=None):
+        if self.fail:
+            raise RuntimeError("relation does not exist")
+        self.executed.append((query, vars))
+
+
+def test_normalize_replaces_values_and_folds_values_lists():
+    assert normalize_query("SELECT * FROM users\n  WHERE vk_id = '42' AND balance > -1.5") == \
+        "SELECT * FROM users WHERE vk_id = ? AND balance > ?"
+    assert normalize_query(b"INSERT INTO t VALUES (%s, %s), (%s, %s), (%s, %s)") == "INSERT INTO t VALUES (...)"
+    assert normalize_query("SELECT %(vk_id)s, 'it''s', t1.col2") == "SELECT ?, ?, t1.col2"
+
+
+def test_fast_queries_are_sampled():
+    log = QueryLog(sample_rate=0.0, slow_threshold=1.0)
+    metrics.get_stats("sql", "SELECT ? -- unsampled").clear()
+    log.observe(FakeCursor(), "SELECT 1 -- unsampled", 1000, 0)
+    assert log.statements == 1
+    assert metrics.get_stats("sql", "SELECT ? -- unsampled").copy()[0] == 0
+    assert log.entries() == []
+
+
+def test_slow_query_is_recorded_and_sent_to_sink():
+    sunk = []
+    log = QueryLog(sample_rate=0.0, slow_threshold=0.1, sink=sunk.append)
+    metrics.get_stats("sql", "SELECT ? -- slow").clear()
+    log.observe(FakeCursor(), "SELECT 1 -- slow", int(0.2e9), int(0.05e9))
+    (entry,) = log.entries()
+    assert entry["query"] == "SELECT ? -- slow"
+    assert entry["duration"] == pytest.approx(0.2) and entry["connection_wait"] == pytest.approx(0.05)
+    assert entry["rows"] == 3 and entry["error"] is None
+    assert sunk == [entry]
+    assert log.stats()["slow"] == 1
+    assert metrics.get_stats("sql", "SELECT ? -- slow").copy()[:3] == (1, 0, 3)
+
+
+def test_paused_thread_does_not_reach_sink():
+    sunk = []
+    log = QueryLog(slow_threshold=0.0, sink=sunk.append)
+    with log.paused():
+        log.observe(FakeCursor(), "INSERT INTO slow_queries VALUES (1)", 10, 0)
+    assert sunk == [] and len(log.entries()) == 1
+
+
+def test_sink_errors_are_swallowed():
+    def sink(entry):
+        raise RuntimeError("sink is down")
+
+    log = QueryLog(slow_threshold=0.0, sink=sink)
+    log.observe(FakeCursor(), "SELECT 1", 10, 0)
+    assert log.stats()["slow"] == 1
+
+
+def test_logged_cursor_records_failures():
+    log = QueryLog(sample_rate=0.0, slow_threshold=10.0)
+    cursor_class = logged_cursor_factory(FakeCursor)
+    assert cursor_class is logged_cursor_factory(FakeCursor)
+    assert issubclass(cursor_class, LoggedCursorMixin)
+
+    cursor = cursor_class(fail=True)
+    cursor.query_log = log
+    cursor.connection_wait = 500
+    with pytest.raises(RuntimeError):
+        cursor.execute("SELECT * FROM missing WHERE id = %s", (1,))
+    (entry,) = log.entries()
+    assert entry["error"] == "relation does not exist" and entry["rows"] == 0
+    assert entry["query"] == "SELECT * FROM missing WHERE id = ?"
+    assert cursor.connection_wait == 0
+    assert log.stats()["failed"] == 1
@@ -0,0 +1,112 @@
+import time
+
+import pytest
+
+from ratelimit import RateLimiter, RateLimited, TokenBucket
+
+CONFIG = {
+    'user': {'rate': 0.001, 'burst': 2},
+    'commands': {'/history': {'rate': 0.001, 'burst': 2}, '/users': {'rate': 0.001, 'burst': 1}},
+    'expensive': ('/history', '/users'),
+    'max_concurrent': 1,
+}
+
+
+def test_token_bucket_reserve_goes_into_debt():
+    bucket = TokenBucket(rate=10.0, burst=1)
+    now = bucket.updated
+    assert bucket.reserve(now) == 0.0
+    assert bucket.delay(now) == pytest.approx(0.1)
+    assert bucket.reserve(now) == pytest.approx(0.1)
+    assert bucket.delay(now + 0.2) == pytest.approx(0.0)
+
+
+def test_user_bucket_rejects_after_burst():
+    limiter = RateLimiter(CONFIG)
+    assert limiter.acquire("1", "/balance") is None
+    assert limiter.acquire("1", "/balance") is None
+    with pytest.raises(RateLimited) as rejected:
+        limiter.acquire("1", "/balance")
+    assert rejected.value.reason == "user" and rejected.value.retry_after > 0
+    assert limiter.acquire("2", "/balance") is None
+
+
+def test_command_bucket_limits_one_command():
+    limiter = RateLimiter(dict(CONFIG, user={'rate': 1000.0, 'burst': 100}, max_concurrent=8))
+    limiter.acquire("1", "/users")()
+    with pytest.raises(RateLimited, match="command"):
+        limiter.acquire("1", "/users")
+    assert limiter.acquire("1", "/balance") is None
+
+
+def test_expensive_commands_hold_a_slot_until_released():
+    limiter = RateLimiter(dict(CONFIG, user={'rate': 1000.0, 'burst': 100},
+                               commands={'/history': {'rate': 1000.0, 'burst': 100}}))
+    release = limiter.acquire("1", "/history")
+    assert limiter.stats()["in_flight"] == 1
+    with pytest.raises(RateLimited, match="concurrency"):
+        limiter.acquire("2", "/history")
+    release()
+    limiter.acquire("2", "/history")()
+    stats = limiter.stats()
+    assert stats["in_flight"] == 0
+    assert stats["throttled_by_reason"] == {"concurrency": 1}
+    assert stats["allowed"] == 2
+
+
+def test_queue_mode_waits_for_a_token():
+    limiter = RateLimiter(dict(CONFIG, user={'rate': 20.0, 'burst': 1}, mode='queue', max_wait=1.0))
+    limiter.acquire("1", "/balance")
+    started = time.monotonic()
+    limiter.acquire("1", "/balance")
+    assert time.monotonic() - started >= 0.03
+    assert limiter.stats()["queued"] == 1
+
+
+def test_sweep_removes_idle_buckets():
+    limiter = RateLimiter(dict(CONFIG, user={'rate': 1000.0, 'burst': 2}))
+    assert limiter.acquire("1", "/balance") is None
+    assert limiter.sweep(now=time.monotonic() + 1) == 1
+    assert limiter.stats()["buckets"] == 0
+
+
+def test_disabled_limiter_admits_everything():
+    limiter = RateLimiter({'enabled': False})
+    assert all(limiter.acquire("1", "/users") is None for _ in range(100))
+
+
+def test_concurrency_rejection_refunds_tokens():
+    limiter = RateLimiter(CONFIG)
+    release = limiter.acquire("1", "/history")
+    for _ in range(3):
+        with pytest.raises(RateLimited) as rejected:
+            limiter.acquire("2", "/history")
+        assert rejected.value.reason == "concurrency"
+    release()
+    limiter.acquire("2", "/history")()
+    limiter.acquire("2", "/history")()
+    with pytest.raises(RateLimited, match="user"):
+        limiter.acquire("2", "/history")
+    assert limiter.stats()["throttled_by_reason"] == {"concurrency": 3, "user": 1}
+
+
+def test_anonymous_commands_have_separate_buckets():
+    limiter = RateLimiter(dict(CONFIG, max_concurrent=8))
+    limiter.acquire(None, "/users")()
+    with pytest.raises(RateLimited, match="command"):
+        limiter.acquire(None, "/users")
+    assert limiter.acquire(None, "/validate") is None
+    assert limiter.acquire(None, "/validate") is None
+    with pytest.raises(RateLimited, match="user"):
+        limiter.acquire(None, "/validate")
+
+
+def test_busy_buckets_over_limit_are_evicted_to_low_water():
+    limiter = RateLimiter(dict(CONFIG, max_buckets=10, sweep_interval=3600))
+    for user in range(11):
+        limiter.acquire(str(user), "/balance")
+    # 11-е ведро превысило предел: осталось 90% от max_buckets
+    assert limiter.stats()["buckets"] == 9
+    assert limiter.stats()["evicted"] == 2
+    limiter.acquire("new", "/balance")
+    assert limiter.stats()["evicted"] == 2
@@ -0,0 +1,33 @@
+import pytest
+
+pytest.importorskip("psycopg2")
+np = pytest.importorskip("numpy")
+
+from reconcile import aggregate_chunk, find_mismatches
+
+
+def test_aggregate_chunk_sums_by_vk_id():
+    vk_ids, sums, counts = aggregate_chunk(np.array(["2", "1", "2", "3", "1", "2"]), [100, -50, 25, 7, 50, 1])
+    assert vk_ids.tolist() == ["1", "2", "3"]
+    assert sums.tolist() == [0, 126, 7]
+    assert counts.tolist() == [2, 3, 1]
+    assert sums.dtype == np.int64
+
+
+def test_aggregate_chunk_keeps_large_sums_exact():
+    big = 2 ** 53 + 1                       # не представимо в float64
+    _, sums, _ = aggregate_chunk(np.array(["1", "1"]), [big, 1])
+    assert int(sums[0]) == big + 1
+
+
+def test_aggregate_empty_chunk():
+    vk_ids, sums, counts = aggregate_chunk(np.array([], dtype=object), [])
+    assert len(vk_ids) == len(sums) == len(counts) == 0
+
+
+def test_find_mismatches_respects_tolerance():
+    indexes, differences = find_mismatches(["1", "2", "3", "4"], [100, 200, 300, 0], [100, 199, 310, 5], tolerance=1)
+    assert indexes.tolist() == [2, 3]
+    assert differences.tolist() == [-10, -5]
+    indexes, differences = find_mismatches(["1"], [100], [100])
+    assert indexes.tolist() == [] and differences.tolist() == []
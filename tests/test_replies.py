@@ -0,0 +1,39 @@
+from replies import render_activity_page, render_transactions_page, render_users_messages
+
+
+def _users(count, start=0):
+    return [(str(n), n * 10, "2026-01-01") for n in range(start, start + count)]
+
+
+def test_users_are_split_into_messages_within_limit():
+    line = len("ID пользователя: 0 - Баланс: 0 - Дата регистрации: 2026-01-01\n")
+    messages = list(render_users_messages([_users(5), _users(5, 5)], max_length=3 * line))
+    assert all(len(message) <= 3 * line for message in messages)
+    assert messages[0].startswith("🗂 Все пользователи:\n")
+    text = "".join(messages)
+    assert [text.count(f"ID пользователя: {n} ") for n in range(10)] == [1] * 10
+    assert len(messages) > 1
+
+
+def test_users_are_read_lazily():
+    read = []
+
+    def chunks():
+        for start in (0, 2):
+            read.append(start)
+            yield _users(2, start)
+
+    messages = render_users_messages(chunks(), max_length=200)
+    next(messages)
+    assert read == [0, 2]
+    assert len(list(messages)) >= 1
+
+
+def test_no_users():
+    assert list(render_users_messages(iter([[]]))) == ["❌ Нет пользователей в системе."]
+
+
+def test_pages_end_with_next_page_hint():
+    page = render_transactions_page([("deposit", 10, "2026-01-01", 1)], "abc", "/history 1")
+    assert page.endswith("➡️ Следующая страница: /history 1 abc\n")
+    assert render_activity_page([]) == "❌ Нет активности для данного пользователя."
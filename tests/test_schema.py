@@ -0,0 +1,42 @@
+import pytest
+
+pytest.importorskip("psycopg2")
+
+
+@pytest.fixture
+def schema(postgres):
+    import schema
+    return schema
+
+
+def test_migrate_is_idempotent(schema):
+    assert schema.migrate() == [migration.version for migration in schema.MIGRATIONS]
+    assert schema.migrate() == []
+
+
+def test_migrate_up_to_target(schema):
+    assert schema.migrate(target=2) == [1, 2]
+    assert schema.migrate() == [migration.version for migration in schema.MIGRATIONS if migration.version > 2]
+
+
+def test_hot_queries_use_their_indexes(schema):
+    schema.migrate()
+    plans = schema.check_query_plans()
+    for hot in schema.hot_queries():
+        assert hot.index in plans[hot.name]
+
+
+def test_check_query_plans_reports_missing_index(schema, postgres):
+    schema.migrate()
+    with postgres.db_cursor() as cursor:
+        cursor.execute("DROP INDEX users_username_idx")
+    with pytest.raises(AssertionError, match="user by username"):
+        schema.check_query_plans()
+
+
+def test_migration_indexes_are_built_after_its_tables(schema, monkeypatch):
+    schema.migrate()
+    extra = schema.Migration(99, "table with index", ["CREATE TABLE IF NOT EXISTS widgets (id int, kind text)"],
+                             [schema.Index("widgets_kind_idx", "ON widgets (kind)")])
+    monkeypatch.setattr(schema, "MIGRATIONS", schema.MIGRATIONS + [extra])
+    assert schema.migrate() == [99]
@@ -0,0 +1,182 @@
+import threading
+from decimal import Decimal
+
+import pytest
+
+import storage
+from storage import MemoryStorage, InsufficientFundsError, IdempotencyConflictError
+
+
+@pytest.fixture
+def memory():
+    backend = MemoryStorage()
+    for vk_id in ("1", "2", "3"):
+        backend.register_user(vk_id, f"user{vk_id}")
+    backend.apply_balance_delta("1", 100, "deposit", "seed")
+    backend.apply_balance_delta("2", 100, "deposit", "seed")
+    return backend
+
+
+def _in_thread(func):
+    result = {}
+
+    def run():
+        try:
+            result["value"] = func()
+        except BaseException as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread, result
+
+
+def test_failed_unit_is_rolled_back(memory):
+    with pytest.raises(RuntimeError):
+        with memory.unit_of_work() as session:
+            memory.transfer("1", "2", 30, session=session)
+            memory.log_activity("1", "Перевод", "30", session=session)
+            memory.record_event("transfer", "1 -> 2", session=session)
+            raise RuntimeError("boom")
+    assert memory.get_user("1")["balance"] == 100 and memory.get_user("2")["balance"] == 100
+    assert len(memory.operations_page("1")[0]) == 1
+    assert memory.activity_page("1") == ([], None)
+    assert memory.events() == []
+    assert memory.system_counters()["total_balance"] == 200
+
+
+def test_guard_rejects_overdraft(memory):
+    with pytest.raises(InsufficientFundsError):
+        memory.apply_balance_delta("1", -101, "withdraw", "x")
+    assert memory.get_user("1")["balance"] == 100
+
+
+def test_units_of_different_users_run_in_parallel(memory):
+    entered, release = threading.Event(), threading.Event()
+
+    def hold_first_user():
+        with memory.unit_of_work() as session:
+            memory.apply_balance_delta("1", 5, "deposit", "x", session=session)
+            entered.set()
+            release.wait(5)
+
+    holder, _ = _in_thread(hold_first_user)
+    assert entered.wait(5)
+    other, result = _in_thread(lambda: memory.apply_balance_delta("2", 5, "deposit", "x").balance)
+    other.join(1)
+    assert result == {"value": Decimal(105)}
+    release.set()
+    holder.join(5)
+
+
+def test_reader_waits_for_unit_of_same_user(memory):
+    entered, release = threading.Event(), threading.Event()
+
+    def hold_first_user():
+        with memory.unit_of_work() as session:
+            memory.apply_balance_delta("1", 5, "deposit", "x", session=session)
+            entered.set()
+            release.wait(5)
+            raise RuntimeError("rollback")
+
+    holder, _ = _in_thread(hold_first_user)
+    assert entered.wait(5)
+    reader, result = _in_thread(lambda: memory.get_user("1")["balance"])
+    reader.join(0.2)
+    assert reader.is_alive()
+    release.set()
+    reader.join(5)
+    assert result == {"value": Decimal(100)}
+
+
+def test_opposite_transfers_do_not_deadlock(memory):
+    def transfers(source, target):
+        for _ in range(300):
+            with memory.unit_of_work() as session:
+                try:
+                    memory.transfer(source, target, 1, session=session)
+                except InsufficientFundsError:
+                    pass
+
+    threads = [threading.Thread(target=transfers, args=pair, daemon=True)
+               for pair in (("1", "2"), ("2", "1"), ("1", "2"), ("2", "1"))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert not any(thread.is_alive() for thread in threads)
+    assert memory.get_user("1")["balance"] + memory.get_user("2")["balance"] == 200
+
+
+def test_concurrent_deposits_keep_history_ordered(memory):
+    def deposits():
+        for _ in range(200):
+            with memory.unit_of_work() as session:
+                memory.apply_balance_delta("3", 1, "deposit", "x", session=session)
+                memory.log_activity("3", "Пополнение", "1", session=session)
+
+    threads = [threading.Thread(target=deposits) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert memory.get_user("3")["balance"] == 1600
+    rows, cursor = [], None
+    while True:
+        page, cursor = memory.operations_page("3", page_size=200, cursor=cursor)
+        rows += page
+        if cursor is None:
+            break
+    assert len(rows) == 1600
+    assert all((a[-2], a[-1]) > (b[-2], b[-1]) for a, b in zip(rows, rows[1:]))
+    assert memory.system_counters()["operations:deposit"] == 1602
+
+
+def test_idempotency_key_replays_and_conflicts(memory):
+    assert memory.apply_balance_delta("1", 10, "deposit", "x", idempotency_key="k") == (110, False)
+    assert memory.apply_balance_delta("1", 10, "deposit", "x", idempotency_key="k") == (110, True)
+    assert memory.get_user("1")["balance"] == 110
+    with pytest.raises(IdempotencyConflictError):
+        memory.apply_balance_delta("2", 10, "deposit", "x", idempotency_key="k")
+
+
+def test_rolled_back_key_can_be_reused(memory):
+    with pytest.raises(RuntimeError):
+        with memory.unit_of_work() as session:
+            memory.apply_balance_delta("1", 10, "deposit", "x", session=session, idempotency_key="k")
+            raise RuntimeError("boom")
+    assert memory.apply_balance_delta("1", 20, "deposit", "x", idempotency_key="k") == (120, False)
+
+
+def test_storage_singleton_can_be_replaced():
+    backend = MemoryStorage()
+    previous = storage.set_storage(backend)
+    try:
+        assert storage.get_storage() is backend
+    finally:
+        storage.set_storage(previous)
+
+
+def test_backend_must_implement_whole_interface():
+    class Partial(storage.StorageBackend):
+        def unit_of_work(self):
+            return None
+
+    with pytest.raises(TypeError):
+        Partial()
+
+
+def test_prepare_adjustments_rejects_invalid_rows():
+    staged, rejected = storage.prepare_adjustments([
+        (None, 10, "нет пользователя"),
+        ("", 10, "пустой id"),
+        ("1", "десять", "не число"),
+        ("1", float("nan"), "nan"),
+        ("1", "inf", "бесконечность"),
+        (2, "10.50", "годная"),
+        ("3", -5, "списание"),
+    ])
+    assert [(row.index, row.error) for row in rejected] == [(i, "invalid") for i in range(5)]
+    assert rejected[2] == storage.RejectedAdjustment(2, "1", "десять", "не число", "invalid")
+    assert staged == [(5, "2", Decimal("10.50"), "годная"), (6, "3", Decimal(-5), "списание")]
+    assert all(type(row[2]) is Decimal for row in staged)